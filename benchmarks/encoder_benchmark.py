@@ -0,0 +1,58 @@
+"""
+Micro-benchmark of point serialization: dict points encoded by the influxdb client against LineProtocolEncoder.
+
+    python -m benchmarks.encoder_benchmark [--samples N] [--json]
+"""
+import sys
+import time
+import argparse
+import simplejson as json
+from influxdb.line_protocol import make_lines
+from particlehub.line_protocol import LineProtocolEncoder
+
+TAGS = dict(site="north lab", room="b-12", firmware="1.4.2")
+SAMPLE = dict(temp=21.53, hum=40.1, pressure=1013.2, battery=3.91, rssi=-67, uptime=86400, charging=False,
+              timestamp="2021-01-01T00:00:00.000Z")
+DEVICES = 100
+
+
+def legacy_encode(data, tags, timestamp):
+    tags = dict(tags)
+    points = [{"measurement": name, "fields": {"value": value}, "tags": tags, "time": timestamp}
+              for name, value in data.items() if name not in tags]
+    return make_lines(dict(points=points))
+
+
+def points_per_second(encode, samples):
+    device_ids = ["device%d" % i for i in range(DEVICES)]
+    start = time.perf_counter()
+    for index in range(samples):
+        encode(SAMPLE, TAGS, 1609459200000000000 + index, device_ids[index % DEVICES])
+    return samples * len(SAMPLE) / (time.perf_counter() - start)
+
+
+def run(samples):
+    encoder = LineProtocolEncoder()
+    legacy = points_per_second(lambda data, tags, timestamp, device_id: legacy_encode(data, tags, timestamp),
+                               samples)
+    encoded = points_per_second(encoder.encode, samples)
+    return dict(legacy=legacy, encoder=encoded, speedup=encoded / legacy,
+                legacy_us_per_point=1e6 / legacy, encoder_us_per_point=1e6 / encoded)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--samples", type=int, default=50000)
+    arg_parser.add_argument("--json", action="store_true", help="print machine readable results")
+    args = arg_parser.parse_args(argv)
+    results = run(args.samples)
+    if args.json:
+        print(json.dumps(results))
+        return
+    print("legacy   %10.0f points/s %6.2f us/point" % (results["legacy"], results["legacy_us_per_point"]))
+    print("encoder  %10.0f points/s %6.2f us/point" % (results["encoder"], results["encoder_us_per_point"]))
+    print("speedup  %10.1fx" % results["speedup"])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
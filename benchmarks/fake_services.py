@@ -0,0 +1,238 @@
+"""
+Local stand-ins for the Particle cloud and InfluxDB used by the benchmarks. Both run in a separate process so
+the CPU and memory measured in the benchmark process belong to particle-hub alone.
+
+Particle API:   GET /v1/devices, GET /v1/devices/<id>/, GET /v1/devices/<id>/<variable>,
+                POST /v1/devices/<id>/<function>, GET /v1/devices/events (SSE replay of a synthetic fleet)
+InfluxDB:       POST /write, GET|POST /query, GET /ping, GET /stats (benchmark results)
+
+Every generated event carries a "seq" variable; the InfluxDB stand-in matches written seq points with their
+send time to measure ingest to write latency.
+"""
+import time
+import random
+import threading
+import multiprocessing
+import simplejson as json
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PAYLOADS = dict(
+    small="temp=%(temp).2f,hum=40",
+    typical="temp=%(temp).2f,hum=40.1,pressure=1013.2,battery=3.91,rssi=-67,uptime=86400,charging=false,fw=1.4.2",
+    batched=";".join(["temp=%(temp).2f,hum=40.%(i)d,rssi=-67"] * 10),
+)
+VARIABLES = dict(seq="int", temp="double", hum="double", pressure="double", battery="double", rssi="int",
+                 uptime="int", charging="bool", fw="string")
+
+
+def device_ids(count):
+    return ["%024x" % (0xbe000000 + i) for i in range(count)]
+
+
+def device_list(count):
+    return [dict(id=device_id, name="bench-%d" % i, variables=VARIABLES, functions=["reset"], notes=None,
+                 connected=True, online=True, status="normal", last_heard="2021-01-01T00:00:00.000Z")
+            for i, device_id in enumerate(device_ids(count))]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Fleet:
+    """Synthetic fleet shared by both stand-ins: what was sent and when, and what was written"""
+
+    def __init__(self, devices, events, rate, payload):
+        self.devices = device_list(devices)
+        self.events = events
+        self.rate = rate
+        self.payload = PAYLOADS[payload]
+        self.sent = dict()  # seq: send time
+        self.latencies = list()
+        self.points = 0
+        self.writes = 0
+        self.first_sent = None
+        self.last_written = None
+        self.variable_reads = 0
+        self.function_calls = 0
+        self.lock = threading.Lock()
+
+    def frames(self):
+        """Yields encoded SSE frames, paced to rate events per second (0 for unpaced)"""
+        yield b"retry: 1000\n\n"
+        start = time.time()
+        self.first_sent = start
+        for seq in range(self.events):
+            if self.rate:
+                delay = start + seq / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            device = self.devices[seq % len(self.devices)]
+            published_at = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + ".000Z"
+            data = "seq=%d," % seq + self.payload % dict(temp=random.uniform(15, 25), i=seq % 10)
+            event = dict(data=data, ttl=60, published_at=published_at, coreid=device["id"])
+            self.sent[seq] = time.time()
+            yield ("event: DATA\ndata: %s\n\n" % json.dumps(event)).encode()
+
+    def record_write(self, body):
+        now = time.time()
+        lines = body.decode().splitlines()
+        with self.lock:
+            self.writes += 1
+            self.points += len(lines)
+            self.last_written = now
+            for line in lines:
+                if line.startswith("seq,") or line.startswith("seq "):
+                    value = line.split("value=", 1)[1].split(" ", 1)[0].rstrip("i")
+                    sent = self.sent.get(int(float(value)))
+                    if sent is not None:
+                        self.latencies.append(now - sent)
+
+    def stats(self):
+        with self.lock:
+            written = len(self.latencies)
+            elapsed = (self.last_written - self.first_sent) if self.first_sent and self.last_written else None
+            return dict(events_sent=len(self.sent), events_written=written, points=self.points, writes=self.writes,
+                        elapsed=elapsed, events_per_second=written / elapsed if elapsed else None,
+                        latency_p50=percentile(self.latencies, 0.5), latency_p99=percentile(self.latencies, 0.99),
+                        variable_reads=self.variable_reads, function_calls=self.function_calls)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fleet = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_empty(self, status=204):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+
+class ParticleHandler(_Handler):
+
+    def do_GET(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts == ["v1", "devices"]:
+            self._send_json(self.fleet.devices)
+        elif parts == ["v1", "devices", "events"]:
+            self._stream_events()
+        elif len(parts) == 3 and parts[:2] == ["v1", "devices"]:
+            self._send_json(dict(self._device(parts[2]), tags=dict()))
+        elif len(parts) == 4 and parts[:2] == ["v1", "devices"]:
+            self.fleet.variable_reads += 1
+            self._send_json(dict(cmd="VarReturn", name=parts[3], result=random.uniform(15, 25)))
+        else:
+            self._send_json(dict(error="not found"), 404)
+
+    def do_POST(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        self._read_body()
+        if len(parts) == 4 and parts[:2] == ["v1", "devices"]:
+            self.fleet.function_calls += 1
+            self._send_json(dict(id=parts[2], connected=True, return_value=1))
+        else:
+            self._send_json(dict(error="not found"), 404)
+
+    def _device(self, device_id):
+        return next((device for device in self.fleet.devices if device["id"] == device_id), dict(id=device_id))
+
+    def _stream_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        buffer = list()
+        for frame in self.fleet.frames():
+            buffer.append(frame)
+            if len(buffer) >= 64 or self.fleet.rate:
+                self._write_chunk(b"".join(buffer))
+                buffer = list()
+        if buffer:
+            self._write_chunk(b"".join(buffer))
+        while True:  # Hold the stream open like the cloud does
+            time.sleep(15)
+            self._write_chunk(b":\n\n")
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class InfluxHandler(_Handler):
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/ping":
+            self._send_empty()
+        elif path == "/stats":
+            self._send_json(self.fleet.stats())
+        elif path == "/query":
+            self._send_json(dict(results=[dict(statement_id=0)]))
+        else:
+            self._send_json(dict(error="not found"), 404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+        if path == "/write":
+            self.fleet.record_write(body)
+            self._send_empty()
+        elif path == "/query":
+            self._send_json(dict(results=[dict(statement_id=0)]))
+        else:
+            self._send_json(dict(error="not found"), 404)
+
+
+def serve(fleet_options, connection):
+    fleet = Fleet(**fleet_options)
+    particle = ThreadingHTTPServer(("127.0.0.1", 0), type("Particle", (ParticleHandler,), dict(fleet=fleet)))
+    influx = ThreadingHTTPServer(("127.0.0.1", 0), type("Influx", (InfluxHandler,), dict(fleet=fleet)))
+    particle.daemon_threads = influx.daemon_threads = True
+    threading.Thread(target=influx.serve_forever, daemon=True).start()
+    connection.send((particle.server_address[1], influx.server_address[1]))
+    particle.serve_forever()
+
+
+class FakeServices:
+    """Runs the Particle and InfluxDB stand-ins in a child process"""
+
+    def __init__(self, devices=100, events=10000, rate=0, payload="typical"):
+        self.fleet_options = dict(devices=devices, events=events, rate=rate, payload=payload)
+        self.process = None
+        self.particle_port = None
+        self.influx_port = None
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        self.process = context.Process(target=serve, args=(self.fleet_options, sender), daemon=True)
+        self.process.start()
+        self.particle_port, self.influx_port = receiver.recv()
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+
+    @property
+    def particle_url(self):
+        return "http://127.0.0.1:%d/v1/" % self.particle_port
@@ -0,0 +1,170 @@
+"""
+End to end ingestion benchmark: HubManager and StreamManager reading a synthetic fleet from a local Particle
+stand-in and writing to a local InfluxDB stand-in (see benchmarks.fake_services).
+
+    python -m benchmarks.ingest_benchmark [--devices N] [--events N] [--rate EPS] [--payload small|typical|batched]
+                                          [--engine thread|asyncio] [--handler-workers N] [--shards N]
+                                          [--poll-rate N] [--metrics]
+                                          [--json] [--output FILE] [--baseline FILE] [--tolerance 0.2]
+
+Reports events/s, p50/p99 ingest to write latency, memory per device and CPU per event. With --baseline the
+run fails (exit status 1) if throughput dropped or p99 latency grew by more than the tolerance.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import requests
+import simplejson as json
+from particlehub import models, metrics
+from benchmarks.fake_services import FakeServices
+
+REGRESSION_CHECKS = dict(events_per_second=1, latency_p99=-1, cpu_per_event=-1)  # 1: higher is better
+
+
+def resident_memory():
+    """:return: (int) current resident set size in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(devices=100, events=10000, rate=0, payload="typical", engine="thread", handler_workers=4, shards=0,
+        poll_rate=1000, timeout=300):
+    services = FakeServices(devices=devices, events=events, rate=rate, payload=payload).start()
+    state_dir = tempfile.TemporaryDirectory()
+    os.environ["PHSTATE_FILE"] = os.path.join(state_dir.name, "phstate.pkl")
+    models.Device.set_api_url(services.particle_url)
+    influx_url = "http://127.0.0.1:%d" % services.influx_port
+    log_credentials = dict(host="127.0.0.1", port=services.influx_port, database="bench", flush_interval=0.1,
+                           spool_dir=None)
+    stream_config = dict(url=services.particle_url + "devices/events?access_token=bench", engine=engine,
+                         handler_workers=handler_workers, shards=shards)
+
+    memory_start = resident_memory()
+    cloud = models.ParticleCloud("bench")
+    hub_manager = models.HubManager(cloud, stream_config, [], "influx", log_credentials,
+                                    poll_config=dict(rate=poll_rate, burst=poll_rate),
+                                    leader_lock=_NeverLeader())  # Ingestion starts once all devices are managed
+    hub_manager.add_devices(list(hub_manager.devices))
+
+    poll_start = time.perf_counter()
+    hub_manager.update_all_device_data()
+    poll_elapsed = time.perf_counter() - poll_start
+
+    cpu_start = time.process_time()
+    hub_manager.start_ingestion()
+    deadline = time.monotonic() + timeout
+    stats = dict()
+    while time.monotonic() < deadline:
+        stats = requests.get(influx_url + "/stats").json()
+        if stats["events_written"] >= events:
+            break
+        time.sleep(0.1)
+    cpu_elapsed = time.process_time() - cpu_start
+    memory_end = resident_memory()
+
+    hub_manager.stop_ingestion()
+    models.close_influx_writers()
+    services.stop()
+    state_dir.cleanup()
+
+    written = stats.get("events_written", 0)
+    return dict(config=dict(devices=devices, events=events, rate=rate, payload=payload, engine=engine,
+                            handler_workers=handler_workers, shards=shards, poll_rate=poll_rate),
+                events_written=written, events_per_second=stats.get("events_per_second"),
+                latency_p50=stats.get("latency_p50"), latency_p99=stats.get("latency_p99"),
+                points_written=stats.get("points"), influx_writes=stats.get("writes"),
+                memory_total=memory_end - memory_start, memory_per_device=(memory_end - memory_start) / devices,
+                cpu_per_event=cpu_elapsed / written if written else None,
+                poll_seconds=poll_elapsed, variable_reads=stats.get("variable_reads"),
+                complete=written >= events)
+
+
+class _NeverLeader:
+    """Leader lock that is never won, so the benchmark decides when ingestion starts"""
+
+    def acquire(self):
+        return False
+
+    def renew(self):
+        return True
+
+    def release(self):
+        pass
+
+
+def regressions(results, baseline, tolerance):
+    """:return: (list) descriptions of metrics worse than baseline by more than tolerance"""
+    found = list()
+    for metric, direction in REGRESSION_CHECKS.items():
+        current, previous = results.get(metric), baseline.get(metric)
+        if current is None or previous is None:
+            continue
+        if (direction > 0 and current < previous * (1 - tolerance)) or \
+                (direction < 0 and current > previous * (1 + tolerance)):
+            found.append("%s: %.6g (baseline %.6g)" % (metric, current, previous))
+    if not results.get("complete"):
+        found.append("only %d of %d events were written" % (results["events_written"], results["config"]["events"]))
+    return found
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--devices", type=int, default=100)
+    arg_parser.add_argument("--events", type=int, default=10000)
+    arg_parser.add_argument("--rate", type=float, default=0, help="events/s sent by the cloud, 0 for unpaced")
+    arg_parser.add_argument("--payload", default="typical", choices=["small", "typical", "batched"])
+    arg_parser.add_argument("--engine", default="thread", choices=["thread", "asyncio"])
+    arg_parser.add_argument("--handler-workers", type=int, default=4)
+    arg_parser.add_argument("--shards", type=int, default=0)
+    arg_parser.add_argument("--poll-rate", type=float, default=1000, help="variable reads/s allowed by the poller")
+    arg_parser.add_argument("--metrics", action="store_true", help="run with instrumentation enabled")
+    arg_parser.add_argument("--timeout", type=float, default=300)
+    arg_parser.add_argument("--json", action="store_true", help="print machine readable results")
+    arg_parser.add_argument("--output", help="also write the JSON results to this file")
+    arg_parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    arg_parser.add_argument("--tolerance", type=float, default=0.2)
+    args = arg_parser.parse_args(argv)
+    if args.metrics:
+        metrics.enable()
+
+    results = run(devices=args.devices, events=args.events, rate=args.rate, payload=args.payload,
+                  engine=args.engine, handler_workers=args.handler_workers, shards=args.shards,
+                  poll_rate=args.poll_rate, timeout=args.timeout)
+    results["config"]["metrics"] = args.metrics
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print("events written      %d / %d" % (results["events_written"], args.events))
+        print("throughput          %s events/s" % _format(results["events_per_second"], "%.0f"))
+        print("latency p50 / p99   %s / %s ms" % (_format(results["latency_p50"], "%.1f", 1000),
+                                                  _format(results["latency_p99"], "%.1f", 1000)))
+        print("memory per device   %.0f bytes" % results["memory_per_device"])
+        print("cpu per event       %s us" % _format(results["cpu_per_event"], "%.1f", 1e6))
+        print("poll all devices    %.3f s" % results["poll_seconds"])
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found = regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in found:
+            print("REGRESSION " + regression, file=sys.stderr)
+        status = 1 if found else 0
+    sys.stdout.flush()
+    sys.exit(status)
+
+
+def _format(value, template, scale=1):
+    return "n/a" if value is None else template % (value * scale)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of DATA payload parsing: the original two list comprehension split against DataParser.
+
+    python -m benchmarks.parser_benchmark [--events N] [--json]
+"""
+import sys
+import time
+import argparse
+import simplejson as json
+from particlehub.parser import DataParser
+
+PAYLOADS = dict(
+    small="temp=21.5,hum=40",
+    typical="temp=21.53,hum=40.1,pressure=1013.2,battery=3.91,rssi=-67,uptime=86400,charging=false,fw=1.4.2",
+    batched=";".join("temp=21.%d,hum=40.%d,rssi=-6%d" % (i, i, i) for i in range(10)),
+)
+
+
+def legacy_parse(payload):
+    device_data_pairs = payload.split(",")
+    device_data_pairs = [pair.split("=") for pair in device_data_pairs]
+    return {pair[0]: pair[1] for pair in device_data_pairs}
+
+
+def events_per_second(func, payload, events):
+    start = time.perf_counter()
+    for _ in range(events):
+        func(payload)
+    return events / (time.perf_counter() - start)
+
+
+def run(events):
+    parser = DataParser()
+    results = dict()
+    for name, payload in PAYLOADS.items():
+        typed = events_per_second(lambda p: parser.parse_samples(p, "bench-device"), payload, events)
+        result = dict(parser=typed)
+        if name != "batched":  # The legacy split cannot parse batched payloads
+            result["legacy"] = events_per_second(legacy_parse, payload, events)
+        results[name] = result
+    return results
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--events", type=int, default=100000)
+    arg_parser.add_argument("--json", action="store_true", help="print machine readable results")
+    args = arg_parser.parse_args(argv)
+    results = run(args.events)
+    if args.json:
+        print(json.dumps(results))
+        return
+    for name, result in results.items():
+        line = "%-8s parser %10.0f events/s" % (name, result["parser"])
+        if "legacy" in result:
+            line += "   legacy %10.0f events/s (untyped strings)" % result["legacy"]
+        print(line)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
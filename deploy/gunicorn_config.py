@@ -1,4 +1,9 @@
+import os
+
 bind = "0.0.0.0:5000"
-workers = 1
-threads = 1
+# Every worker serves the UI, one of them is elected to run stream ingestion (see coordination_config)
+workers = int(os.environ.get("PH_WEB_WORKERS", 1))
+# Every open /events stream holds a thread until the browser disconnects. phconfig.live_max_clients caps them per
+# worker (503 beyond the cap) and must stay below threads so page loads and /health/* are still served.
+threads = 8
 timeout = 120
@@ -0,0 +1,231 @@
+import ssl
+import asyncio
+import logging
+import threading
+import urllib.parse
+from particlehub import metrics
+from particlehub.sse import StreamHTTPError, SSEFrameParser, Backoff, request_headers
+
+phlog = logging.getLogger("particle-hub.async_stream")
+
+PARTICLE_EVENTS_URL = "https://api.particle.io/v1/"
+
+
+def subscription_url(access_token, product=None, device_id=None, event_prefix=None):
+    """
+    Builds a Particle event stream URL for a product fleet, a single device or all devices of the account,
+    optionally limited to events whose name starts with event_prefix.
+
+    :return: (str)
+    """
+    if product is not None:
+        path = "products/%s/events" % product
+    elif device_id is not None:
+        path = "devices/%s/events" % device_id
+    else:
+        path = "devices/events"
+    if event_prefix:
+        path = "%s/%s" % (path, urllib.parse.quote(event_prefix))
+    return PARTICLE_EVENTS_URL + path + "?" + urllib.parse.urlencode(dict(access_token=access_token))
+
+
+class SSESubscription:
+
+    def __init__(self, url, on_event, name=None, headers=None, last_event_id=None):
+        """
+            url (str):               SSE endpoint
+            on_event (callable):     on_event(sseclient.Event), called on the engine loop thread. It must
+                                     return quickly: while it runs no subscription reads, so slow work belongs
+                                     on another thread (StreamManager queues events to its handler_workers).
+            name (str):              label used in logs and stats
+            headers (dict):          extra request headers
+            last_event_id (str):     resume point for the first connection
+        """
+        self.url = url
+        self.on_event = on_event
+        self.name = name if name is not None else urllib.parse.urlsplit(url).path
+        self.headers = headers if headers is not None else dict()
+        self.last_event_id = last_event_id
+        self.connected = False
+        self.events = 0
+        self.reconnects = 0
+
+    def stats(self):
+        return dict(connected=self.connected, events=self.events, reconnects=self.reconnects,
+                    last_event_id=self.last_event_id)
+
+
+class AsyncStreamEngine:
+    """
+    Runs many SSE subscriptions concurrently on a single asyncio event loop. Dropped connections are retried
+    with jittered exponential backoff and resumed from the last received event id. Event handlers run on the
+    loop, so a slow handler delays every subscription. The engine can be stopped and started again.
+    """
+
+    def __init__(self, subscriptions=None, idle_timeout=90.0, backoff_base=1.0, backoff_max=60.0):
+        self.subscriptions = list(subscriptions) if subscriptions is not None else list()
+        self.idle_timeout = idle_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.loop = None
+        self._tasks = list()
+        self._thread = None
+
+    def add_subscription(self, subscription):
+        self.subscriptions.append(subscription)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._start_task, subscription)
+
+    def start(self):
+        """Runs the engine on a background thread"""
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, args=(ready,), name="PHAsyncStreamThread",
+                                        daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self, timeout=1):
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._cancel_tasks)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run_loop(self, ready):
+        self.loop = asyncio.new_event_loop()
+        self._tasks = list()  # Tasks of a previous run belong to its closed loop
+        asyncio.set_event_loop(self.loop)
+        for subscription in self.subscriptions:
+            self._start_task(subscription)
+        self.loop.call_soon(ready.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def run(self):
+        """Runs every subscription on the current event loop until cancelled"""
+        self.loop = asyncio.get_running_loop()
+        self._tasks = list()
+        for subscription in self.subscriptions:
+            self._start_task(subscription)
+        try:
+            await asyncio.gather(*self._tasks)
+        except asyncio.CancelledError:
+            self._cancel_tasks()
+            raise
+
+    def _start_task(self, subscription):
+        self._tasks.append(self.loop.create_task(self._consume(subscription)))
+
+    def _cancel_tasks(self):
+        for task in self._tasks:
+            task.cancel()
+        if not self.loop.is_running() or self._thread is None:
+            return
+        tasks = list(self._tasks)
+        self.loop.create_task(self._stop_after(tasks))
+
+    async def _stop_after(self, tasks):
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    async def _consume(self, subscription):
+        backoff = Backoff(self.backoff_base, self.backoff_max)
+        while True:
+            try:
+                async for event in self._read_events(subscription):
+                    backoff.reset()
+                    subscription.events += 1
+                    if event.id:
+                        subscription.last_event_id = event.id
+                    try:
+                        subscription.on_event(event)
+                    except Exception as e:
+                        phlog.error("Stream %s event handler raised %s" % (subscription.name, type(e).__name__))
+                        phlog.debug(e)
+            except asyncio.CancelledError:
+                subscription.connected = False
+                raise
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, StreamHTTPError) as e:
+                phlog.warning("Stream %s disconnected: %s" % (subscription.name, type(e).__name__))
+                phlog.debug(e)
+            subscription.connected = False
+            subscription.reconnects += 1
+            if metrics.enabled:
+                metrics.STREAM_RECONNECTS.inc(subscription.name)
+            await asyncio.sleep(backoff.next_delay())
+
+    async def _read_events(self, subscription):
+        url = urllib.parse.urlsplit(subscription.url)
+        secure = url.scheme == "https"
+        port = url.port or (443 if secure else 80)
+        reader, writer = await self._with_timeout(
+            asyncio.open_connection(url.hostname, port, ssl=ssl.create_default_context() if secure else None))
+        try:
+            headers = dict(Host=url.netloc, **request_headers(subscription.headers, subscription.last_event_id))
+            target = url.path + ("?" + url.query if url.query else "")
+            request = "GET %s HTTP/1.1\r\n" % target
+            request += "".join("%s: %s\r\n" % item for item in headers.items()) + "\r\n"
+            writer.write(request.encode())
+            await writer.drain()
+
+            status_line = await self._readline(reader)
+            status = status_line.split(b" ", 2)
+            if len(status) < 2 or status[1] != b"200":
+                raise StreamHTTPError(status_line.decode(errors="replace").strip())
+            chunked = False
+            while True:
+                line = await self._readline(reader)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "transfer-encoding" and "chunked" in value.lower():
+                    chunked = True
+            subscription.connected = True
+
+            parser = SSEFrameParser()
+            async for chunk in self._iter_body(reader, chunked):
+                for event in parser.feed(chunk):
+                    yield event
+        finally:
+            writer.close()
+
+    async def _iter_body(self, reader, chunked):
+        while True:
+            if chunked:
+                size_line = await self._readline(reader)
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    raise EOFError("Stream closed by server")
+                chunk = await self._with_timeout(reader.readexactly(size + 2))
+                yield chunk[:-2]
+            else:
+                chunk = await self._with_timeout(reader.read(65536))
+                if not chunk:
+                    raise EOFError("Stream closed by server")
+                yield chunk
+
+    async def _readline(self, reader):
+        line = await self._with_timeout(reader.readline())
+        if not line:
+            raise EOFError("Stream closed by server")
+        return line
+
+    async def _with_timeout(self, awaitable):
+        """
+        Awaits with the idle timeout. Unlike asyncio.wait_for on Python < 3.12 this never swallows a cancellation
+        that races a completed read.
+        """
+        task = asyncio.ensure_future(awaitable)
+        try:
+            done, _ = await asyncio.wait({task}, timeout=self.idle_timeout)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if not done:
+            task.cancel()
+            raise asyncio.TimeoutError("No data for %s seconds" % self.idle_timeout)
+        return task.result()
+
+    def stats(self):
+        return {subscription.name: subscription.stats() for subscription in self.subscriptions}
@@ -0,0 +1,97 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from particlehub.polling import TokenBucket, AccountLimiter, DEFAULT_RATE, DEFAULT_BURST
+
+phlog = logging.getLogger("particle-hub.commands")
+
+
+class CommandResult:
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.return_value = None
+        self.error = None
+        self.attempts = 0
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def to_dict(self):
+        result = dict(status="success" if self.ok else "fail", return_value=self.return_value,
+                      attempts=self.attempts, elapsed=self.elapsed)
+        if not self.ok:
+            result["error"] = self.error
+        return result
+
+
+class FleetCommander:
+    """
+    Calls a Particle function on many devices concurrently over the shared HTTP session. Requests are limited
+    per account and by a token bucket, each call has a timeout, and transient failures are retried with
+    exponential backoff.
+    """
+
+    def __init__(self, max_workers=32, account_concurrency=8, rate=DEFAULT_RATE, burst=DEFAULT_BURST, timeout=10.0,
+                 retries=2, retry_backoff=0.5, rate_limiter=None):
+        """
+            max_workers (int):            size of the request thread pool
+            account_concurrency (int):    max in-flight calls per cloud API token
+            rate (float), burst (int):    token bucket settings, ignored when rate_limiter is given
+            timeout (float):              seconds to wait for each call
+            retries (int):                extra attempts after a timeout, HTTP 429 or 5xx
+            retry_backoff (float):        seconds before the first retry, doubled for each later one
+            rate_limiter (TokenBucket):   shared with other users of the same API budget, e.g. the poller
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="PHCommandThread")
+        self.account_limiter = AccountLimiter(account_concurrency)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket(rate, burst)
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+    def call(self, devices, function, argument=""):
+        """
+        Calls function(argument) on every device in parallel
+
+        :param devices: (list) Device objects
+        :param function: (str) Particle function name
+        :param argument: (str) function argument, at most 63 characters
+
+        :return: (dict) device_id: CommandResult
+        """
+        futures = [(device, self.executor.submit(self._call, device, function, argument)) for device in devices]
+        return {device.id: future.result() for device, future in futures}
+
+    def _call(self, device, function, argument):
+        from particlehub.models import CloudCommunicationError, TransientCloudError
+        result = CommandResult(device.id)
+        start = time.monotonic()
+        while True:
+            result.attempts += 1
+            try:
+                with self.account_limiter.limit(device.cloud_api_token):
+                    self.rate_limiter.acquire()
+                    result.return_value = device.call_function(function, argument, timeout=self.timeout)
+                result.error = None
+                break
+            except TransientCloudError as e:
+                result.error = str(e) or type(e).__name__
+                if result.attempts > self.retries:
+                    break
+                time.sleep(self.retry_backoff * 2 ** (result.attempts - 1))
+            except CloudCommunicationError as e:
+                result.error = str(e) or type(e).__name__
+                break
+            except Exception as e:
+                phlog.error("Calling %s on %s failed" % (function, device.id))
+                phlog.debug(e)
+                result.error = type(e).__name__
+                break
+        result.elapsed = time.monotonic() - start
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,134 @@
+import os
+import fcntl
+import logging
+import threading
+
+phlog = logging.getLogger("particle-hub.coordination")
+
+
+###################################################################################################
+# Leader Election
+
+class LeaderLock:
+    """
+    Exclusive lock deciding which of several processes owns stream ingestion. A backend for a shared service
+    (e.g. a database or key value store lease) implements the same three methods.
+    """
+
+    def acquire(self):
+        """:return: (bool) True if this process now holds the lock, never blocks"""
+        raise NotImplementedError
+
+    def renew(self):
+        """:return: (bool) False if the lock was lost since it was acquired"""
+        return True
+
+    def release(self):
+        raise NotImplementedError
+
+
+class FileLeaderLock(LeaderLock):
+    """
+    flock based lock for processes on one host. The kernel releases it when the holder exits, so a crashed
+    leader is replaced on the next election attempt.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, "a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+lock_backends = dict(file=FileLeaderLock)
+
+
+def open_leader_lock(backend="file", path=None, **options):
+    """
+    Creates the leader lock, by default a file lock next to PHSTATE_FILE
+
+    :param backend: (str) key of lock_backends
+    :param path: (str) lock file for the file backend
+
+    :return: (LeaderLock)
+    """
+    if backend == "file" and path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(os.environ["PHSTATE_FILE"])), "ingest.lock")
+    if path is not None:
+        options["path"] = path
+    return lock_backends[backend](**options)
+
+
+class LeaderElector:
+    """
+    Campaigns for a LeaderLock in the background. on_elected runs once the lock is won; if the lock is later
+    lost, on_demoted runs and this process stops campaigning.
+    """
+
+    def __init__(self, lock, on_elected, on_demoted=None, interval=5.0):
+        """
+            lock (LeaderLock)
+            on_elected (func):      called without arguments when this process becomes the leader
+            on_demoted (func):      called without arguments when leadership is lost
+            interval (float):       seconds between election and renewal attempts
+        """
+        self.lock = lock
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.interval = interval
+        self.is_leader = False
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="PHLeaderElectorThread", daemon=True)
+
+    def start(self):
+        """Makes the first election attempt synchronously, then keeps campaigning in the background"""
+        self._campaign()
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=1)
+        if self.is_leader:
+            self.is_leader = False
+            self.lock.release()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            if not self._campaign():
+                return
+
+    def _campaign(self):
+        """:return: (bool) False once leadership was lost"""
+        if not self.is_leader:
+            if self.lock.acquire():
+                phlog.info("Elected ingestion leader (pid: %d)" % os.getpid())
+                self.is_leader = True
+                self.on_elected()
+            return True
+        if self.lock.renew():
+            return True
+        phlog.error("Lost ingestion leadership (pid: %d)" % os.getpid())
+        self.is_leader = False
+        if self.on_demoted is not None:
+            self.on_demoted()
+        return False
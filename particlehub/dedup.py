@@ -0,0 +1,56 @@
+import time
+import threading
+import collections
+
+
+class EventDeduplicator:
+    """
+    Recognises Particle events delivered more than once, e.g. replayed after a reconnect or received by
+    redundant stream consumers. Events are keyed by coreid, event name, published_at and a hash of the payload;
+    keys are remembered for window seconds and at most max_entries are kept, oldest first out.
+    """
+
+    def __init__(self, window=600, max_entries=100000):
+        """
+            window (float):        seconds a delivered event is remembered
+            max_entries (int):     memory bound, about 200 bytes per entry
+        """
+        self.window = window
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._seen = collections.OrderedDict()  # key: time.monotonic() of first delivery
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def event_key(event_name, event_data):
+        return (event_data.get('coreid'), event_name, event_data.get('published_at'),
+                hash(event_data.get('data')))
+
+    def is_duplicate(self, event_name, event_data):
+        """
+        :param event_name: (str) SSE event name
+        :param event_data: (dict) parsed Particle event
+
+        :return: (bool) True if the same event was seen within the window
+        """
+        key = self.event_key(event_name, event_data)
+        now = time.monotonic()
+        with self._lock:
+            expired = now - self.window
+            seen_at = self._seen.get(key)
+            if seen_at is not None and seen_at >= expired:
+                self.hits += 1
+                return True
+            self.misses += 1
+            self._seen.pop(key, None)
+            self._seen[key] = now
+            while self._seen:
+                oldest_key, seen_at = next(iter(self._seen.items()))
+                if seen_at >= expired and len(self._seen) <= self.max_entries:
+                    break
+                del self._seen[oldest_key]
+            return False
+
+    def stats(self):
+        return dict(dedup_hits=self.hits, dedup_misses=self.misses, dedup_entries=len(self._seen))
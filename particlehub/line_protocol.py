@@ -0,0 +1,130 @@
+"""
+InfluxDB line protocol encoding:  measurement,tag1=a,tag2=b value=21.5 1609459200000000000
+
+Escaping and field formatting follow influxdb.line_protocol.make_line so the written series and field types are
+the same as with dict points: tags are sorted by key and tags with an empty value are left out, str fields are
+quoted and floats are written with repr. Unlike make_line, ints are written as floats too, so a measurement keeps
+one field type whether a value happens to be integral or not, and nan and infinite values, which line protocol
+cannot express, are skipped.
+"""
+
+import math
+import time
+
+_key_escapes = str.maketrans({"\\": "\\\\", " ": "\\ ", ",": "\\,", "=": "\\=", "\n": "\\n"})
+_string_escapes = str.maketrans({"\\": "\\\\", "\"": "\\\"", "\n": "\\n"})
+
+
+def escape_key(value):
+    """Escapes a measurement, tag key or tag value"""
+    return str(value).translate(_key_escapes)
+
+
+def format_field(value):
+    """
+    :param value: (str, int, float or bool)
+
+    :return: (str) line protocol field value, None when value is None, nan or infinite
+    """
+    formatter = _field_formatters.get(type(value))
+    if formatter is not None:
+        return formatter(value)
+    if value is None:
+        return None
+    try:
+        return _format_number(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _format_number(value):
+    try:
+        value = float(value)
+    except OverflowError:
+        return None
+    return repr(value) if math.isfinite(value) else None
+
+
+_field_formatters = {
+    float: lambda value: repr(value) if math.isfinite(value) else None,
+    int: _format_number,
+    bool: str,
+    str: lambda value: "\"%s\"" % value.translate(_string_escapes),
+}
+
+
+def series_key(measurement, tags):
+    """
+    :param measurement: (str)
+    :param tags: (dict)
+
+    :return: (str) escaped measurement and sorted tag set
+    """
+    key = escape_key(measurement)
+    for tag in sorted(tags):
+        tag_key, tag_value = escape_key(tag), escape_key("" if tags[tag] is None else tags[tag])
+        if tag_key and tag_value:
+            key += ",%s=%s" % (tag_key, tag_value)
+    return key
+
+
+class LineProtocolEncoder:
+    """
+    Encodes device samples as line protocol. The escaped series key of each (device, measurement) is cached
+    and a device's keys are rebuilt when its tags no longer equal the tags they were built from, so add_tag,
+    remove_tag and polled tag values take effect on the next write. Lookups need no lock: concurrent rebuilds
+    produce equal keys.
+    """
+
+    def __init__(self):
+        self._series = dict()  # device_id: (copy of the tags, {measurement: series key})
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, data, tags, timestamp=None, device_id=None):
+        """
+        :param data: (dict) measurement: value, measurements named like a tag and None values are skipped
+        :param tags: (dict) device tags
+        :param timestamp: (int) epoch nanoseconds, None for now
+        :param device_id: (str) series key cache key, None to build the keys without caching
+
+        :return: (list) line protocol strings
+        """
+        if timestamp is None:  # Stamped here so a spooled point keeps its original time
+            timestamp = time.time_ns()
+        keys = self._series_keys(device_id, tags)
+        suffix = " %d" % timestamp
+        lines = list()
+        for measurement, value in data.items():
+            if measurement in tags:
+                continue
+            field = format_field(value)
+            if field is None:
+                continue
+            key = keys.get(measurement)
+            if key is None:
+                self.misses += 1
+                key = keys[measurement] = series_key(measurement, tags)
+            else:
+                self.hits += 1
+            lines.append(key + " value=" + field + suffix)
+        return lines
+
+    def _series_keys(self, device_id, tags):
+        if device_id is None:
+            return dict()
+        entry = self._series.get(device_id)
+        if entry is None or entry[0] != tags:
+            entry = self._series[device_id] = (dict(tags), dict())
+        return entry[1]
+
+    def invalidate(self, device_id=None):
+        """Drops the cached series keys of one device, or of every device when device_id is None"""
+        if device_id is None:
+            self._series.clear()
+        else:
+            self._series.pop(device_id, None)
+
+    def stats(self):
+        return dict(series_key_hits=self.hits, series_key_misses=self.misses,
+                    series_keys=sum(len(entry[1]) for entry in list(self._series.values())))
@@ -0,0 +1,225 @@
+import logging
+import threading
+import collections
+from particlehub.vitals import DeviceVitals
+
+phlog = logging.getLogger("particle-hub.live")
+
+
+###################################################################################################
+# Live Device Updates
+
+def device_snapshot(device):
+    """JSON friendly view of the live state of a device"""
+    return dict(id=device.id, name=device.name, online=device.online, variable_state=dict(device.variable_state))
+
+
+class LiveClient:
+    """
+    Pending updates for one browser connection. Updates are coalesced per device so a client that falls
+    behind only receives the latest state, and a client with more than max_pending devices waiting is dropped.
+    The snapshot delivered with the first batch does not count against max_pending.
+    """
+
+    def __init__(self, max_pending=1000, snapshot=None):
+        """
+            max_pending (int):    devices with updates waiting before the client is dropped
+            snapshot (dict):      key: payload sent first, whatever the number of devices
+        """
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict(snapshot or ())
+        self._limit = max_pending + len(self.pending)
+        self.condition = threading.Condition()
+        self.dropped = False
+        self.closed = False
+
+    def offer(self, key, payload):
+        with self.condition:
+            if key not in self.pending and len(self.pending) >= self._limit:
+                self.dropped = True
+                self.pending.clear()
+            else:
+                self.pending[key] = payload
+            self.condition.notify()
+
+    def next_batch(self, timeout=None):
+        """
+        Waits for pending updates.
+
+        :param timeout: (float) seconds
+
+        :return: (list) payloads, empty on timeout, or None once the client was dropped or closed
+        """
+        with self.condition:
+            if not self.pending and not self.dropped and not self.closed:
+                self.condition.wait(timeout)
+            if self.dropped or self.closed:
+                return None
+            batch = list(self.pending.values())
+            self.pending.clear()
+            self._limit = self.max_pending
+            return batch
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class DeviceEventBroadcaster:
+    """
+    Fans device state changes out to live clients. Registered as a device listener on the HubManager, so it is
+    called with each Device whose state changed. Every client holds a web server thread for as long as it is
+    connected, so at most max_clients are accepted.
+    """
+
+    def __init__(self, max_pending=1000, max_clients=4):
+        self.max_pending = max_pending
+        self.max_clients = max_clients
+        self.clients = set()
+        self.dropped_clients = 0
+        self.rejected_clients = 0
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, device):
+        self.publish(device)
+
+    def subscribe(self, snapshot_devices=()):
+        """
+        Registers a new client, queueing the last known state of snapshot_devices first
+
+        :param snapshot_devices: (iterable) Device objects
+
+        :return: (LiveClient) or None when max_clients are already connected
+        """
+        if len(self.clients) >= self.max_clients:  # Checked again below, skips building a snapshot for nothing
+            self.rejected_clients += 1
+            return None
+        client = LiveClient(self.max_pending, {device.id: device_snapshot(device) for device in snapshot_devices})
+        with self._lock:
+            if len(self.clients) >= self.max_clients:
+                self.rejected_clients += 1
+                return None
+            self.clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        client.close()
+        with self._lock:
+            self.clients.discard(client)
+
+    def publish(self, device):
+        if not self.clients:
+            return
+        payload = device_snapshot(device)
+        with self._lock:
+            clients = list(self.clients)
+        self.published += 1
+        for client in clients:
+            client.offer(device.id, payload)
+            if client.dropped:
+                phlog.warning("Dropping slow live event client")
+                self.dropped_clients += 1
+                self.unsubscribe(client)
+
+    def stats(self):
+        return dict(clients=len(self.clients), dropped_clients=self.dropped_clients,
+                    rejected_clients=self.rejected_clients, published=self.published)
+
+
+class LiveUpdateRelay:
+    """
+    Shares the live device state, time series samples and device vitals of the ingesting process with the other
+    web workers, whose /events, /timeseries and health columns would otherwise only see their own requests. While
+    publishing, device state changes and vitals (coalesced per device) and samples are queued and flush() commits
+    them as one batch to the state store. The other processes call apply() to feed the batches committed since
+    their last call to their own devices, time series cache, vitals cache and listeners. Needs a state store that
+    shares updates, i.e. the sqlite backend.
+    """
+
+    def __init__(self, state_store, max_samples=50000):
+        """
+            state_store (StateStore):    shared by every process
+            max_samples (int):           samples queued between flushes, later ones are not shared
+        """
+        self.state_store = state_store
+        self.max_samples = max_samples
+        self.publishing = False
+        self.cursor = None
+        self.published = 0
+        self.applied = 0
+        self.dropped_samples = 0
+        self._states = dict()  # device_id: variable_state
+        self._samples = list()  # [device_id, values, timestamp]
+        self._vitals = dict()  # device_id: DeviceVitals
+        self._lock = threading.Lock()
+
+    def device_updated(self, device):
+        """Device listener of the publishing process"""
+        if self.publishing:
+            with self._lock:
+                self._states[device.id] = dict(device.variable_state)
+
+    def sample_recorded(self, device_id, values, timestamp):
+        """TimeSeriesCache.on_record hook of the publishing process"""
+        if not self.publishing:
+            return
+        values = {name: value for name, value in values.items() if isinstance(value, (int, float))}
+        with self._lock:
+            if len(self._samples) >= self.max_samples:
+                self.dropped_samples += 1
+                return
+            self._samples.append([device_id, values, timestamp])
+
+    def vitals_fetched(self, device, vitals):
+        """VitalsCollector.on_vitals hook of the publishing process"""
+        if self.publishing:
+            with self._lock:
+                self._vitals[device.id] = vitals
+
+    def flush(self):
+        """Commits the queued updates as one batch"""
+        with self._lock:
+            states, self._states = self._states, dict()
+            samples, self._samples = self._samples, list()
+            vitals, self._vitals = self._vitals, dict()
+        if not states and not samples and not vitals:
+            return
+        vitals = {device_id: dict(entry.to_dict(), age=entry.age) for device_id, entry in vitals.items()}
+        cursor = self.state_store.publish_updates(dict(states=states, samples=samples, vitals=vitals))
+        if cursor is not None:
+            self.cursor = cursor  # This process does not apply its own batches if it stops publishing
+            self.published += 1
+
+    def apply(self, devices, timeseries, notify, vitals_collector=None):
+        """
+        Applies the batches published by another process since the last call
+
+        :param devices: (dict) device_id: Device, updates of other devices are ignored
+        :param timeseries: (TimeSeriesCache)
+        :param notify: (func) notify(device) for each device whose state changed
+        :param vitals_collector: (VitalsCollector) cache of the relayed vitals, None to ignore them
+        """
+        self.cursor, batches = self.state_store.load_updates(self.cursor)
+        updated = dict()
+        for batch in batches:
+            for device_id, values, timestamp in batch["samples"]:
+                if device_id in devices:
+                    timeseries.record(device_id, values, timestamp)
+            for device_id, state in batch["states"].items():
+                device = devices.get(device_id)
+                if device is not None:
+                    device.variable_state.update(state)
+                    updated[device_id] = device
+            if vitals_collector is not None:
+                for device_id, vitals in batch.get("vitals", dict()).items():
+                    if device_id in devices:
+                        vitals_collector.store(DeviceVitals.from_dict(vitals))
+        self.applied += len(batches)
+        for device in updated.values():
+            notify(device)
+
+    def stats(self):
+        return dict(relay_published=self.published, relay_applied=self.applied,
+                    relay_dropped_samples=self.dropped_samples)
@@ -0,0 +1,144 @@
+import bisect
+import threading
+
+# Instrumented code checks this flag before touching a metric, so disabled metrics cost one attribute lookup
+enabled = False
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+###################################################################################################
+# Metric Types
+
+class Counter:
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = dict()  # label values tuple: count
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+        with self._lock:
+            values = sorted(self.values.items())
+        lines.extend("%s%s %s" % (self.name, _labels(self.labels, key), _number(value)) for key, value in values)
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values = dict()  # label values tuple: [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self.values.items())
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name, _labels(self.labels + ("le",), key + (_number(bound),)),
+                                                 cumulative))
+            lines.append("%s_bucket%s %d" % (self.name, _labels(self.labels + ("le",), key + ("+Inf",)), counts[-1]))
+            lines.append("%s_sum%s %s" % (self.name, _labels(self.labels, key), _number(counts[-2])))
+            lines.append("%s_count%s %d" % (self.name, _labels(self.labels, key), counts[-1]))
+        return lines
+
+
+def render_gauge(name, documentation, samples, labels=()):
+    """
+    Renders a gauge whose value is read at scrape time
+
+    :param samples: (float) single value, or (dict) label values tuple: value
+
+    :return: (list) exposition lines
+    """
+    lines = ["# HELP %s %s" % (name, documentation), "# TYPE %s gauge" % name]
+    if not isinstance(samples, dict):
+        samples = {(): samples}
+    lines.extend("%s%s %s" % (name, _labels(labels, key), _number(value)) for key, value in sorted(samples.items()))
+    return lines
+
+
+def render(gauges=()):
+    """
+    Prometheus text exposition of every registered metric followed by the scrape time gauges
+
+    :param gauges: (iterable) (name, documentation, samples, labels) tuples for render_gauge
+
+    :return: (str)
+    """
+    lines = list()
+    for metric in registry:
+        lines.extend(metric.render())
+    for gauge in gauges:
+        lines.extend(render_gauge(*gauge))
+    return "\n".join(lines) + "\n"
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                          .replace("\n", "\\n")) for name, value in zip(names, values))
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+###################################################################################################
+# Hot Path Metrics
+
+SSE_FRAMES = Counter("particlehub_sse_frames_total", "SSE frames received", ("event",))
+PARSE_SECONDS = Histogram("particlehub_parse_seconds", "Time decoding the Particle event envelope")
+HANDLER_SECONDS = Histogram("particlehub_handler_seconds", "Time handling an event", ("event",))
+EVENT_LAG_SECONDS = Histogram("particlehub_event_lag_seconds", "Delay from published_at until handled",
+                              buckets=LAG_BUCKETS)
+DB_WRITE_BATCH_SIZE = Histogram("particlehub_db_write_batch_points", "Points per database write", buckets=SIZE_BUCKETS)
+DB_WRITE_SECONDS = Histogram("particlehub_db_write_seconds", "Database write latency", ("result",))
+API_REQUEST_SECONDS = Histogram("particlehub_api_request_seconds", "Particle API request latency",
+                                ("method", "status"))
+STREAM_RECONNECTS = Counter("particlehub_stream_reconnects_total", "SSE stream reconnects", ("subscription",))
+DEDUP_EVENTS = Counter("particlehub_dedup_events_total", "Subscribed events checked for redelivery, hit if dropped",
+                       ("result",))
+
+registry = [SSE_FRAMES, PARSE_SECONDS, HANDLER_SECONDS, EVENT_LAG_SECONDS, DB_WRITE_BATCH_SIZE, DB_WRITE_SECONDS,
+            API_REQUEST_SECONDS, STREAM_RECONNECTS, DEDUP_EVENTS]
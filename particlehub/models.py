@@ -1,37 +1,114 @@
-import pickle
 import os
+import time
+import fnmatch
+import atexit
 import logging
+import collections
 import requests
-import sseclient
 import threading
 import simplejson as json
 from string import Template
 from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from particlehub import metrics
+from particlehub.pipeline import EventPipeline, StageTimer
+from particlehub.async_stream import AsyncStreamEngine, SSESubscription
+from particlehub.stream_supervisor import StreamSupervisor
+from particlehub.polling import VariablePoller, PollingService, TokenBucket
+from particlehub.commands import FleetCommander
+from particlehub.vitals import VitalsCollector, DeviceVitals
+from particlehub.parser import DataParser
+from particlehub.line_protocol import LineProtocolEncoder
+from particlehub.dedup import EventDeduplicator
+from particlehub.recording import EventRecorder
+from particlehub.replay import EventReplayer, replay_stream_manager
+from particlehub.spool import PointSpool, SpoolLockedError
+from particlehub.state import open_state_store
+from particlehub.coordination import LeaderElector
+from particlehub.sharding import ShardedIngestion, extract_coreid
+from particlehub.timeseries import TimeSeriesCache, parse_timestamp_ns
+from particlehub.live import LiveUpdateRelay
 
 BASE_PARTICLE_URL = "https://api.particle.io/v1/"
 phlog = logging.getLogger("particle-hub.models")
 
+# Shared keep-alive connection pool for all Particle API calls
+http_session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
 
 ###################################################################################################
 # General API Classes
 
 class ParticleCloud:
 
-    def __init__(self, cloud_api_token):
+    def __init__(self, cloud_api_token, cache_ttl=30, timeout=10.0):
+        """
+            cloud_api_token (str):    Particle API access token
+            cache_ttl (float):        seconds a fetched device list is reused before asking the cloud again
+            timeout (float):          seconds to wait for the device list, so a hung request cannot hold the
+                                      device list lock indefinitely
+        """
         self.cloud_api_token = cloud_api_token
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self._device_list = None
+        self._etag = None
+        self._fetched_at = None
+        self._lock = threading.Lock()
 
     def get_devices(self):
-        url = BASE_PARTICLE_URL + "devices"
-        request = requests.get(url, params=dict(access_token=self.cloud_api_token))
-        if request.status_code == requests.codes.ok:
-            devices = dict()
-            device_list = request.json()
-            for device_dict in device_list:
-                device = Device.from_dict(device_dict, self.cloud_api_token)
-                devices[device.id] = device
-            return devices
-        else:
+        devices = dict()
+        device_list, _ = self.get_device_list(max_age=0)
+        for device_dict in device_list:
+            device = Device.from_dict(device_dict, self.cloud_api_token)
+            devices[device.id] = device
+        return devices
+
+    def get_device_list(self, max_age=None):
+        """
+        Returns the raw /v1/devices list. A cached copy younger than max_age is returned without a request, and
+        otherwise the request is conditional on the last ETag.
+
+        :param max_age: (float) seconds, defaults to cache_ttl
+
+        :return: (tuple) (list of device dicts, True if the list changed since the previous call)
+
+        :raises: CloudCommunicationError when the cloud cannot be reached, times out or answers with an error
+        """
+        if max_age is None:
+            max_age = self.cache_ttl
+        with self._lock:
+            now = time.monotonic()
+            if self._device_list is not None and max_age > 0 and now - self._fetched_at < max_age:
+                return self._device_list, False
+            url = Device.API_DEVICES_URL
+            headers = {"If-None-Match": self._etag} if self._etag and self._device_list is not None else None
+            start = time.monotonic()
+            try:
+                request = http_session.get(url, params=dict(access_token=self.cloud_api_token), headers=headers,
+                                           timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                _observe_api_request("GET", start, "error")
+                phlog.error("Cloud Communication error in get_devices: %s" % type(e).__name__)
+                phlog.debug(e)
+                raise CloudCommunicationError(type(e).__name__)
+            _observe_api_request("GET", start, request.status_code)
+            if request.status_code == requests.codes.not_modified:
+                self._fetched_at = now
+                return self._device_list, False
+            if request.status_code == requests.codes.ok:
+                try:
+                    device_list = request.json()
+                except ValueError as e:
+                    phlog.error("Cloud Communication error in get_devices: invalid device list")
+                    phlog.debug(e)
+                    raise CloudCommunicationError("Invalid device list")
+                changed = device_list != self._device_list
+                self._device_list = device_list
+                self._etag = request.headers.get("ETag")
+                self._fetched_at = now
+                return device_list, changed
             if phlog:
                 phlog.error("Cloud Communication error in get_devices")
                 phlog.debug(request)
@@ -41,62 +118,473 @@ class ParticleCloud:
 class HubManager:
 
     def __init__(self, cloud_api, stream_config, event_callbacks, log_dest, log_credentials, devices=None,
-                 managed_devices=None):
+                 managed_devices=None, poll_config=None, schedule_config=None, state_store=None,
+                 device_listeners=None, timeseries_config=None, leader_lock=None, state_sync_interval=1.0,
+                 lazy=False, command_config=None, vitals_config=None):
+        """
+            command_config (dict):          FleetCommander options for call_function, it shares the poller's
+                                            rate limit unless given its own rate
+            vitals_config (dict):           VitalsCollector options, None to disable device vitals. Vitals are
+                                            collected while ingesting, sharing the poller's rate limit unless
+                                            given their own rate, and relayed to the other workers.
+            leader_lock (LeaderLock):       when given, stream ingestion and polling run only while this process
+                                            holds the lock, so several web workers can share one ingestion. The
+                                            leader relays live device state and time series samples to the
+                                            other workers through the state store.
+            state_sync_interval (float):    seconds between checks for state changes made by other processes
+            lazy (bool):                    return without waiting for the cloud. The last known device list is
+                                            served from the state store while a background thread fetches the
+                                            device list and then starts ingestion; ready is set once it is done.
+        """
         self.event_callbacks = event_callbacks
+        self.log_dest = log_dest
+        self.log_credentials = log_credentials
+        self.timeseries = TimeSeriesCache(**(timeseries_config or dict()))
+        self.device_listeners = device_listeners if device_listeners is not None else list()
+        self.state_store = state_store
+        if state_store is None:
+            self.state_store = open_state_store(os.environ['PHSTATE_FILE'],
+                                                os.environ.get('PHSTATE_BACKEND', 'sqlite'))
         self.cloud = cloud_api
+        self.poller = VariablePoller(**(poll_config or dict()))
+        command_config = dict(command_config or dict())
+        if "rate" not in command_config:
+            command_config["rate_limiter"] = self.poller.rate_limiter
+        self.commander = FleetCommander(**command_config)
+        self.vitals = None
+        if vitals_config is not None:
+            vitals_config = dict(vitals_config)
+            if "rate" not in vitals_config:
+                vitals_config["rate_limiter"] = self.poller.rate_limiter
+            self.vitals = VitalsCollector(on_vitals=self._vitals_fetched, **vitals_config)
+        self.replayer = None
+        self._replay_lock = threading.Lock()
         self.devices = devices
+        self.device_source = None  # "cloud" once the device list was fetched, "snapshot" for the last known list
+        self._refresh_thread = None
+        self._refresh_lock = threading.Lock()
         self.managed_devices = managed_devices
         if managed_devices is None:
             self.managed_devices = dict()
-        self.update_device_list()
+        if not lazy:
+            self.update_device_list()
+        if self.devices is None:
+            self._load_device_snapshot()
         self.load_state()
+        self.live_relay = None
+        if leader_lock is not None:
+            self.live_relay = LiveUpdateRelay(self.state_store)
+            self.device_listeners.append(self.live_relay.device_updated)
+            self.timeseries.on_record = self.live_relay.sample_recorded
         self.stream_manager = StreamManager(stream_config, event_callbacks, log_dest, log_credentials,
-                                            managed_devices=self.managed_devices)
+                                            managed_devices=self.managed_devices,
+                                            device_listeners=self.device_listeners,
+                                            timeseries=self.timeseries, on_stream_gap=self.backfill_stream_gap)
+        self.polling_service = None
+        if schedule_config is not None:
+            self.polling_service = PollingService(self, **schedule_config)
+        self.ingesting = False
+        self.leader_elector = None
+        self.ready = False
+        self._state_version = self.state_store.version()
+        self._state_sync_stop = threading.Event()
+        self._ready_event = threading.Event()
+        self._state_sync_thread = None
+        self._warm_up_thread = None
+        if lazy:
+            self._warm_up_thread = threading.Thread(target=self._warm_up, args=(leader_lock, state_sync_interval),
+                                                    name="PHWarmUpThread", daemon=True)
+            self._warm_up_thread.start()
+        else:
+            self._start(leader_lock, state_sync_interval)
+
+    def _start(self, leader_lock, state_sync_interval):
+        if leader_lock is None:
+            self.start_ingestion()
+        else:
+            self._state_sync_thread = threading.Thread(target=self._run_state_sync, args=(state_sync_interval,),
+                                                       name="PHStateSyncThread", daemon=True)
+            self._state_sync_thread.start()
+            self.leader_elector = LeaderElector(leader_lock, self.start_ingestion, self.stop_ingestion)
+            self.leader_elector.start()
+        self.ready = True
+
+    def _warm_up(self, leader_lock, state_sync_interval, retry_max=60.0):
+        """
+        Background startup of a lazy hub: fetches the device list, applies the saved state and starts. The hub
+        starts with the last known device list when the cloud cannot be reached, and the device list is fetched
+        again with exponential backoff, up to retry_max seconds apart, until the cloud answers.
+        """
+        try:
+            self._fetch_device_list()
+        finally:
+            self._start(leader_lock, state_sync_interval)
+            self._ready_event.set()
+        delay = 1.0
+        while self.device_source != "cloud" and not self._state_sync_stop.wait(delay):
+            self._fetch_device_list()
+            delay = min(retry_max, delay * 2)
+
+    def _fetch_device_list(self):
+        try:
+            self.update_device_list()
+        except Exception as e:
+            phlog.error("Device list fetch failed")
+            phlog.debug(e)
+            return
+        if self.device_source == "cloud":
+            self.load_state()  # Devices added since the snapshot may be managed or tagged
+            self.stream_manager.set_managed_devices(self.managed_devices)
+            if self.ingesting and self.polling_service is not None:
+                self.polling_service.sync()
+
+    def wait_until_ready(self, timeout=None):
+        """:return: (bool) ready"""
+        if self._warm_up_thread is not None:
+            self._ready_event.wait(timeout)
+        return self.ready
+
+    def health(self):
+        """
+        State of each component, for readiness and liveness checks
+
+        :return: (dict) ready (bool), devices ("cloud", "snapshot" or "unavailable"), device_count, managed_count,
+                 ingestion ("starting", "running" or "standby" while another process leads), stream_connected,
+                 stream_alive (False if ingesting without a running stream reader)
+        """
+        if self.ingesting:
+            ingestion = "running"
+        else:
+            ingestion = "standby" if self.ready else "starting"
+        subscriptions = self.stream_manager.stats().get("subscriptions", dict()).values()
+        supervisor = self.stream_manager.stream_supervisor
+        return dict(ready=self.ready, devices=self.device_source or "unavailable",
+                    device_count=len(self.devices or dict()), managed_count=len(self.managed_devices),
+                    ingestion=ingestion,
+                    stream_connected=any(subscription["connected"] for subscription in subscriptions),
+                    stream_alive=not self.ingesting or supervisor is None or supervisor.running)
+
+    def start_ingestion(self):
+        """Starts the event stream and background polling"""
+        self.ingesting = True
+        if self.live_relay is not None:
+            self.live_relay.publishing = True
         self.stream_manager.start_stream()
+        if self.polling_service is not None:
+            self.polling_service.start()
+        if self.vitals is not None:
+            self.vitals.start(lambda: list(self.managed_devices.values()))
+
+    def stop_ingestion(self):
+        self.ingesting = False
+        if self.live_relay is not None:
+            self.live_relay.publishing = False
+            self.live_relay.flush()
+        self.stream_manager.stop_stream()
+        if self.polling_service is not None:
+            self.polling_service.stop()
+        if self.vitals is not None:
+            self.vitals.stop()
+
+    def sync_state(self):
+        """
+        Applies managed device and tag changes committed to the state store by other processes
+
+        :return: (bool) True if the state changed
+        """
+        version = self.state_store.version()
+        if version is None or version == self._state_version:
+            return False
+        self._state_version = version
+        state_data = self._load_state() or dict(managed_device_ids=list(), tags=dict())
+        managed_device_ids = set(state_data['managed_device_ids'])
+        devices = self.devices or dict()
+        for device_id, tags in state_data['tags'].items():
+            if device_id in devices:
+                devices[device_id].tags = tags
+        for device in devices.values():
+            device.is_managed = device.id in managed_device_ids
+        managed_devices = {device_id: device for device_id, device in devices.items()
+                           if device_id in managed_device_ids}
+        if managed_devices.keys() != self.managed_devices.keys():
+            self.managed_devices = managed_devices
+            self.timeseries.retain(managed_devices)
+            if self.polling_service is not None:
+                self.polling_service.sync()
+        self.stream_manager.set_managed_devices(self.managed_devices)  # Tags may have changed too
+        return True
+
+    def _run_state_sync(self, interval):
+        while not self._state_sync_stop.wait(interval):
+            try:
+                self.sync_state()
+                self.sync_live_updates()
+            except Exception as e:
+                phlog.error("State sync failed")
+                phlog.debug(e)
+
+    def sync_live_updates(self):
+        """Publishes the live updates of the ingesting process, or applies them in the others"""
+        if self.live_relay is None:
+            return
+        if self.ingesting:
+            self.live_relay.flush()
+        else:
+            self.live_relay.apply(self.managed_devices, self.timeseries, self._notify_device_listeners, self.vitals)
 
-    def update_device_list(self):
-        # This needs to be more sophistocated to not overwrite existing device objects that may be modified.
-        # Need to add devices that dont exist, and update meta data for existing objects
+    def update_device_list(self, force=False):
+        """
+        Reconciles the device list with the cloud. Existing Device objects are updated in place, new devices are
+        added and devices missing from the cloud are marked removed (and dropped unless managed), so references
+        held by the managed set and the stream manager stay valid.
+
+        :param force: (bool) bypass the device list cache
+
+        :return: (None)
+        """
         try:
-            new_devices = self.cloud.get_devices()
-            if self.devices is not None:
-                for device_id in self.devices:
-                    if device_id in new_devices:
-                        new_devices[device_id].tags = self.devices[device_id].tags
-                        new_devices[device_id].is_managed = self.devices[device_id].is_managed
-            self.devices = new_devices
+            device_list, changed = self.cloud.get_device_list(max_age=0 if force else None)
         except CloudCommunicationError:
-            self.devices = None
+            return
+        self.device_source = "cloud"
+        if self.devices is None:
+            self.devices = dict()
+        elif not changed:
+            return
+        if changed:
+            self.state_store.save_device_snapshot(device_list)
+        seen = set()
+        for device_dict in device_list:
+            device_id = device_dict["id"]
+            seen.add(device_id)
+            if device_id in self.devices:
+                self.devices[device_id].update_from_dict(device_dict)
+            else:
+                self.devices[device_id] = Device.from_dict(device_dict, self.cloud.cloud_api_token)
+        for device_id in [device_id for device_id in self.devices if device_id not in seen]:
+            device = self.devices[device_id]
+            device.removed = True
+            if not device.is_managed:
+                del self.devices[device_id]
+
+    def _load_device_snapshot(self):
+        """Serves the device list saved by the last successful fetch until the cloud can be reached"""
+        device_list = self.state_store.load_device_snapshot()
+        if device_list is None:
+            return
+        self.devices = {device_dict["id"]: Device.from_dict(device_dict, self.cloud.cloud_api_token)
+                        for device_dict in device_list}
+        self.device_source = "snapshot"
+
+    def refresh_device_list_async(self):
+        """
+        Reconciles the device list on a background thread unless a refresh is already running
+
+        :return: (bool) True if a refresh was started
+        """
+        with self._refresh_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return False
+            self._refresh_thread = threading.Thread(target=self.update_device_list, name="PHDeviceListThread",
+                                                    daemon=True)
+            self._refresh_thread.start()
+            return True
 
     def update_device_data(self, device_id):
         """
             Enables manual device update from UI
         """
         device = self.devices[device_id]
-        device.get_all_variable_data()
+        device.get_all_variable_data(poller=self.poller)
         for callback in self.event_callbacks:
             callback(device.variable_state)
+        self._notify_device_listeners(device)
+
+    def update_all_device_data(self, device_ids=None):
+        """
+        Concurrently refreshes variable data for many devices
+
+        :param device_ids: (list) defaults to the managed devices
+
+        :return: (dict) device_id: PollResult
+        """
+        if device_ids is None:
+            device_ids = list(self.managed_devices.keys())
+        devices = [self.devices[device_id] for device_id in device_ids]
+        results = self.poller.poll(devices)
+        for device in devices:
+            for callback in self.event_callbacks:
+                callback(device.variable_state)
+            self._notify_device_listeners(device)
+        return results
+
+    def backfill_stream_gap(self, started, ended):
+        """
+        Polls, in the background, the managed devices whose variables were not updated since an event stream
+        outage began, and publishes the values like scheduled polls so the outage leaves a short gap in the logs
+
+        :param started: (float) time.monotonic() of the last event before the outage
+        :param ended: (float) time.monotonic() of the reconnect
+
+        :return: (threading.Thread) or None when no device missed updates
+        """
+        devices = [device for device in list(self.managed_devices.values())
+                   if device.online is not False and device.variables
+                   and max(device.variable_updated.values(), default=0) < started]
+        if not devices:
+            return None
+        phlog.info("Backfilling %d devices after a %.0f second stream outage" % (len(devices), ended - started))
+        thread = threading.Thread(target=self._backfill, args=(devices,), name="PHBackfillThread", daemon=True)
+        thread.start()
+        return thread
+
+    def _backfill(self, devices):
+        results = self.poller.poll(devices)
+        for device in devices:
+            if results[device.id].values:
+                self.publish_device_data(device, results[device.id].values)
+
+    def publish_device_data(self, device, values):
+        """
+        Sends polled variable values to the event callbacks and the log database
+
+        :param device: (Device)
+        :param values: (dict) variable name: value
+
+        :return: (None)
+        """
+        for callback in self.event_callbacks:
+            callback(device.variable_state)
+        self._notify_device_listeners(device)
+        now = time.time_ns()
+        self.timeseries.record(device.id, values, now)
+        if self.stream_manager.db_logging:
+            device_data = dict(values)
+            device_data['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(now / 1e9))
+            self.stream_manager.log_function(device_data, self.stream_manager.log_credentials, device.tags,
+                                             timestamp=now, device_id=device.id)
+
+    def _vitals_fetched(self, device, vitals):
+        self._log_vitals(device, vitals)
+        if self.live_relay is not None:
+            self.live_relay.vitals_fetched(device, vitals)
+
+    def _log_vitals(self, device, vitals):
+        """Writes the numeric vitals of a device to the log database, timed by the device's diagnostics report"""
+        if not self.stream_manager.db_logging or not vitals.metrics:
+            return
+        data = {"vitals_" + name: value for name, value in vitals.metrics.items()}
+        timestamp = parse_timestamp_ns(vitals.updated_at) if vitals.updated_at else None
+        self.stream_manager.log_function(data, self.stream_manager.log_credentials, device.tags,
+                                         timestamp=timestamp, device_id=device.id)
+
+    def device_vitals(self, device_id):
+        """
+        Cached vitals of a device, refreshed in the background when older than the vitals ttl. Processes that
+        are not ingesting serve the vitals relayed by the ingesting one and never call the cloud.
+
+        :param device_id: (str)
+
+        :return: (DeviceVitals) or None if vitals are disabled, the device is unknown or not fetched yet
+        """
+        device = (self.devices or dict()).get(device_id)
+        if self.vitals is None or device is None:
+            return None
+        if self.live_relay is not None and not self.ingesting:
+            return self.vitals.peek(device_id)
+        return self.vitals.get(device)
+
+    def vitals_summary(self, device_id):
+        """:return: (dict) health summary from the vitals cache without calling the cloud, or None"""
+        vitals = self.vitals.peek(device_id) if self.vitals is not None else None
+        return vitals.summary() if vitals is not None else None
+
+    def query_timeseries(self, device_id, variable, start=None, end=None, bucket=None):
+        """
+        Reads recent samples of a device variable from the time series cache, completing ranges older than the
+        cache from the log database when it supports queries.
+
+        :param device_id: (str)
+        :param variable: (str)
+        :param start: (int) epoch nanoseconds, inclusive
+        :param end: (int) epoch nanoseconds, exclusive
+        :param bucket: (int) downsampling bucket width in nanoseconds, None for raw samples
+
+        :return: (tuple) (list of points, source)
+        """
+        fallback = None
+        query_function = log_query_functions.get(self.log_dest)
+        if query_function is not None:
+            tags = dict(self.devices[device_id].tags) if device_id in self.devices else dict()
+
+            def fallback(_variable, _start, _end, _bucket):
+                return query_function(_variable, _start, _end, _bucket, self.log_credentials, tags)
+        return self.timeseries.query(device_id, variable, start, end, bucket, fallback)
+
+    def metric_gauges(self):
+        """
+        Values read when metrics are scraped
+
+        :return: (list) (name, documentation, samples, labels) tuples, see metrics.render_gauge
+        """
+        stream_stats = self.stream_manager.stats()
+        last_event_at = self.stream_manager.last_event_at
+        gauges = [
+            ("particlehub_devices", "Devices listed by the cloud", len(self.devices or dict()), ()),
+            ("particlehub_managed_devices", "Managed devices", len(self.managed_devices), ()),
+            ("particlehub_ingesting", "1 if this process runs stream ingestion", int(self.ingesting), ()),
+            ("particlehub_last_event_age_seconds", "Seconds since the last SSE frame, -1 before the first",
+             time.monotonic() - last_event_at if last_event_at is not None else -1, ()),
+            ("particlehub_handler_queue_depth", "Events waiting for a handler worker",
+             stream_stats.get("queue_depth", 0), ()),
+            ("particlehub_timeseries_samples", "Samples held by the time series cache",
+             self.timeseries.stats()["samples"], ()),
+        ]
+        writers = influx_writer_stats()
+        gauges.append(("particlehub_db_write_queue_depth", "Points waiting to be written",
+                       {(name,): stats["queue_depth"] for name, stats in writers.items()}, ("writer",)))
+        gauges.append(("particlehub_db_spool_pending_bytes", "Spooled bytes waiting to be replayed",
+                       {(name,): stats["spool"]["pending_bytes"]
+                        for name, stats in writers.items() if "spool" in stats}, ("writer",)))
+        if "subscriptions" in stream_stats:
+            gauges.append(("particlehub_stream_connected", "1 while the SSE subscription is connected",
+                           {(name,): int(stats["connected"]) for name, stats in stream_stats["subscriptions"].items()},
+                           ("subscription",)))
+        if self.polling_service is not None:
+            gauges.append(("particlehub_polling_backed_off_devices", "Offline devices polled with backoff",
+                           self.polling_service.stats()["backed_off"], ()))
+        return gauges
+
+    def _notify_device_listeners(self, device):
+        for listener in self.device_listeners:
+            listener(device)
 
     def add_device(self, device_id):
         device = self.devices[device_id]
         device.is_managed = True
         self.managed_devices[device_id] = device
-        self.stream_manager.managed_devices = self.managed_devices
-        self.save_state()
+        self.stream_manager.set_managed_devices(self.managed_devices)
+        self.state_store.set_managed([device_id], True)
+        if self.polling_service is not None:
+            self.polling_service.sync()
 
     def remove_device(self, device_id):
         device = self.devices[device_id]
         device.is_managed = False
         del self.managed_devices[device_id]
-        self.stream_manager.managed_devices = self.managed_devices
-        self.save_state()
+        self.stream_manager.set_managed_devices(self.managed_devices)
+        self.timeseries.clear(device_id)
+        self.state_store.set_managed([device_id], False)
+        if self.polling_service is not None:
+            self.polling_service.sync()
 
     def add_tag(self, device_id, tag):
         device = self.devices[device_id]
         try:
             if device.online:
                 device.tags[tag] = device.get_variable_data(tag)
-                self.save_state()
+                self.state_store.set_tags(device_id, device.tags)
+                self.stream_manager.set_managed_devices(self.managed_devices)
                 return True
         except (KeyError, AttributeError):
             return False
@@ -105,11 +593,209 @@ class HubManager:
         try:
             device = self.devices[device_id]
             device.tags.pop(tag)
-            self.save_state()
+            self.state_store.set_tags(device_id, device.tags)
+            self.stream_manager.set_managed_devices(self.managed_devices)
             return True
         except (KeyError, AttributeError):
             return False
 
+    def select_devices(self, device_ids=None, name=None, tag=None, managed=None):
+        """
+        Selects devices for bulk operations. All given criteria must match.
+
+        :param device_ids: (list) explicit device ids, unknown ids are kept so they are reported as failures
+        :param name: (str) case insensitive glob matched against the device name, e.g. "greenhouse-*"
+        :param tag: (str) tag the device must have
+        :param managed: (bool) managed state the device must have
+
+        :return: (list) device ids
+        """
+        devices = self.devices or dict()
+        if device_ids is not None:
+            candidates = list(dict.fromkeys(device_ids))
+        else:
+            candidates = list(devices.keys())
+        selected = list()
+        for device_id in candidates:
+            device = devices.get(device_id)
+            if device is None:
+                if name is None and tag is None and managed is None:
+                    selected.append(device_id)
+                continue
+            if name is not None and not fnmatch.fnmatch((device.name or "").lower(), name.lower()):
+                continue
+            if tag is not None and tag not in device.tags:
+                continue
+            if managed is not None and device.is_managed != managed:
+                continue
+            selected.append(device_id)
+        return selected
+
+    def add_devices(self, device_ids):
+        """
+        Starts managing many devices with one state commit and one managed set swap
+
+        :param device_ids: (list)
+
+        :return: (dict) device_id: result dict
+        """
+        return self._set_managed(device_ids, True)
+
+    def remove_devices(self, device_ids):
+        """
+        Stops managing many devices with one state commit and one managed set swap
+
+        :param device_ids: (list)
+
+        :return: (dict) device_id: result dict
+        """
+        return self._set_managed(device_ids, False)
+
+    def _set_managed(self, device_ids, managed):
+        results = dict()
+        managed_devices = dict(self.managed_devices)
+        changed = list()
+        for device_id in device_ids:
+            device = (self.devices or dict()).get(device_id)
+            if device is None:
+                results[device_id] = dict(status="fail", error="unknown device")
+                continue
+            if managed:
+                managed_devices[device_id] = device
+            else:
+                managed_devices.pop(device_id, None)
+            changed.append(device)
+            results[device_id] = dict(status="success")
+        with self.state_store.batch():
+            self.state_store.set_managed([device.id for device in changed], managed)
+        for device in changed:
+            device.is_managed = managed
+        self.managed_devices = managed_devices
+        self.stream_manager.set_managed_devices(managed_devices)
+        self.timeseries.retain(managed_devices)
+        if self.polling_service is not None:
+            self.polling_service.sync()
+        return results
+
+    def call_function(self, device_ids, function, argument=""):
+        """
+        Calls a Particle function on many devices concurrently
+
+        :param device_ids: (list) e.g. from select_devices
+        :param function: (str)
+        :param argument: (str)
+
+        :return: (dict) function, argument, succeeded, failed, elapsed and results (device_id: result dict with
+                 status, return_value, attempts, elapsed and error)
+        """
+        start = time.monotonic()
+        devices = self.devices or dict()
+        results = {device_id: dict(status="fail", error="unknown device")
+                   for device_id in device_ids if device_id not in devices}
+        known = [devices[device_id] for device_id in device_ids if device_id in devices]
+        for device_id, result in self.commander.call(known, function, argument).items():
+            results[device_id] = result.to_dict()
+        succeeded = sum(1 for result in results.values() if result["status"] == "success")
+        phlog.info("Called %s on %d devices (%d failed)" % (function, len(results), len(results) - succeeded))
+        return dict(function=function, argument=argument, succeeded=succeeded, failed=len(results) - succeeded,
+                    elapsed=time.monotonic() - start, results=results)
+
+    def replay_events(self, paths, time_offset=0, rebase_to=None, dry_run=False, add_devices=False):
+        """
+        Replays recorded or exported event files to the log database in the background, see
+        particlehub.replay.EventReplayer. Replayed events do not change the live device state.
+
+        :param paths: (list) event files and directories
+        :param time_offset: (int) nanoseconds added to every published_at
+        :param rebase_to: (int) epoch nanoseconds the first event is moved to
+        :param dry_run: (bool) count the events without handling them
+        :param add_devices: (bool) also replay devices that are not managed
+
+        :return: (dict) replay stats, None if a replay is already running
+        """
+        with self._replay_lock:
+            if self.replayer is not None and self.replayer.stats()["running"]:
+                return None
+            device_tags = {device_id: device.tags for device_id, device in self.managed_devices.items()}
+            stream_manager = replay_stream_manager(self.stream_manager.stream_config, self.log_dest,
+                                                   self.log_credentials, device_tags)
+            self.replayer = EventReplayer(stream_manager, time_offset=time_offset, rebase_to=rebase_to,
+                                          dry_run=dry_run, add_devices=add_devices)
+            self.replayer.started = time.monotonic()
+            threading.Thread(target=self._replay, args=(self.replayer, paths), name="PHReplayThread",
+                             daemon=True).start()
+            return self.replayer.stats()
+
+    def _replay(self, replayer, paths):
+        try:
+            stats = replayer.run(paths)
+            phlog.info("Replayed %d of %d events in %.1f s" % (stats["replayed"], stats["events"], stats["elapsed"]))
+        except Exception as e:
+            replayer.finished = time.monotonic()
+            phlog.error("Event replay failed")
+            phlog.debug(e)
+
+    def replay_status(self):
+        """:return: (dict) stats of the running or last replay, None if there was none"""
+        return self.replayer.stats() if self.replayer is not None else None
+
+    def add_tags(self, device_ids, tag):
+        """
+        Tags many devices with a variable, fetching its current value from every online device concurrently
+
+        :param device_ids: (list)
+        :param tag: (str) variable name
+
+        :return: (dict) device_id: result dict
+        """
+        results = dict()
+        to_fetch = list()
+        for device_id in device_ids:
+            device = (self.devices or dict()).get(device_id)
+            if device is None:
+                results[device_id] = dict(status="fail", error="unknown device")
+            elif not device.online:
+                results[device_id] = dict(status="fail", error="offline")
+            else:
+                to_fetch.append(device)
+        poll_results = self.poller.poll(to_fetch, [tag])
+        with self.state_store.batch():
+            for device in to_fetch:
+                poll_result = poll_results[device.id]
+                if tag in poll_result.values:
+                    device.tags[tag] = poll_result.values[tag]
+                    self.state_store.set_tags(device.id, device.tags)
+                    results[device.id] = dict(status="success", value=device.tags[tag])
+                else:
+                    results[device.id] = dict(status="fail", error=poll_result.errors.get(tag))
+        self.stream_manager.set_managed_devices(self.managed_devices)
+        return results
+
+    def remove_tags(self, device_ids, tag):
+        """
+        Removes a tag from many devices with one state commit
+
+        :param device_ids: (list)
+        :param tag: (str)
+
+        :return: (dict) device_id: result dict
+        """
+        results = dict()
+        with self.state_store.batch():
+            for device_id in device_ids:
+                device = (self.devices or dict()).get(device_id)
+                if device is None:
+                    results[device_id] = dict(status="fail", error="unknown device")
+                    continue
+                if tag not in device.tags:
+                    results[device_id] = dict(status="fail", error="not tagged")
+                    continue
+                device.tags.pop(tag)
+                self.state_store.set_tags(device_id, device.tags)
+                results[device_id] = dict(status="success")
+        self.stream_manager.set_managed_devices(self.managed_devices)
+        return results
+
     def save_state(self):
         """
         Gathers data requiring persistence and passes to internal state_save method
@@ -121,8 +807,7 @@ class HubManager:
                               tags={device_id: device.tags for device_id, device in self.devices.items()})
             self._save_state(state_data)
 
-    @staticmethod
-    def _save_state(data):
+    def _save_state(self, data):
         """
         Executes the specific persistence method with aggregated data
 
@@ -130,9 +815,7 @@ class HubManager:
 
         :return: (None)
         """
-        state_filename = os.environ['PHSTATE_FILE']
-        with open(state_filename, 'wb') as state_file:
-            pickle.dump(data, state_file)
+        self.state_store.save(data)
 
     def load_state(self):
         """
@@ -142,41 +825,51 @@ class HubManager:
         """
         state_data = self._load_state()
         if state_data is not None:
-            self.managed_devices = {device_id: device for device_id, device in self.devices.items() if device_id in state_data['managed_device_ids']}
+            managed_device_ids = set(state_data['managed_device_ids'])
+            devices = self.devices or dict()
+            self.managed_devices.clear()
+            self.managed_devices.update({device_id: device for device_id, device in devices.items()
+                                         if device_id in managed_device_ids})
             for device_id, device in self.managed_devices.items():
                 device.is_managed = True
             for device_id, tags in state_data['tags'].items():
-                self.devices[device_id].tags = tags
+                if device_id in devices:
+                    devices[device_id].tags = tags
 
-    @staticmethod
-    def _load_state():
+    def _load_state(self):
         """
         Executes the specific persistence retrieval method.
 
         :return: (dict)
         """
-        state_filename = os.environ['PHSTATE_FILE']
-        if os.path.exists(state_filename):
-            with open(state_filename, 'rb') as state_file:
-                return pickle.load(state_file)
-        else:
-            return None
+        return self.state_store.load()
 
 
 class StreamManager(object):
 
     def __init__(self, stream_config, callbacks, log_dest=None, log_credentials=None, managed_devices=None,
-                 subscribed_events=None):
+                 subscribed_events=None, device_listeners=None, timeseries=None, on_stream_gap=None):
         """
-            stream_config (dict):      url, headers
+            stream_config (dict):      url, headers, handler_workers (0 handles events on the stream thread or,
+                                       with the asyncio engine, on its event loop), max_queue_size, backpressure,
+                                       engine ("thread" or "asyncio"), subscriptions (list of url, name, headers),
+                                       idle_timeout, backoff_max, backfill_min_gap (thread engine reconnects),
+                                       dedup (EventDeduplicator options, None to handle duplicates),
+                                       record (EventRecorder options to record the raw stream, None by default)
             log_dest (str):            string defining the log database to use
             log_credentials (dict):    DB credentials
             callbacks (list):          [func1, func2]
             managed_devices (dict):    List of device objects to log [id1:device1, id2:device2]
             subscribed_events (list):  List of Particle Publish event names to respond to 
+            device_listeners (list):   [func(device)] called after a device's state was updated by an event
+            timeseries (TimeSeriesCache): recent samples of every DATA event
+            on_stream_gap (func):      on_stream_gap(started, ended) after the thread engine's stream recovered
+                                       from an outage, with time.monotonic() bounds
         """
+        self.timeseries = timeseries
         self.stream_config = stream_config
         self.callbacks = callbacks
+        self.device_listeners = device_listeners if device_listeners is not None else list()
         self.managed_devices = managed_devices
         self.log_credentials = log_credentials
         self.event_handlers = dict(LOG=self._handle_log, ERROR=self._handle_error, DATA=self._handle_data)
@@ -189,44 +882,212 @@ class StreamManager(object):
             self.log_function = None
             self.db_logging = False
 
-        self.stream_thread = threading.Thread(target=self._start_stream, name="PHStreamThread")
+        self.parser = DataParser()
+        self.parse_time = StageTimer()
+        self.deduplicator = None
+        dedup_config = stream_config.get("dedup", dict())
+        if dedup_config is not None:
+            self.deduplicator = EventDeduplicator(**dedup_config)
+        self.recorder = None
+        record_config = stream_config.get("record")
+        if record_config is not None:
+            self.recorder = EventRecorder(**record_config)
+        self.last_event_at = None
+        self.sharded = None
+        shards = stream_config.get("shards", 0)
+        if shards:  # Handlers run in the shard processes
+            self.sharded = ShardedIngestion(shards, stream_config, log_dest,
+                                            [_shard_log_credentials(log_credentials, shard) for shard in range(shards)],
+                                            self._apply_shard_samples,
+                                            batch_size=stream_config.get("shard_batch_size", 500))
+        self.pipeline = None
+        handler_workers = stream_config.get("handler_workers", 4) if not shards else 0
+        if handler_workers:
+            self.pipeline = EventPipeline(self._dispatch_event, workers=handler_workers,
+                                          max_queue_size=stream_config.get("max_queue_size", 10000),
+                                          backpressure=stream_config.get("backpressure", "block"))
+
+        self.async_engine = None
+        if stream_config.get("engine") == "asyncio":
+            subscriptions = stream_config.get("subscriptions", [dict(url=stream_config["url"])])
+            self.async_engine = AsyncStreamEngine([SSESubscription(on_event=self._ingest_msg, **subscription)
+                                                   for subscription in subscriptions])
+
+        self.stream_supervisor = None
+        if self.async_engine is None:
+            self.stream_supervisor = StreamSupervisor(stream_config["url"], self._ingest_msg, on_gap=on_stream_gap,
+                                                      headers=stream_config.get("headers"),
+                                                      idle_timeout=stream_config.get("idle_timeout", 90.0),
+                                                      backoff_max=stream_config.get("backoff_max", 60.0),
+                                                      min_gap=stream_config.get("backfill_min_gap", 5.0))
 
     def start_stream(self):
-        self.stream_thread.start()
+        if self.sharded is not None:
+            self.sharded.start()
+            self.sharded.assign(self.managed_devices)
+        if self.pipeline is not None:
+            self.pipeline.start()
+        if self.async_engine is not None:
+            self.async_engine.start()
+        else:
+            self.stream_supervisor.start()
 
     def stop_stream(self):
-        self.stream_thread.join(timeout=1)
+        if self.async_engine is not None:
+            self.async_engine.stop(timeout=1)
+        else:
+            self.stream_supervisor.stop(timeout=1)
+        if self.pipeline is not None:
+            self.pipeline.close(timeout=1)
+        if self.sharded is not None:
+            self.sharded.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def set_managed_devices(self, managed_devices):
+        """Replaces the managed devices, rebalancing them over the shard processes when sharded"""
+        self.managed_devices = managed_devices
+        if self.sharded is not None:
+            self.sharded.assign(managed_devices)
+
+    def _ingest_msg(self, event):
+        self.last_event_at = time.monotonic()
+        if metrics.enabled:
+            metrics.SSE_FRAMES.inc(event.event)
+        if self.recorder is not None:
+            self._record_msg(event)
+        if self.sharded is not None:
+            self._route_msg(event)
+        elif self.pipeline is None:
+            self._handle_msg(event)
+        else:
+            self._enqueue_msg(event)
+
+    def _record_msg(self, event):
+        try:
+            self.recorder.record(event)
+        except OSError as e:  # Ingestion goes on without the recording
+            phlog.error("Recording the event stream failed")
+            phlog.debug(e)
 
-    def _start_stream(self):
-        stream = sseclient.SSEClient(self.stream_config["url"])
-        for event in stream:
-            if event.data != "":
-                self._handle_msg(event)
+    def _route_msg(self, event):
+        """Reader stage of sharded ingestion: hands the raw frame to the shard owning its device"""
+        if event.event not in self.subscribed_events:
+            return
+        coreid = extract_coreid(event.data)
+        if coreid is None:
+            coreid = json.loads(event.data).get('coreid')
+        if coreid not in self.managed_devices:
+            return
+        self.sharded.submit(coreid, event.event, event.data)
+        for callback in self.callbacks:
+            callback(event)
+
+    def _apply_shard_samples(self, samples):
+        """Applies samples parsed by a shard to the hub's devices, time series cache and listeners"""
+        received = time.monotonic()
+        updated = dict()
+        for device_id, values, timestamp in samples:
+            device = self.managed_devices.get(device_id)
+            if device is None:
+                continue
+            device.variable_state.update(values)
+            for variable in values:
+                device.variable_updated[variable] = received
+            if self.timeseries is not None:
+                self.timeseries.record(device_id, values, timestamp)
+            updated[device_id] = device
+        for device in updated.values():
+            for listener in self.device_listeners:
+                listener(device)
+
+    def _enqueue_msg(self, event):
+        """
+        Reader stage: parses the frame and hands subscribed events to the handler pipeline
+        """
+        event_data = self._parse_msg(event)
+        if self._is_subscribed(event, event_data) and not self._is_duplicate(event, event_data):
+            self.pipeline.submit(event_data['coreid'], event, event_data)
 
     def _handle_msg(self, event):
+        event_data = self._parse_msg(event)
+        if self._is_subscribed(event, event_data) and not self._is_duplicate(event, event_data):
+            self._dispatch_event(event, event_data)
+
+    def _parse_msg(self, event):
+        start = time.monotonic()
         event_data = dict(json.loads(event.data))  # Parses the top level Particle.IO structure
-        event_name = event.event
-        if event_data['coreid'] in self.managed_devices.keys() and event_name in self.subscribed_events:
-            device = self.managed_devices[event_data['coreid']]
-            handler = self.event_handlers[event_name]
+        elapsed = time.monotonic() - start
+        self.parse_time.add(elapsed)
+        if metrics.enabled:
+            metrics.PARSE_SECONDS.observe(elapsed)
+        return event_data
+
+    def _is_subscribed(self, event, event_data):
+        return event_data['coreid'] in self.managed_devices.keys() and event.event in self.subscribed_events
+
+    def _is_duplicate(self, event, event_data):
+        if self.deduplicator is None:
+            return False
+        duplicate = self.deduplicator.is_duplicate(event.event, event_data)
+        if metrics.enabled:
+            metrics.DEDUP_EVENTS.inc("hit" if duplicate else "miss")
+        return duplicate
+
+    def _dispatch_event(self, event, event_data):
+        device = self.managed_devices.get(event_data['coreid'])
+        if device is None:  # Removed from management while queued
+            return
+        handler = self.event_handlers[event.event]
+        if metrics.enabled:
+            start = time.monotonic()
+            handler(event_data, device)
+            metrics.HANDLER_SECONDS.observe(time.monotonic() - start, event.event)
+        else:
             handler(event_data, device)
-            for callback in self.callbacks:  # Other system callbacks
-                callback(event)
+        for callback in self.callbacks:  # Other system callbacks
+            callback(event)
+        for listener in self.device_listeners:
+            listener(device)
+
+    def stats(self):
+        stats = dict(parse_time=self.parse_time.stats())
+        if self.pipeline is not None:
+            stats.update(self.pipeline.stats())
+        if self.async_engine is not None:
+            stats["subscriptions"] = self.async_engine.stats()
+        else:
+            stats["subscriptions"] = {self.stream_supervisor.name: self.stream_supervisor.stats()}
+        if self.sharded is not None:
+            stats.update(self.sharded.stats())
+        if self.deduplicator is not None:
+            stats.update(self.deduplicator.stats())
+        if self.recorder is not None:
+            stats["recording"] = self.recorder.stats()
+        return stats
 
     def _handle_data(self, data, device):
         """
         data (dict)        full event data dict
         device (Device)    device object
 
-        ParticleHub Schema: "key1=val1,key2=val2"
+        ParticleHub Schema: "key1=val1,key2=val2", see particlehub.parser
         """
-        device_data_pairs = data['data'].split(",")
-        device_data_pairs = [pair.split("=") for pair in device_data_pairs]
-        device_data = {pair[0]: pair[1] for pair in device_data_pairs}
-        device_data['timestamp'] = data['published_at']
-
-        if self.db_logging:
-            self.log_function(device_data, self.log_credentials, device.tags)
+        received = time.monotonic()
+        published = parse_timestamp_ns(data['published_at'])
+        for index, device_data in enumerate(self.parser.parse_samples(data['data'], device.id)):
+            for variable, value in device_data.items():
+                device.variable_state[variable] = value
+                device.variable_updated[variable] = received
+            device_data.setdefault('timestamp', data['published_at'])
+            if self.timeseries is not None:
+                self.timeseries.record(device.id, device_data, published)
+
+            if self.db_logging:  # Batched samples are 1 ns apart so a redelivered event overwrites the same points
+                self.log_function(device_data, self.log_credentials, device.tags, timestamp=published + index,
+                                  device_id=device.id)
+        if metrics.enabled:
+            metrics.EVENT_LAG_SECONDS.observe(time.time() - published / 1e9)
 
     def _handle_log(self, data, device):
         """
@@ -234,7 +1095,8 @@ class StreamManager(object):
         device (Device)
         """
         if self.db_logging:
-            self.log_function({"LOG": data['data']}, self.log_credentials, device.tags)
+            self.log_function({"LOG": data['data']}, self.log_credentials, device.tags,
+                              timestamp=parse_timestamp_ns(data['published_at']), device_id=device.id)
 
     def _handle_error(self, data, device):
         """
@@ -242,30 +1104,337 @@ class StreamManager(object):
         device (Device)
         """
         if self.db_logging:
-            self.log_function({"ERROR": data['data']}, self.log_credentials, device.tags)
+            self.log_function({"ERROR": data['data']}, self.log_credentials, device.tags,
+                              timestamp=parse_timestamp_ns(data['published_at']), device_id=device.id)
 
 
 ###################################################################################################
 # Log Functions
 
-def _log_to_influx(data, log_credentials=None, tags=None):
-    for variable_name, value in data.items():
-        if variable_name in tags:
-            break
-        point = [{"measurement": variable_name, "fields": {"value": value}, "tags": tags}]
+DEFAULT_INFLUX_TIMEOUT = 10  # seconds
+
+
+class InfluxBatchWriter:
+    """
+    Long lived InfluxDB writer. Points, line protocol strings or dict points, are queued by write() and flushed
+    in batches by a background thread whenever batch_size points are pending or flush_interval seconds have
+    elapsed. Requests time out after DEFAULT_INFLUX_TIMEOUT seconds unless the credentials set a timeout, so an
+    unreachable database fails the flush instead of stalling it.
+    """
+
+    def __init__(self, log_credentials, batch_size=5000, flush_interval=1.0, max_queue_size=100000, spool=None,
+                 replay_rate=5000):
+        """
+            log_credentials (dict):    InfluxDBClient keyword arguments
+            batch_size (int):          number of points sent per write_points call
+            flush_interval (float):    max seconds a point waits in the queue
+            max_queue_size (int):      pending point limit, the oldest points are spooled beyond it, or dropped
+                                       without a spool
+            spool (PointSpool):        durable store for batches the database could not accept
+            replay_rate (float):       max spooled points replayed per second once the database is back
+        """
+        self.client = InfluxDBClient(**dict(dict(timeout=DEFAULT_INFLUX_TIMEOUT), **log_credentials))
+        self.spool = spool
+        self.replay_limiter = TokenBucket(replay_rate, max(batch_size, replay_rate))
+        self.spooled_points = 0
+        self.replayed_points = 0
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.dropped_points = 0
+        self.written_points = 0
+        self.flush_count = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="PHInfluxWriterThread", daemon=True)
+        self._thread.start()
+
+    def write(self, points):
+        with self._lock:
+            self._queue.extend(points)
+            overflow = [self._queue.popleft() for _ in range(len(self._queue) - self.max_queue_size)]
+            if len(self._queue) >= self.batch_size:
+                self._flush_event.set()
+        if overflow:
+            self._spool_batch(overflow)
+
+    def wait_for_capacity(self, max_depth=None, timeout=None):
+        """
+        Blocks bulk producers until at most max_depth points are pending, so the queue does not overflow and
+        drop points
+
+        :param max_depth: (int) defaults to half of max_queue_size
+        :param timeout: (float) seconds, None to wait as long as the writer runs
+
+        :return: (bool) False if the queue was still deeper than max_depth
+        """
+        max_depth = self.max_queue_size // 2 if max_depth is None else max_depth
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self._queue) > max_depth:
+            if self._stop_event.is_set() or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            self._flush_event.set()
+            time.sleep(0.005)
+        return True
+
+    def flush(self):
+        """
+        Writes every pending point to the database in batch_size chunks
+
+        :return: (None)
+        """
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                if not batch:
+                    return
+                self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        start = time.monotonic()
+        result = "ok"
         try:
-            client = InfluxDBClient(**log_credentials)
-            client.write_points(point)
-        except InfluxDBClientError as e:
+            self._write_points(batch)
+            self.written_points += len(batch)
+        except InfluxDBClientError as e:  # Rejected points would be rejected again on replay
+            result = "rejected"
+            self.dropped_points += len(batch)
             phlog.error("InfluxDBClientError")
             phlog.debug(e)
         except InfluxDBServerError as e:
+            result = "error"
             phlog.error("InfluxDBServerError")
             phlog.debug(e)
+            self._spool_batch(batch)
+        except requests.exceptions.RequestException as e:
+            result = "error"
+            phlog.error("InfluxDB RequestException")
+            phlog.debug(e)
+            self._spool_batch(batch)
+        self.last_flush_latency = time.monotonic() - start
+        if metrics.enabled:
+            metrics.DB_WRITE_BATCH_SIZE.observe(len(batch))
+            metrics.DB_WRITE_SECONDS.observe(self.last_flush_latency, result)
+        self.total_flush_latency += self.last_flush_latency
+        self.flush_count += 1
+
+    def _write_points(self, points):
+        lines = [point for point in points if isinstance(point, str)]
+        if lines:
+            self.client.write_points(lines, protocol="line")
+        if len(lines) < len(points):  # dict points, e.g. spooled by an earlier version
+            self.client.write_points([point for point in points if not isinstance(point, str)])
+
+    def _spool_batch(self, batch):
+        if self.spool is None:
+            self.dropped_points += len(batch)
+            return
+        now = time.time_ns()
+        for point in batch:
+            if isinstance(point, dict):  # Encoded lines are always timestamped
+                point.setdefault("time", now)  # Keep the original write time when replayed later
+        self.spool.append(batch)
+        self.spooled_points += len(batch)
+
+    def replay_spool(self):
+        """
+        Writes spooled batches back to the database at up to replay_rate points per second, stopping at the
+        first failure. Progress is checkpointed after every successful batch.
+
+        :return: (int) points replayed
+        """
+        replayed = 0
+        while self.spool is not None and not self._stop_event.is_set():
+            points, position = self.spool.read_batch(self.batch_size)
+            if not points:
+                break
+            self.replay_limiter.acquire(min(len(points), self.replay_limiter.burst))
+            try:
+                self._write_points(points)
+                replayed += len(points)
+            except InfluxDBClientError as e:
+                self.dropped_points += len(points)
+                phlog.error("InfluxDBClientError replaying spool")
+                phlog.debug(e)
+            except (InfluxDBServerError, requests.exceptions.RequestException) as e:
+                phlog.debug(e)
+                break
+            self.spool.commit(position)
+        self.replayed_points += replayed
+        return replayed
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            self.flush()
+            if self.spool is not None and self.spool.has_pending():
+                self.replay_spool()
+
+    def close(self):
+        """
+        Stops the flush thread, writes any pending points and releases the client connection pool
+
+        :return: (None)
+        """
+        self._stop_event.set()
+        self._flush_event.set()
+        self._thread.join()
+        self.flush()
+        self.client.close()
+        if self.spool is not None:
+            self.spool.close()
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        mean_latency = self.total_flush_latency / self.flush_count if self.flush_count else 0.0
+        stats = dict(queue_depth=self.queue_depth, written_points=self.written_points,
+                     dropped_points=self.dropped_points, flush_count=self.flush_count,
+                     last_flush_latency=self.last_flush_latency, mean_flush_latency=mean_latency,
+                     spooled_points=self.spooled_points, replayed_points=self.replayed_points)
+        if self.spool is not None:
+            stats["spool"] = self.spool.stats()
+        return stats
+
+
+INFLUX_WRITER_OPTIONS = ("batch_size", "flush_interval", "max_queue_size", "replay_rate")
+SPOOL_OPTIONS = ("spool_dir", "spool_segment_bytes", "spool_max_bytes")
+_influx_writers = dict()
+_influx_writers_lock = threading.Lock()
+_line_encoder = LineProtocolEncoder()
+
+
+def get_influx_writer(log_credentials):
+    """
+    Returns the shared InfluxBatchWriter for a set of credentials, creating it on first use. Writer options
+    (batch_size, flush_interval, max_queue_size, replay_rate) and spool options (spool_dir, spool_segment_bytes,
+    spool_max_bytes) may be included in the credentials dict. The spool defaults to a "spool" directory next to
+    PHSTATE_FILE, set spool_dir to None to disable it.
+
+    :param log_credentials: (dict)
+
+    :return: (InfluxBatchWriter)
+    """
+    key = tuple(sorted(log_credentials.items()))
+    with _influx_writers_lock:
+        if key not in _influx_writers:
+            options = {k: v for k, v in log_credentials.items() if k in INFLUX_WRITER_OPTIONS}
+            client_args = {k: v for k, v in log_credentials.items()
+                           if k not in INFLUX_WRITER_OPTIONS and k not in SPOOL_OPTIONS}
+            options["spool"] = _create_spool(log_credentials)
+            _influx_writers[key] = InfluxBatchWriter(client_args, **options)
+        return _influx_writers[key]
+
+
+def _shard_log_credentials(log_credentials, shard):
+    """Log credentials of one shard process, which keeps its own spool directory"""
+    if log_credentials is None:
+        return None
+    spool_dir = _spool_dir(log_credentials)
+    if spool_dir is None:
+        return log_credentials
+    return dict(log_credentials, spool_dir=os.path.join(spool_dir, "shard-%d" % shard))
+
+
+def _spool_dir(log_credentials):
+    if "spool_dir" in log_credentials:
+        return log_credentials["spool_dir"]
+    if "PHSTATE_FILE" in os.environ:
+        return os.path.join(os.path.dirname(os.path.abspath(os.environ["PHSTATE_FILE"])), "spool")
+    return None
+
+
+def _create_spool(log_credentials):
+    spool_dir = _spool_dir(log_credentials)
+    if spool_dir is None:
+        return None
+    spool_options = dict(segment_bytes=log_credentials.get("spool_segment_bytes", 16 * 2 ** 20),
+                         max_bytes=log_credentials.get("spool_max_bytes", 512 * 2 ** 20))
+    try:
+        return PointSpool(spool_dir, **spool_options)
+    except SpoolLockedError:  # Only one process per host spools, normally the ingestion leader
+        phlog.error("Spool %s is in use by another process, writing without a spool" % spool_dir)
+        return None
+
+
+def influx_writer_stats():
+    """:return: (dict) "host/database": InfluxBatchWriter stats"""
+    with _influx_writers_lock:
+        writers = list(_influx_writers.items())
+    return {"%s/%s" % (dict(key).get("host"), dict(key).get("database")): writer.stats() for key, writer in writers}
+
+
+@atexit.register
+def close_influx_writers():
+    with _influx_writers_lock:
+        writers = list(_influx_writers.values())
+        _influx_writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+def _log_to_influx(data, log_credentials=None, tags=None, timestamp=None, device_id=None):
+    """
+    :param timestamp: (int) epoch nanoseconds of every point, writing the same data again with the same
+                      timestamp overwrites the points instead of adding duplicates. None for the current time.
+    :param device_id: (str) caches the encoded series keys of the device
+    """
+    get_influx_writer(log_credentials).write(_line_encoder.encode(data, tags or dict(), timestamp, device_id))
 
 
 log_functions = dict(influx=_log_to_influx)
-log_query_functions = dict(influx=None)
+
+
+def _query_influx(variable, start, end, bucket=None, log_credentials=None, tags=None):
+    """
+    Reads one variable from InfluxDB in the time series cache format. Points are matched by measurement and the
+    device tags they were written with.
+
+    :param variable: (str) measurement
+    :param start: (int) epoch nanoseconds, inclusive, or None
+    :param end: (int) epoch nanoseconds, exclusive, or None
+    :param bucket: (int) downsampling bucket width in nanoseconds, None for raw samples
+    :param log_credentials: (dict)
+    :param tags: (dict)
+
+    :return: (list) [timestamp, value] pairs, or dicts of time, min, max, mean, count when downsampled
+    """
+    conditions = list()
+    if start is not None:
+        conditions.append("time >= %d" % start)
+    if end is not None:
+        conditions.append("time < %d" % end)
+    for tag, value in (tags or dict()).items():
+        conditions.append("\"%s\" = '%s'" % (tag.replace('"', '\\"'), str(value).replace("'", "\\'")))
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    measurement = variable.replace('"', '\\"')
+    if bucket:
+        query = ('SELECT min("value"), max("value"), mean("value"), count("value") FROM "%s"%s GROUP BY time(%du)'
+                 % (measurement, where, bucket // 1000))
+    else:
+        query = 'SELECT "value" FROM "%s"%s' % (measurement, where)
+    try:
+        result = get_influx_writer(log_credentials).client.query(query, epoch="ns")
+    except (InfluxDBClientError, InfluxDBServerError, requests.exceptions.RequestException) as e:
+        phlog.error("InfluxDB query failed")
+        phlog.debug(e)
+        return list()
+    if bucket:
+        return [dict(time=point["time"], min=point["min"], max=point["max"], mean=point["mean"],
+                     count=point["count"]) for point in result.get_points() if point["count"]]
+    return [[point["time"], point["value"]] for point in result.get_points()]
+
+
+log_query_functions = dict(influx=_query_influx)
 
 
 ###################################################################################################
@@ -273,24 +1442,40 @@ log_query_functions = dict(influx=None)
 
 class Device:
     DEVICE_TYPE = "unknown"
+    API_DEVICES_URL = BASE_PARTICLE_URL + "devices"
     API_DEVICE_URL = Template(BASE_PARTICLE_URL + "devices/$id/")
     API_GET_URL = Template(BASE_PARTICLE_URL + "devices/$id/$var_name")
     API_FUNC_URL = Template(BASE_PARTICLE_URL + "devices/$id/$func_name")
     API_VITALS_URL = Template(BASE_PARTICLE_URL + "diagnostics/$id/last")
 
+    @classmethod
+    def set_api_url(cls, base_url):
+        """
+        Points every Particle API call at base_url, e.g. a local stand-in of the cloud
+
+        :param base_url: (str) ending in "/v1/"
+        """
+        cls.API_DEVICES_URL = base_url + "devices"
+        cls.API_DEVICE_URL = Template(base_url + "devices/$id/")
+        cls.API_GET_URL = Template(base_url + "devices/$id/$var_name")
+        cls.API_FUNC_URL = Template(base_url + "devices/$id/$func_name")
+        cls.API_VITALS_URL = Template(base_url + "diagnostics/$id/last")
+
     def __init__(self, device_id, cloud_api_token, name=None, tags=None, variables=None, variable_state=None,
-                 notes=None, connected=None, online=None, status=None, is_managed=False):
+                 notes=None, connected=None, online=None, status=None, is_managed=False, removed=False):
         self.id = device_id
         self.cloud_api_token = cloud_api_token
         self.name = name
         self.tags = tags
         self.variables = variables
         self.variable_state = variable_state
+        self.variable_updated = dict()  # variable name: time.monotonic() of the last stream or poll update
         self.notes = notes
         self.connected = connected
         self.online = online
         self.status = status
         self.is_managed = is_managed
+        self.removed = removed  # No longer listed by the cloud
 
         if variable_state is None:
             self.variable_state = dict()
@@ -306,20 +1491,47 @@ class Device:
                    notes=input_dict["notes"], connected=input_dict["connected"], online=input_dict["online"],
                    status=input_dict["status"])
 
-    def get_all_variable_data(self):
-        if self.tags is not None:
-            for tag in self.tags:
-                tag_val = self.get_variable_data(tag)
-                self.tags[tag] = tag_val
+    def update_from_dict(self, input_dict):
+        """Updates cloud metadata in place, returning True if anything changed"""
+        changed = self.removed
+        self.removed = False
+        for attribute in ("name", "variables", "notes", "connected", "online", "status"):
+            if getattr(self, attribute) != input_dict[attribute]:
+                setattr(self, attribute, input_dict[attribute])
+                changed = True
+        return changed
+
+    def get_all_variable_data(self, poller=None):
+        """Fetches every tag and variable value concurrently, returning a PollResult"""
+        if poller is None:
+            poller = _get_default_poller()
+        return poller.poll_device(self)
+
+    def device_health(self, timeout=None):
+        """
+        Fetches the last diagnostics the device reported (Particle device vitals), raising TransientCloudError for
+        timeouts, HTTP 429 and 5xx responses and CloudCommunicationError for other failures
 
-        for variable in self.variables:
-            try:
-                self.variable_state[variable] = self.get_variable_data(variable)
-            except requests.exceptions.RequestException:
-                pass
+        :param timeout: (float) seconds, None to wait indefinitely
 
-    def device_health(self):
-        raise NotImplementedError
+        :return: (DeviceVitals)
+        """
+        start = time.monotonic()
+        try:
+            r = http_session.get(Device.API_VITALS_URL.substitute(dict(id=self.id)),
+                                 params=dict(access_token=self.cloud_api_token), timeout=timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            _observe_api_request("GET", start, "error")
+            raise TransientCloudError(type(e).__name__)
+        except requests.exceptions.RequestException as e:
+            _observe_api_request("GET", start, "error")
+            raise CloudCommunicationError(type(e).__name__)
+        _observe_api_request("GET", start, r.status_code)
+        if r.status_code == requests.codes.too_many_requests or r.status_code >= 500:
+            raise TransientCloudError("HTTP %d" % r.status_code)
+        if r.status_code != requests.codes.ok:
+            raise CloudCommunicationError("HTTP %d" % r.status_code)
+        return DeviceVitals.from_diagnostics(self.id, r.json().get("diagnostics") or dict())
 
     def _update_variable_names(self):
         """Queries the variables available with this device"""
@@ -345,6 +1557,58 @@ class Device:
             phlog.debug(val)
             return None
 
+    def fetch_variable(self, var, timeout=None):
+        """
+        Returns the current value of var, raising CloudCommunicationError with the reason on failure
+
+        :param var: (str)
+        :param timeout: (float) seconds, None to wait indefinitely
+        """
+        if var not in (self.variables or dict()):
+            raise CloudCommunicationError("Unknown variable %s" % var)
+        start = time.monotonic()
+        try:
+            r = http_session.get(Device.API_GET_URL.substitute(dict(id=self.id, var_name=var)),
+                                 params=dict(access_token=self.cloud_api_token), timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            _observe_api_request("GET", start, "error")
+            raise CloudCommunicationError(type(e).__name__)
+        _observe_api_request("GET", start, r.status_code)
+        if r.status_code != requests.codes.ok:
+            raise CloudCommunicationError("HTTP %d" % r.status_code)
+        return r.json()["result"]
+
+    def call_function(self, func_name, arg="", timeout=None):
+        """
+        Calls a Particle function, raising TransientCloudError for timeouts, HTTP 429 and 5xx responses and
+        CloudCommunicationError for other failures
+
+        :param func_name: (str)
+        :param arg: (str)
+        :param timeout: (float) seconds, None to wait indefinitely
+
+        :return: (int) the function's return value
+        """
+        start = time.monotonic()
+        try:
+            r = http_session.post(Device.API_FUNC_URL.substitute(dict(id=self.id, func_name=func_name)),
+                                  data=dict(args=str(arg), access_token=self.cloud_api_token), timeout=timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            _observe_api_request("POST", start, "error")
+            raise TransientCloudError(type(e).__name__)
+        except requests.exceptions.RequestException as e:
+            _observe_api_request("POST", start, "error")
+            raise CloudCommunicationError(type(e).__name__)
+        _observe_api_request("POST", start, r.status_code)
+        if r.status_code == requests.codes.too_many_requests or r.status_code >= 500:
+            raise TransientCloudError("HTTP %d" % r.status_code)
+        if r.status_code != requests.codes.ok:
+            raise CloudCommunicationError("HTTP %d" % r.status_code)
+        try:
+            return r.json().get("return_value")
+        except (ValueError, AttributeError):
+            raise CloudCommunicationError("Invalid response")
+
     def _call_func(self, func_name, arg):
         result = send_post_request(url=Device.API_FUNC_URL.substitute(
             dict(id=self.id, func_name=func_name)),
@@ -356,14 +1620,34 @@ class Device:
 ###################################################################################################
 # General Methods
 
+_default_poller = None
+_default_poller_lock = threading.Lock()
+
+
+def _get_default_poller():
+    global _default_poller
+    with _default_poller_lock:
+        if _default_poller is None:
+            _default_poller = VariablePoller()
+        return _default_poller
+
+
+def _observe_api_request(method, start, status):
+    if metrics.enabled:
+        metrics.API_REQUEST_SECONDS.observe(time.monotonic() - start, method, status)
+
+
 def send_get_request(url, params, except_return=None):
+    start = time.monotonic()
     try:
-        r = requests.get(url, params=params)
+        r = http_session.get(url, params=params)
+        _observe_api_request("GET", start, r.status_code)
         if r.status_code == requests.codes.ok:
             return dict(r.json())
         else:
             return None
     except requests.exceptions.RequestException:
+        _observe_api_request("GET", start, "error")
         phlog.error("send_get_request RequestException")
         phlog.debug(url)
         phlog.debug(params)
@@ -371,13 +1655,16 @@ def send_get_request(url, params, except_return=None):
 
 
 def send_post_request(url, data, except_return=False):
+    start = time.monotonic()
     try:
-        r = requests.post(url, data=data)
+        r = http_session.post(url, data=data)
+        _observe_api_request("POST", start, r.status_code)
         if r.status_code == requests.codes.ok:
             return True
         else:
             return False
     except requests.exceptions.RequestException:
+        _observe_api_request("POST", start, "error")
         phlog.error("send_post_request RequestException")
         phlog.debug(url)
         phlog.debug(data)
@@ -400,3 +1687,8 @@ class LogStopError(Exception):
 
 class CloudCommunicationError(Exception):
     pass
+
+
+class TransientCloudError(CloudCommunicationError):
+    """A failure worth retrying: timeout, connection error, rate limit or server error"""
+    pass
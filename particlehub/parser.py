@@ -0,0 +1,198 @@
+"""
+ParticleHub DATA payload schema:  "key1=val1,key2=val2"
+
+Pairs are separated by "," and a key from its value by the first "=". A backslash escapes the next character
+so keys and values may contain separators (msg=a\\,b). Several samples may be batched in one event by
+separating them with ";". Empty pairs are ignored. Numbers are converted to float, so a field keeps one type
+in the log database whether a device sends 21 or 21.5, and true/false to bool. Anything else, including nan, inf
+and "1_000" style literals, stays a string.
+"""
+
+import re
+import threading
+
+PAIR_SEPARATOR = ","
+KEY_SEPARATOR = "="
+SAMPLE_SEPARATOR = ";"
+ESCAPE = "\\"
+
+_escaped_token = re.compile(r"\\(.)|([,=;])|([^\\,=;]+)", re.DOTALL)
+_bool_values = {"true": True, "false": False}
+_flag_values = dict(_bool_values, **{"1": True, "0": False})
+
+
+def to_bool(value):
+    return _bool_values[value.lower()]
+
+
+def to_number(value):
+    """Converts a decimal literal to float, rejecting nan, inf, "1_000" and surrounding whitespace"""
+    number = float(value)
+    if number - number != 0 or "_" in value or value[0].isspace() or value[-1].isspace():
+        raise ValueError(value)
+    return number
+
+
+def to_flag(value):
+    """to_bool for a key already parsed as bool, which also reads 1 and 0 so the field stays bool"""
+    return _flag_values[value.lower()]
+
+
+def to_numeric(value):
+    """to_number for a key already parsed as a number, which also reads true and false as 1.0 and 0.0"""
+    try:
+        return to_number(value)
+    except ValueError:
+        return float(to_bool(value))
+
+
+def infer_type(value):
+    """
+    Returns the first converter (to_number, to_bool or str) that accepts value
+
+    :param value: (str)
+
+    :return: (callable)
+    """
+    for converter in (to_number, to_bool):
+        try:
+            converter(value)
+            return converter
+        except (ValueError, KeyError):
+            continue
+    return str
+
+
+def to_text(value):
+    """str for a key last seen with a string value, raising ValueError for a number or bool so the key is typed
+    again: an empty or garbled value must not turn a numeric key into a string one"""
+    first = value[:1]
+    if first.isdigit() or first in "+-.":
+        try:
+            to_number(value)
+        except ValueError:
+            return value
+        raise ValueError(value)
+    if value.lower() in _bool_values:
+        raise ValueError(value)
+    return value
+
+
+# Converter cached for a key by the type inferred from its last value that needed inference
+_cached_converters = {to_number: to_numeric, to_bool: to_flag, str: to_text}
+
+
+class DataParser:
+    """
+    Parses DATA event payloads into typed dicts. A converter is cached for each device and key so type inference
+    only runs the first time a key is seen, or when a value no longer fits. Number and bool keys keep their type
+    for values of the other kind (1/0 for a bool, true/false for a number) so the field type in the log database
+    does not flip, while a key cached as a string is typed again as soon as it sends a number or bool.
+    """
+
+    def __init__(self):
+        self.schema = dict()
+        self._lock = threading.Lock()
+
+    def parse(self, payload, device_id=None):
+        """
+        :param payload: (str) single sample payload
+        :param device_id: (str) schema cache key
+
+        :return: (dict) key: typed value
+        """
+        samples = self.parse_samples(payload, device_id)
+        result = dict()
+        for sample in samples:
+            result.update(sample)
+        return result
+
+    def parse_samples(self, payload, device_id=None):
+        """
+        :param payload: (str) one or more ";" separated samples
+        :param device_id: (str) schema cache key
+
+        :return: (list) one dict per sample
+        """
+        device_schema = self.schema.get(device_id)
+        if device_schema is None:
+            with self._lock:
+                device_schema = self.schema.setdefault(device_id, dict())
+        if ESCAPE in payload:
+            return [self._convert(pairs, device_schema) for pairs in self._tokenize_escaped(payload) if pairs]
+
+        samples = list()
+        for raw_sample in payload.split(SAMPLE_SEPARATOR):
+            sample = dict()
+            for pair in raw_sample.split(PAIR_SEPARATOR):
+                key, separator, value = pair.partition(KEY_SEPARATOR)
+                if not key or not separator:
+                    continue
+                converter = device_schema.get(key)
+                if converter is not None:
+                    try:
+                        sample[key] = converter(value)
+                        continue
+                    except (ValueError, KeyError):
+                        pass
+                sample[key] = self._infer(device_schema, key, value)
+            if sample:
+                samples.append(sample)
+        return samples
+
+    def _convert(self, pairs, device_schema):
+        sample = dict()
+        for key, value in pairs:
+            converter = device_schema.get(key)
+            if converter is not None:
+                try:
+                    sample[key] = converter(value)
+                    continue
+                except (ValueError, KeyError):
+                    pass
+            sample[key] = self._infer(device_schema, key, value)
+        return sample
+
+    def _infer(self, device_schema, key, value):
+        converter = infer_type(value)
+        cached = _cached_converters.get(converter)
+        if cached is not None:
+            with self._lock:
+                device_schema[key] = cached
+        return converter(value)
+
+    @staticmethod
+    def _tokenize_escaped(payload):
+        samples = list()
+        pairs = list()
+        key = None
+        current = list()
+        for match in _escaped_token.finditer(payload):
+            escaped, separator, text = match.groups()
+            if separator is None:
+                current.append(escaped if escaped is not None else text)
+            elif separator == KEY_SEPARATOR and key is None:
+                key = "".join(current)
+                current = list()
+            elif separator == KEY_SEPARATOR:
+                current.append(separator)  # Unescaped "=" inside a value
+            else:
+                if key:
+                    pairs.append((key, "".join(current)))
+                key = None
+                current = list()
+                if separator == SAMPLE_SEPARATOR:
+                    samples.append(pairs)
+                    pairs = list()
+        if key:
+            pairs.append((key, "".join(current)))
+        samples.append(pairs)
+        return samples
+
+    def clear(self, device_id=None):
+        """Forgets cached types for one device, or for every device"""
+        with self._lock:
+            if device_id is None:
+                self.schema.clear()
+            else:
+                self.schema.pop(device_id, None)
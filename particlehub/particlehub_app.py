@@ -1,31 +1,98 @@
 import os
 import sys
+import time
 import signal
 import logging.handlers
 import importlib.util
 from flask_wtf import CSRFProtect
-from flask import Flask, render_template, jsonify, request, make_response
-from particlehub import models
+import simplejson as json
+from flask import Flask, Blueprint, Response, render_template, jsonify, request, make_response, \
+    stream_with_context, current_app, abort
+from particlehub import models, metrics
+from particlehub.live import DeviceEventBroadcaster
+from particlehub.coordination import open_leader_lock
 
-spec = importlib.util.spec_from_file_location("phconfig", os.getenv("PHCONFIG_FILE"))
-phconfig = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(phconfig)
+phlog = logging.getLogger('particle-hub')
+views = Blueprint('particlehub', __name__)
+
+
+def load_config(path=None):
+    """
+    Executes the configuration module, by default the file named by PHCONFIG_FILE
+
+    :return: (module)
+    """
+    spec = importlib.util.spec_from_file_location("phconfig", path or os.getenv("PHCONFIG_FILE"))
+    phconfig = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(phconfig)
+    return phconfig
+
+
+def create_app(phconfig=None, hub_manager=None):
+    """
+    Builds the web app. The HubManager is created lazily: requests are served at once from the last known device
+    list while the cloud device list is fetched and ingestion starts in the background (see /health/ready).
+
+    :param phconfig: (module) configuration, loaded from PHCONFIG_FILE by default
+    :param hub_manager: (HubManager) use this hub instead of creating one from phconfig
+
+    :return: (Flask)
+    """
+    if phconfig is None:
+        phconfig = load_config()
+    app = Flask(__name__)
+    app.secret_key = phconfig.csrf_key
+    csrf = CSRFProtect()
+    csrf.init_app(app)
+    _configure_logging(phconfig)
+    if getattr(phconfig, "metrics_enabled", False):
+        metrics.enable()
+
+    live_broadcaster = DeviceEventBroadcaster(max_pending=getattr(phconfig, "live_max_pending", 1000),
+                                              max_clients=getattr(phconfig, "live_max_clients", 4))
+    if hub_manager is None:
+        hub_manager = _create_hub_manager(phconfig, [live_broadcaster])
+    else:
+        hub_manager.device_listeners.append(live_broadcaster)
+    app.extensions['particlehub'] = dict(hub_manager=hub_manager, live_broadcaster=live_broadcaster,
+                                         device_row_cache=dict(), replay_dir=getattr(phconfig, "replay_dir", None))
+    app.register_blueprint(views)
+    return app
 
-app = Flask(__name__)
-app.secret_key = phconfig.csrf_key
-csrf = CSRFProtect()
-csrf.init_app(app)
 
-phlog = logging.getLogger('particle-hub')
-phlog.setLevel(logging.INFO)
-log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-syslog_handler = logging.handlers.SysLogHandler(address=phconfig.syslog_host)
-syslog_handler.setFormatter(log_formatter)
-phlog.addHandler(syslog_handler)
-models.phlog = phlog
+def _configure_logging(phconfig):
+    phlog.setLevel(logging.INFO)
+    if not any(isinstance(handler, logging.handlers.SysLogHandler) for handler in phlog.handlers):
+        log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        syslog_handler = logging.handlers.SysLogHandler(address=phconfig.syslog_host)
+        syslog_handler.setFormatter(log_formatter)
+        phlog.addHandler(syslog_handler)
+    models.phlog = phlog
+
+
+def _create_hub_manager(phconfig, device_listeners):
+    db_log_dest = phconfig.default_log_source
+    db_log_credentials = phconfig.log_config[db_log_dest]
+    coordination_config = getattr(phconfig, "coordination_config", dict(backend="file"))
+    leader_lock = open_leader_lock(**coordination_config) if coordination_config is not None else None
+    cloud = models.ParticleCloud(phconfig.cloud_api_token, cache_ttl=getattr(phconfig, "device_cache_ttl", 30),
+                                 timeout=getattr(phconfig, "cloud_timeout", 10))
+    return models.HubManager(cloud, phconfig.stream_config, list(), db_log_dest, db_log_credentials,
+                             poll_config=getattr(phconfig, "poll_config", None),
+                             schedule_config=getattr(phconfig, "schedule_config", None),
+                             device_listeners=device_listeners,
+                             timeseries_config=getattr(phconfig, "timeseries_config", None),
+                             leader_lock=leader_lock, lazy=True,
+                             command_config=getattr(phconfig, "command_config", None),
+                             vitals_config=getattr(phconfig, "vitals_config", None))
 
-db_log_dest = phconfig.default_log_source
-db_log_credentials = phconfig.log_config[db_log_dest]
+
+def get_hub_manager():
+    return current_app.extensions['particlehub']['hub_manager']
+
+
+def get_live_broadcaster():
+    return current_app.extensions['particlehub']['live_broadcaster']
 
 
 def stop_signal_handler(signum, frame):
@@ -33,51 +100,201 @@ def stop_signal_handler(signum, frame):
     sys.exit(0)
 
 
-signal.signal(signal.SIGINT, stop_signal_handler)
-signal.signal(signal.SIGTERM, stop_signal_handler)
+DEFAULT_PAGE_SIZE = 50
+LIVE_KEEPALIVE_INTERVAL = 15
 
 
-@app.route('/', methods=['GET'])
+@views.route('/', methods=['GET'])
 def root():
-    refresh_all_devices()
+    get_hub_manager().refresh_device_list_async()
     return render_template('particlehub.html')
 
 
-@app.route('/get-devices', methods=['GET'])
+@views.route('/get-devices', methods=['GET'])
 def get_devices():
+    """
+    Streams one page of device rows. Query params: page, per_page, name (glob), tag, managed ("true"/"false").
+    The total number of matching devices is returned in the X-Total-Count header.
+    """
+    hub_manager = get_hub_manager()
     devices = hub_manager.devices
     if devices is None:
         return make_response("<h3>No Devices Found</h3>", 200)
-    response = ""
-    for device_id, device in devices.items():
-        response = response + render_template('device_list_row.html', device=device) + "\n"
-    return make_response(response, 200)
-
-
-@app.route('/refresh-all-devices', methods=['GET'])
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = max(request.args.get('per_page', DEFAULT_PAGE_SIZE, type=int), 1)
+    managed = request.args.get('managed')
+    if managed is not None:
+        managed = managed.lower() == "true"
+    start = (page - 1) * per_page
+    if request.args.get('name') is None and request.args.get('tag') is None and managed is None:
+        total = len(devices)
+        page_ids = list(devices)[start:start + per_page]
+    else:
+        device_ids = hub_manager.select_devices(name=request.args.get('name'), tag=request.args.get('tag'),
+                                                managed=managed)
+        total = len(device_ids)
+        page_ids = device_ids[start:start + per_page]
+
+    def generate():
+        for device_id in page_ids:
+            device = devices.get(device_id)
+            if device is not None:
+                yield _render_device_row(device, hub_manager.vitals_summary(device_id)) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype="text/html")
+    response.headers['X-Total-Count'] = str(total)
+    response.headers['X-Page'] = str(page)
+    response.headers['X-Per-Page'] = str(per_page)
+    return response
+
+
+def _render_device_row(device, vitals=None):
+    """
+    Renders a device row, reusing the cached html while the fields shown in the row are unchanged
+
+    :param device: (Device)
+    :param vitals: (dict) health summary from the vitals cache, see HubManager.vitals_summary
+    """
+    signature = (device.name, device.online, device.is_managed, tuple(sorted((vitals or dict()).items())))
+    device_row_cache = current_app.extensions['particlehub']['device_row_cache']
+    cached = device_row_cache.get(device.id)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    row = render_template('device_list_row.html', device=device, vitals=vitals)
+    device_row_cache[device.id] = (signature, row)
+    return row
+
+
+@views.route('/refresh-all-devices', methods=['GET'])
 def refresh_all_devices():
-    hub_manager.update_device_list()
+    get_hub_manager().update_device_list(force=True)
     return get_devices()
 
 
-@app.route('/get-device-info', methods=['GET'])
+@views.route('/device-health', methods=['GET'])
+def device_health():
+    """Vitals of a device as JSON, served from the cache and refreshed in the background once older than the ttl"""
+    device_id = request.args.get('id')
+    hub_manager = get_hub_manager()
+    if hub_manager.vitals is None:
+        return make_response("device vitals are disabled", 404)
+    vitals = hub_manager.device_vitals(device_id)
+    if vitals is None:
+        return make_response(jsonify(dict(id=device_id, status="pending")), 202)
+    return make_response(jsonify(dict(vitals.to_dict(), age=vitals.age)), 200)
+
+
+@views.route('/get-device-info', methods=['GET'])
 def get_device_info():
     device_id = request.args.get('id')
-    device = hub_manager.devices[device_id]
+    device = get_hub_manager().devices[device_id]
     device_info = device.full_device_data()
     response = render_template("device_info.html", device_info=device_info)
     return make_response(response, 200)
 
 
-@app.route('/add-unmanaged-devices', methods=['POST'])
+@views.route('/add-unmanaged-devices', methods=['POST'])
 def add_unmanaged_devices():
-    for device_id, device in hub_manager.devices.items():
-        if device.is_managed is not True:
-            _add_device(device.id)
+    device_ids = get_hub_manager().select_devices(managed=False)
+    get_hub_manager().add_devices(device_ids)
+    phlog.info("Devices Added (count: %d)" % len(device_ids))
     return make_response("success", 200)
+
+
+@views.route('/bulk/add-devices', methods=['POST'])
+def bulk_add_devices():
+    device_ids = _bulk_selection()
+    if device_ids is None:
+        return _no_selection()
+    results = get_hub_manager().add_devices(device_ids)
+    phlog.info("Bulk devices added (count: %d)" % _success_count(results))
+    return make_response(jsonify(results), 200)
+
+
+@views.route('/bulk/remove-devices', methods=['POST'])
+def bulk_remove_devices():
+    device_ids = _bulk_selection()
+    if device_ids is None:
+        return _no_selection()
+    results = get_hub_manager().remove_devices(device_ids)
+    phlog.info("Bulk devices removed (count: %d)" % _success_count(results))
+    return make_response(jsonify(results), 200)
+
+
+@views.route('/bulk/add-tag', methods=['POST'])
+def bulk_add_tag():
+    tag = _bulk_args().get('tag')
+    if not tag:
+        return _bad_request("tag is required")
+    device_ids = _bulk_selection()
+    if device_ids is None:
+        return _no_selection()
+    results = get_hub_manager().add_tags(device_ids, tag)
+    return make_response(jsonify(results), 200)
+
+
+@views.route('/bulk/remove-tag', methods=['POST'])
+def bulk_remove_tag():
+    tag = _bulk_args().get('tag')
+    if not tag:
+        return _bad_request("tag is required")
+    device_ids = _bulk_selection()
+    if device_ids is None:
+        return _no_selection()
+    results = get_hub_manager().remove_tags(device_ids, tag)
+    return make_response(jsonify(results), 200)
+
+
+@views.route('/bulk/call-function', methods=['POST'])
+def bulk_call_function():
+    """Calls the Particle function "function" with "argument" on the selected devices, see _bulk_selection"""
+    args = _bulk_args()
+    if not args.get('function'):
+        return _bad_request("function is required")
+    device_ids = _bulk_selection()
+    if device_ids is None:
+        return _no_selection()
+    summary = get_hub_manager().call_function(device_ids, args['function'], args.get('argument', ""))
+    return make_response(jsonify(summary), 200)
+
+
+def _bulk_args():
+    return request.get_json(silent=True) or request.form
+
+
+def _bulk_selection():
+    """
+    Resolves the devices targeted by a bulk request from a JSON body or form fields:
+    ids (list), name (glob), has_tag (str), managed ("true"/"false")
+
+    :return: (list) device ids, None when the request has none of the selectors so it never acts on every device.
+             Aborts with 400 when ids is not a list.
+    """
+    args = _bulk_args()
+    device_ids = (args.getlist('ids') or None) if hasattr(args, 'getlist') else args.get('ids')
+    if device_ids is not None and not isinstance(device_ids, list):
+        abort(_bad_request("ids must be a list"))
+    name, tag, managed = args.get('name'), args.get('has_tag'), args.get('managed')
+    if device_ids is None and name is None and tag is None and managed is None:
+        return None
+    if isinstance(managed, str):
+        managed = managed.lower() == "true"
+    return get_hub_manager().select_devices(device_ids=device_ids, name=name, tag=tag, managed=managed)
+
+
+def _no_selection():
+    return _bad_request("select devices with ids, name, has_tag or managed")
+
+
+def _bad_request(error):
+    return make_response(jsonify(dict(status="fail", error=error)), 400)
+
+
+def _success_count(results):
+    return sum(1 for result in results.values() if result['status'] == "success")
     
 
-@app.route('/add-device', methods=['POST'])
+@views.route('/add-device', methods=['POST'])
 def add_device():
     device_id = request.form['id']
     _add_device(device_id)
@@ -85,11 +302,11 @@ def add_device():
 
 
 def _add_device(device_id):
-    hub_manager.add_device(device_id)
+    get_hub_manager().add_device(device_id)
     phlog.info("Device Added (id: %s)" % device_id)
 
 
-@app.route('/remove-device', methods=['POST'])
+@views.route('/remove-device', methods=['POST'])
 def remove_device():
     device_id = request.form['id']
     _remove_device(device_id)
@@ -97,37 +314,144 @@ def remove_device():
 
 
 def _remove_device(device_id):
-    hub_manager.remove_device(device_id)
+    get_hub_manager().remove_device(device_id)
     phlog.info("Device and log manager removed (id: %s)" % device_id)
 
 
-@app.route('/add-tag', methods=['POST'])
+@views.route('/add-tag', methods=['POST'])
 def add_tag():
     device_id = request.form['id']
     tag = request.form['tag']
-    success = hub_manager.add_tag(device_id, tag)
+    success = get_hub_manager().add_tag(device_id, tag)
     if success is True:
         return make_response(jsonify(dict(status="success", tag=tag)), 200)
     else:
         return make_response(jsonify(dict(status="fail", tag=tag)), 200)
 
 
-@app.route('/remove-tag', methods=['POST'])
+@views.route('/remove-tag', methods=['POST'])
 def remove_tag():
     device_id = request.form['id']
     tag = request.form['tag']
-    success = hub_manager.remove_tag(device_id, tag)
+    success = get_hub_manager().remove_tag(device_id, tag)
     if success is True:
         return make_response(jsonify(dict(status="success", tag=tag)), 200)
     else:
         return make_response(jsonify(dict(status="fail", tag=tag)), 200)
 
 
-event_callbacks = list()
-cloud = models.ParticleCloud(phconfig.cloud_api_token)
-hub_manager = models.HubManager(cloud, phconfig.stream_config, event_callbacks, db_log_dest, db_log_credentials)
+@views.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of the hub's instrumentation"""
+    if not metrics.enabled:
+        return make_response("metrics are disabled", 404)
+    gauges = get_hub_manager().metric_gauges()
+    gauges.append(("particlehub_live_clients", "Browsers connected to /events",
+                   get_live_broadcaster().stats()["clients"], ()))
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+@views.route('/replay', methods=['GET', 'POST'])
+def replay():
+    """
+    POST replays event files in replay_dir to the log database in the background, from a JSON body or form
+    fields: paths (list, relative to replay_dir), shift (seconds), rebase ("now" or a published_at time),
+    dry_run and all_devices ("true"/"false"). GET returns the progress of the running or last replay.
+    """
+    replay_dir = current_app.extensions['particlehub']['replay_dir']
+    if replay_dir is None:
+        return make_response("replay is disabled", 404)
+    if request.method == 'GET':
+        return make_response(jsonify(get_hub_manager().replay_status()), 200)
+    args = _bulk_args()
+    paths = (args.getlist('paths') or None) if hasattr(args, 'getlist') else args.get('paths')
+    root = os.path.realpath(replay_dir)
+    paths = [os.path.realpath(os.path.join(root, path)) for path in paths or [""]]
+    if any(os.path.commonpath([root, path]) != root or not os.path.exists(path) for path in paths):
+        return make_response(jsonify(dict(status="fail", error="paths must exist in replay_dir")), 400)
+    rebase = args.get('rebase')
+    stats = get_hub_manager().replay_events(paths, time_offset=int(float(args.get('shift') or 0) * 1e9),
+                                            rebase_to=time.time_ns() if rebase == "now" else
+                                            (models.parse_timestamp_ns(rebase) if rebase else None),
+                                            dry_run=_flag(args.get('dry_run')),
+                                            add_devices=_flag(args.get('all_devices')))
+    if stats is None:
+        return make_response(jsonify(dict(status="fail", error="a replay is already running")), 409)
+    return make_response(jsonify(dict(stats, status="success")), 202)
+
+
+def _flag(value):
+    return value.lower() == "true" if isinstance(value, str) else bool(value)
+
+
+@views.route('/health/live', methods=['GET'])
+def health_live():
+    """Liveness: 200 unless this process leads ingestion without a running stream reader"""
+    health = get_hub_manager().health()
+    return make_response(jsonify(health), 200 if health['stream_alive'] else 500)
+
+
+@views.route('/health/ready', methods=['GET'])
+def health_ready():
+    """Readiness: 200 once startup finished with a device list, 503 before, with the state of each component"""
+    health = get_hub_manager().health()
+    ready = health['ready'] and health['devices'] != "unavailable"
+    return make_response(jsonify(health), 200 if ready else 503)
+
+
+@views.route('/timeseries', methods=['GET'])
+def get_timeseries():
+    """
+    Recent telemetry of a device as JSON. Query params: id, variable, start and end (epoch seconds), bucket
+    (seconds). Without a variable the last value of every cached variable is returned.
+    """
+    device_id = request.args.get('id')
+    variable = request.args.get('variable')
+    if variable is None:
+        return make_response(jsonify(dict(id=device_id, last=get_hub_manager().timeseries.last(device_id))), 200)
+    start, end, bucket = [_seconds_to_ns(request.args.get(key, type=float)) for key in ('start', 'end', 'bucket')]
+    points, source = get_hub_manager().query_timeseries(device_id, variable, start, end, bucket)
+    return make_response(jsonify(dict(id=device_id, variable=variable, source=source, points=points)), 200)
+
+
+def _seconds_to_ns(seconds):
+    return None if seconds is None else int(seconds * 1e9)
+
+
+@views.route('/events', methods=['GET'])
+def events():
+    """
+    Server-sent event stream of live device state. A snapshot of every managed device is sent on connect,
+    followed by coalesced "devices" events carrying a list of changed devices. Each stream holds a server
+    thread, so beyond live_max_clients streams per worker the request is refused with 503 and the page keeps
+    working without live updates.
+    """
+    live_broadcaster = get_live_broadcaster()
+    client = live_broadcaster.subscribe(list(get_hub_manager().managed_devices.values()))
+    if client is None:
+        return make_response("too many live event clients", 503, {"Retry-After": "30"})
+
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                batch = client.next_batch(timeout=LIVE_KEEPALIVE_INTERVAL)
+                if batch is None:
+                    return
+                if batch:
+                    yield "event: devices\ndata: %s\n\n" % json.dumps(batch)
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            live_broadcaster.unsubscribe(client)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 if __name__ == '__main__':
+    signal.signal(signal.SIGINT, stop_signal_handler)
+    signal.signal(signal.SIGTERM, stop_signal_handler)
+    phconfig = load_config()
     phlog.info("Starting particle-hub")
-    app.run(debug=True, host=phconfig.web_host)
+    create_app(phconfig).run(debug=True, host=phconfig.web_host)
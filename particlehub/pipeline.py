@@ -0,0 +1,209 @@
+import time
+import zlib
+import logging
+import tempfile
+import threading
+import collections
+import sseclient
+import simplejson as json
+
+phlog = logging.getLogger("particle-hub.pipeline")
+
+BACKPRESSURE_POLICIES = ("block", "drop_oldest", "spill")
+
+
+###################################################################################################
+# Event Pipeline
+
+class EventPipeline:
+    """
+    Bounded, multi worker event pipeline. Events are partitioned by key (device coreid) so that every event
+    for a given device is handled in arrival order by the same worker.
+    """
+
+    def __init__(self, handler, workers=4, max_queue_size=10000, backpressure="block"):
+        """
+            handler (callable):      handler(event, event_data) run on a worker thread
+            workers (int):           number of handler threads
+            max_queue_size (int):    pending events allowed per worker before backpressure applies
+            backpressure (str):      block, drop_oldest or spill (overflow to a temporary file)
+        """
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy: %s" % backpressure)
+        self.handler = handler
+        self.max_queue_size = max_queue_size
+        self.backpressure = backpressure
+        self.received = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.queue_wait = StageTimer()
+        self.handle_time = StageTimer()
+        self._closed = False
+        self._partitions = [_Partition(self, index) for index in range(max(workers, 1))]
+
+    def start(self):
+        for partition in self._partitions:
+            partition.thread.start()
+
+    def submit(self, key, event, event_data):
+        """
+        Queues an event on the worker owning key, applying the backpressure policy when that worker is full.
+
+        :param key: (str) partition key, normally the device coreid
+        :param event: (sseclient.Event)
+        :param event_data: (dict) parsed event payload
+
+        :return: (bool) False if the event was not queued
+        """
+        if self._closed:
+            return False
+        self.received += 1
+        partition = self._partitions[zlib.crc32(key.encode()) % len(self._partitions)]
+        return partition.put((event, event_data, time.monotonic()))
+
+    def close(self, timeout=None):
+        """
+        Stops accepting events and waits for the workers to drain their queues.
+
+        :return: (None)
+        """
+        self._closed = True
+        for partition in self._partitions:
+            partition.stop()
+        for partition in self._partitions:
+            if partition.thread.is_alive():
+                partition.thread.join(timeout)
+
+    @property
+    def queue_depth(self):
+        return sum(len(partition) for partition in self._partitions)
+
+    def stats(self):
+        return dict(workers=len(self._partitions), queue_depth=self.queue_depth, received=self.received,
+                    dropped=self.dropped, spilled=self.spilled, queue_wait=self.queue_wait.stats(),
+                    handle_time=self.handle_time.stats())
+
+
+class _Partition:
+    """A single worker thread and its bounded queue (plus on-disk overflow when spilling)."""
+
+    def __init__(self, pipeline, index):
+        self.pipeline = pipeline
+        self.queue = collections.deque()
+        self.spill = None
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="PHHandlerThread-%d" % index, daemon=True)
+
+    def __len__(self):
+        return len(self.queue) + (len(self.spill) if self.spill is not None else 0)
+
+    def put(self, item):
+        pipeline = self.pipeline
+        with self.condition:
+            if self.spill is not None and len(self.spill):
+                # Once spilling, everything goes to disk until it drains so ordering is preserved
+                self.spill.append(item)
+                pipeline.spilled += 1
+            elif len(self.queue) < pipeline.max_queue_size:
+                self.queue.append(item)
+            elif pipeline.backpressure == "block":
+                while len(self.queue) >= pipeline.max_queue_size and not self.stopping:
+                    self.condition.wait()
+                self.queue.append(item)
+            elif pipeline.backpressure == "drop_oldest":
+                self.queue.popleft()
+                self.queue.append(item)
+                pipeline.dropped += 1
+            else:
+                if self.spill is None:
+                    self.spill = _SpillFile()
+                self.spill.append(item)
+                pipeline.spilled += 1
+            self.condition.notify_all()
+        return True
+
+    def get(self):
+        with self.condition:
+            while not self.queue and not (self.spill is not None and len(self.spill)):
+                if self.stopping:
+                    return None
+                self.condition.wait()
+            if self.queue:
+                item = self.queue.popleft()
+            else:
+                item = self.spill.popleft()
+            self.condition.notify_all()
+            return item
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+    def _run(self):
+        pipeline = self.pipeline
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            event, event_data, enqueued_at = item
+            start = time.monotonic()
+            pipeline.queue_wait.add(start - enqueued_at)
+            try:
+                pipeline.handler(event, event_data)
+            except Exception as e:
+                phlog.error("Event handler raised %s" % type(e).__name__)
+                phlog.debug(e)
+            pipeline.handle_time.add(time.monotonic() - start)
+
+
+class _SpillFile:
+    """FIFO of queued events stored as NDJSON in an anonymous temporary file."""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(mode="w+b")
+        self.read_offset = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        event, event_data, enqueued_at = item
+        record = [event.event, event.data, event.id, enqueued_at]
+        self.file.seek(0, 2)
+        self.file.write(json.dumps(record).encode() + b"\n")
+        self.count += 1
+
+    def popleft(self):
+        self.file.seek(self.read_offset)
+        line = self.file.readline()
+        self.read_offset = self.file.tell()
+        self.count -= 1
+        if self.count == 0:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_offset = 0
+        event_name, data, event_id, enqueued_at = json.loads(line)
+        event = sseclient.Event(data=data, event=event_name, id=event_id)
+        return event, dict(json.loads(data)), enqueued_at
+
+
+class StageTimer:
+    """Running count, mean and max of a pipeline stage latency in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def stats(self):
+        mean = self.total / self.count if self.count else 0.0
+        return dict(count=self.count, mean=mean, max=self.max)
@@ -0,0 +1,257 @@
+import time
+import random
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from apscheduler.schedulers.background import BackgroundScheduler
+
+phlog = logging.getLogger("particle-hub.polling")
+
+# Particle allows roughly 10,000 API calls per 5 minutes per client
+DEFAULT_RATE = 30.0
+DEFAULT_BURST = 30
+
+
+class TokenBucket:
+    """Thread safe token bucket rate limiter."""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        """
+            rate (float):    tokens added per second
+            burst (int):     bucket capacity
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Blocks until the requested number of tokens is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AccountLimiter:
+    """Thread safe limit on the requests in flight with each cloud API token."""
+
+    def __init__(self, concurrency=8):
+        """
+            concurrency (int):    max in-flight requests per cloud API token
+        """
+        self.concurrency = concurrency
+        self._semaphores = dict()
+        self._lock = threading.Lock()
+
+    def limit(self, cloud_api_token):
+        """:return: (BoundedSemaphore) held around a request made with cloud_api_token"""
+        with self._lock:
+            if cloud_api_token not in self._semaphores:
+                self._semaphores[cloud_api_token] = threading.BoundedSemaphore(self.concurrency)
+            return self._semaphores[cloud_api_token]
+
+
+class PollResult:
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.values = dict()
+        self.errors = dict()
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def to_dict(self):
+        return dict(device_id=self.device_id, values=self.values, errors=self.errors, elapsed=self.elapsed)
+
+
+class VariablePoller:
+    """
+    Fetches variables for many devices concurrently over the shared HTTP session, limited per account and by
+    a token bucket shared by every request.
+    """
+
+    def __init__(self, max_workers=16, account_concurrency=8, rate=DEFAULT_RATE, burst=DEFAULT_BURST, timeout=10.0):
+        """
+            max_workers (int):            size of the request thread pool
+            account_concurrency (int):    max in-flight requests per cloud API token
+            rate (float), burst (int):    token bucket settings for all requests
+            timeout (float):              seconds to wait for each request, so a stuck request cannot hold a
+                                          worker and an account slot indefinitely
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="PHPollThread")
+        self.account_limiter = AccountLimiter(account_concurrency)
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(rate, burst)
+
+    def poll(self, devices, variables=None):
+        """
+        Fetches variables for every device in parallel and applies the values to variable_state and tags.
+
+        :param devices: (list) Device objects
+        :param variables: (list) variable names to fetch, defaults to every variable and tag of each device
+
+        :return: (dict) device_id: PollResult
+        """
+        start = time.monotonic()
+        pending = list()
+        results = dict()
+        for device in devices:
+            result = results[device.id] = PollResult(device.id)
+            names = variables if variables is not None else self._device_variables(device)
+            for name in names:
+                pending.append((device, name, result, self.executor.submit(self._fetch, device, name)))
+        for device, name, result, future in pending:
+            try:
+                value = future.result()
+            except Exception as e:
+                result.errors[name] = str(e) or type(e).__name__
+                continue
+            result.values[name] = value
+            if name in device.tags:
+                device.tags[name] = value
+            if device.variables is not None and name in device.variables:
+                device.variable_state[name] = value
+                device.variable_updated[name] = time.monotonic()
+        elapsed = time.monotonic() - start
+        for result in results.values():
+            result.elapsed = elapsed
+        return results
+
+    def poll_device(self, device, variables=None):
+        return self.poll([device], variables)[device.id]
+
+    @staticmethod
+    def _device_variables(device):
+        names = list(device.tags)
+        names.extend(variable for variable in (device.variables or dict()) if variable not in device.tags)
+        return names
+
+    def _fetch(self, device, name):
+        with self.account_limiter.limit(device.cloud_api_token):
+            self.rate_limiter.acquire()
+            return device.fetch_variable(name, timeout=self.timeout)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class PollingService:
+    """
+    APScheduler driven background polling of managed devices. Each device job polls only the variables that
+    are due, skipping those recently refreshed by a stream DATA event, and backs off while a device is offline.
+    Device.online only changes when the device list is reloaded, so once the backoff of an offline device
+    expires it is probed with a single variable, and marked online again when it answers.
+    """
+
+    def __init__(self, hub_manager, default_interval=300, device_intervals=None, variable_intervals=None,
+                 jitter=10, max_backoff=3600):
+        """
+            hub_manager (HubManager):     source of managed devices, poller and result publishing
+            default_interval (float):     seconds between polls of a variable
+            device_intervals (dict):      device_id: seconds, overrides default_interval
+            variable_intervals (dict):    variable name: seconds, overrides device and default intervals
+            jitter (float):               max random seconds added to each job run
+            max_backoff (float):          upper bound on the delay between polls of an offline device
+        """
+        self.hub_manager = hub_manager
+        self.default_interval = default_interval
+        self.device_intervals = device_intervals if device_intervals is not None else dict()
+        self.variable_intervals = variable_intervals if variable_intervals is not None else dict()
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.scheduler = BackgroundScheduler(daemon=True)
+        self.failures = dict()
+        self.next_allowed = dict()
+        self.polls = 0
+        self.skipped = 0
+
+    def start(self):
+        self.scheduler.start()
+        self.sync()
+
+    def stop(self):
+        self.scheduler.shutdown(wait=False)
+
+    def sync(self):
+        """Adds jobs for newly managed devices and removes jobs for devices no longer managed"""
+        managed_ids = set(self.hub_manager.managed_devices.keys())
+        for job in self.scheduler.get_jobs():
+            if job.id not in managed_ids:
+                job.remove()
+        for device_id in managed_ids:
+            if self.scheduler.get_job(device_id) is None:
+                interval = self._job_interval(self.hub_manager.managed_devices[device_id])
+                first_run = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+                    seconds=random.uniform(0, interval))  # Spread the first polls across one interval
+                self.scheduler.add_job(self.poll_device, "interval", args=(device_id,), id=device_id,
+                                       seconds=interval, jitter=self.jitter, next_run_time=first_run,
+                                       coalesce=True, max_instances=1)
+
+    def poll_device(self, device_id):
+        device = self.hub_manager.managed_devices.get(device_id)
+        if device is None:
+            return None
+        now = time.monotonic()
+        if now < self.next_allowed.get(device_id, 0):
+            self.skipped += 1
+            return None
+        if device.online is False and device_id not in self.failures:
+            self._back_off(device, now)
+            return None
+        due = self.due_variables(device, now)
+        if not due:
+            self.skipped += 1
+            return None
+        if device.online is False:
+            due = due[:1]
+        result = self.hub_manager.poller.poll_device(device, due)
+        self.polls += 1
+        if result.values:
+            self.failures.pop(device_id, None)
+            self.next_allowed.pop(device_id, None)
+            device.online = True
+            self.hub_manager.publish_device_data(device, result.values)
+        else:
+            self._back_off(device, now)
+        return result
+
+    def due_variables(self, device, now=None):
+        if now is None:
+            now = time.monotonic()
+        due = list()
+        for variable in device.variables or dict():
+            updated = device.variable_updated.get(variable)
+            if updated is None or now - updated >= self._variable_interval(device, variable):
+                due.append(variable)
+        return due
+
+    def _back_off(self, device, now):
+        failures = self.failures.get(device.id, 0) + 1
+        self.failures[device.id] = failures
+        delay = min(self.max_backoff, self._job_interval(device) * 2 ** failures)
+        self.next_allowed[device.id] = now + delay
+
+    def _variable_interval(self, device, variable):
+        if variable in self.variable_intervals:
+            return self.variable_intervals[variable]
+        return self.device_intervals.get(device.id, self.default_interval)
+
+    def _job_interval(self, device):
+        intervals = [self._variable_interval(device, variable) for variable in device.variables or dict()]
+        return min(intervals, default=self.device_intervals.get(device.id, self.default_interval))
+
+    def stats(self):
+        return dict(jobs=len(self.scheduler.get_jobs()), polls=self.polls, skipped=self.skipped,
+                    backed_off=len(self.failures))
@@ -0,0 +1,155 @@
+"""
+Recorded event format: gzip compressed NDJSON segments, one SSE frame per line
+
+    {"event": "DATA", "data": "{\"data\":\"temp=21.5\",\"ttl\":60,\"published_at\":\"...\",\"coreid\":\"...\"}"}
+
+data is the raw frame payload as received. Exported Particle events, one event object per line with "event" or
+"name" next to data, coreid and published_at, are read as well, compressed or not.
+"""
+
+import os
+import gzip
+import time
+import logging
+import threading
+import simplejson as json
+from particlehub.sharding import ShardFrame
+
+phlog = logging.getLogger("particle-hub.recording")
+
+SEGMENT_SUFFIX = ".ndjson.gz"
+PARTIAL_SUFFIX = ".part"
+EVENT_FILE_SUFFIXES = (".ndjson.gz", ".jsonl.gz", ".json.gz", ".ndjson", ".jsonl", ".json", PARTIAL_SUFFIX)
+
+
+class EventRecorder:
+    """
+    Appends raw SSE frames to compressed NDJSON segments. A segment is written under a ".part" name and renamed
+    once it holds segment_bytes of uncompressed events or the recorder is closed.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 2 ** 20, compresslevel=1):
+        """
+            directory (str):        segment directory, created if missing
+            segment_bytes (int):    uncompressed bytes per segment
+            compresslevel (int):    gzip level, 1 keeps the cost on the stream thread to a few us per event
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.compresslevel = compresslevel
+        self.recorded_events = 0
+        self.recorded_bytes = 0
+        self.segments = 0
+        self._file = None
+        self._path = None
+        self._segment_size = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, event):
+        """
+        :param event: (sseclient.Event) or any object with event and data attributes
+
+        :return: (None)
+        """
+        line = ('{"event":%s,"data":%s}\n' % (json.dumps(event.event), json.dumps(event.data))).encode()
+        with self._lock:
+            if self._file is None:
+                self._open_segment()
+            self._file.write(line)
+            self._segment_size += len(line)
+            self.recorded_events += 1
+            self.recorded_bytes += len(line)
+            if self._segment_size >= self.segment_bytes:
+                self._close_segment()
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+    def stats(self):
+        return dict(recorded_events=self.recorded_events, recorded_bytes=self.recorded_bytes,
+                    segments=self.segments, directory=self.directory)
+
+    def _open_segment(self):
+        name = "events-%s-%06d%s" % (time.strftime("%Y%m%dT%H%M%S", time.gmtime()), self.segments, SEGMENT_SUFFIX)
+        self._path = os.path.join(self.directory, name)
+        self._file = gzip.open(self._path + PARTIAL_SUFFIX, "wb", compresslevel=self.compresslevel)
+        self._segment_size = 0
+        self.segments += 1
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        self._file.close()
+        os.replace(self._path + PARTIAL_SUFFIX, self._path)
+        self._file = None
+
+
+def event_files(paths):
+    """
+    :param paths: (list) files and directories, a directory stands for the event files it contains
+
+    :return: (list) event file paths in name order within each directory
+    """
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.endswith(EVENT_FILE_SUFFIXES))
+        else:
+            files.append(path)
+    return files
+
+
+class EventFileReader:
+    """
+    Streams the frames of recorded or exported event files one line at a time, so memory does not grow with the
+    size of the files. Malformed lines and truncated segments are logged and skipped.
+    """
+
+    def __init__(self, paths):
+        """
+            paths (list):    files and directories, see event_files
+        """
+        self.files = event_files(paths)
+        self.events = 0
+        self.malformed = 0
+
+    def __iter__(self):
+        for path in self.files:
+            opener = gzip.open if _is_gzip(path) else open
+            try:
+                with opener(path, "rb") as event_file:
+                    for line in event_file:
+                        frame = self._frame(line)
+                        if frame is not None:
+                            self.events += 1
+                            yield frame
+            except (EOFError, OSError) as e:  # A segment cut short by a crash keeps the events before the cut
+                phlog.error("Event file %s is truncated or unreadable" % path)
+                phlog.debug(e)
+
+    def _frame(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            record = json.loads(line)
+            event = record.get("event", record.get("name"))
+            if "coreid" in record:  # Exported Particle event object
+                data = json.dumps({key: value for key, value in record.items() if key not in ("event", "name")})
+            else:
+                data = record["data"]
+            if not isinstance(event, str) or not isinstance(data, str):
+                raise ValueError("event and data must be strings")
+            return ShardFrame(event, data)
+        except (ValueError, KeyError, AttributeError) as e:
+            self.malformed += 1
+            phlog.debug(e)
+            return None
+
+
+def _is_gzip(path):
+    with open(path, "rb") as event_file:
+        return event_file.read(2) == b"\x1f\x8b"
@@ -0,0 +1,238 @@
+"""
+Offline replay and bulk import of recorded or exported Particle events.
+
+    python -m particlehub.replay record DIR [--segment-mb N]
+    python -m particlehub.replay replay PATH [PATH ...] [--dry-run] [--shift SECONDS | --rebase TIME]
+                                                      [--workers N] [--all-devices]
+
+Both use the configuration named by PHCONFIG_FILE: record subscribes to stream_config["url"], replay logs to the
+default log database with the managed devices and tags of PHSTATE_FILE.
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import simplejson as json
+from particlehub.pipeline import EventPipeline
+from particlehub.recording import EventRecorder, EventFileReader
+from particlehub.sharding import ShardFrame, extract_coreid, extract_field
+from particlehub.timeseries import parse_timestamp_ns, format_timestamp_ns
+
+
+class EventReplayer:
+    """
+    Replays event files through a StreamManager's _handle_msg, so events are parsed, deduplicated, handled and
+    logged exactly like live ones. Files are streamed line by line and events fan out to worker threads by
+    device, keeping the order of each device's events, through bounded queues. The reader also waits for the
+    log database writer to keep up, so memory stays flat however long the recording is.
+    """
+
+    def __init__(self, stream_manager, workers=4, max_queue_size=10000, time_offset=0, rebase_to=None,
+                 dry_run=False, add_devices=False, chunk_size=5000):
+        """
+            stream_manager (StreamManager):    handles the events, normally one that is not streaming
+            workers (int):                     handler threads
+            max_queue_size (int):              pending events per worker before the reader blocks
+            time_offset (int):                 nanoseconds added to every published_at
+            rebase_to (int):                   epoch nanoseconds the first event read is moved to, overrides
+                                               time_offset
+            dry_run (bool):                    read and count the events without handling them
+            add_devices (bool):                handle events of devices that are not managed, without tags
+            chunk_size (int):                  events read between checks of the log writer queue
+        """
+        self.stream_manager = stream_manager
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.time_offset = time_offset
+        self.rebase_to = rebase_to
+        self.dry_run = dry_run
+        self.add_devices = add_devices
+        self.chunk_size = chunk_size
+        self.reader = None
+        self.pipeline = None
+        self.replayed = 0
+        self.skipped = 0
+        self.devices = set()
+        self.first_published = None
+        self.last_published = None
+        self.started = None
+        self.finished = None
+        self._stop_event = threading.Event()
+
+    def run(self, paths):
+        """
+        Replays every event of paths and waits until they are handled and written
+
+        :param paths: (list) event files and directories of event files
+
+        :return: (dict) stats
+        """
+        self.started = time.monotonic()
+        self.reader = EventFileReader(paths)
+        writer = None if self.dry_run else self._log_writer()
+        if not self.dry_run:
+            self.pipeline = EventPipeline(self._handle, workers=self.workers, max_queue_size=self.max_queue_size)
+            self.pipeline.start()
+        try:
+            for frame in self.reader:
+                if self._stop_event.is_set():
+                    break
+                self._submit(frame)
+                if writer is not None and self.reader.events % self.chunk_size == 0:
+                    writer.wait_for_capacity()
+        finally:
+            if self.pipeline is not None:
+                self.pipeline.close()
+            if writer is not None:
+                writer.flush()
+            self.finished = time.monotonic()
+        return self.stats()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _submit(self, frame):
+        coreid = extract_coreid(frame.data)
+        managed_devices = self.stream_manager.managed_devices
+        if frame.event not in self.stream_manager.subscribed_events or coreid is None:
+            self.skipped += 1
+            return
+        if coreid not in managed_devices:
+            if not self.add_devices:
+                self.skipped += 1
+                return
+            if not self.dry_run:
+                from particlehub.models import Device
+                managed_devices[coreid] = Device(coreid, None)
+        published_at = extract_field(frame.data, "published_at")
+        if published_at is not None:
+            frame = self._retime(frame, parse_timestamp_ns(published_at))
+        self.devices.add(coreid)
+        self.replayed += 1
+        if not self.dry_run:
+            self.pipeline.submit(coreid, frame, None)
+
+    def _retime(self, frame, published):
+        if self.first_published is None:
+            self.first_published = self.last_published = published
+            if self.rebase_to is not None:
+                self.time_offset = self.rebase_to - published
+        self.first_published = min(self.first_published, published)
+        self.last_published = max(self.last_published, published)
+        if not self.time_offset:
+            return frame
+        event_data = json.loads(frame.data)
+        event_data['published_at'] = format_timestamp_ns(published + self.time_offset)
+        return ShardFrame(frame.event, json.dumps(event_data))
+
+    def _handle(self, frame, event_data):
+        self.stream_manager._handle_msg(frame)
+
+    def _log_writer(self):
+        from particlehub.models import _log_to_influx, get_influx_writer
+        if self.stream_manager.log_function is _log_to_influx:
+            return get_influx_writer(self.stream_manager.log_credentials)
+        return None
+
+    def stats(self):
+        end = self.finished if self.finished is not None else time.monotonic()
+        elapsed = end - self.started if self.started is not None else 0.0
+        stats = dict(dry_run=self.dry_run, running=self.started is not None and self.finished is None,
+                     events=self.reader.events if self.reader is not None else 0,
+                     malformed=self.reader.malformed if self.reader is not None else 0,
+                     replayed=self.replayed, skipped=self.skipped, devices=len(self.devices), elapsed=elapsed,
+                     events_per_second=self.replayed / elapsed if elapsed else 0.0,
+                     time_offset=self.time_offset, first_published_at=None, last_published_at=None)
+        if self.first_published is not None:
+            stats["first_published_at"] = format_timestamp_ns(self.first_published)
+            stats["last_published_at"] = format_timestamp_ns(self.last_published)
+        if self.pipeline is not None:
+            stats["queue_depth"] = self.pipeline.queue_depth
+        return stats
+
+
+def replay_stream_manager(stream_config, log_dest, log_credentials, device_tags):
+    """
+    Builds a StreamManager that only handles replayed events, apart from the live hub's devices and listeners
+
+    :param stream_config: (dict) the hub's stream configuration, its dedup options are kept
+    :param device_tags: (dict) device_id: tags of the devices to replay
+
+    :return: (StreamManager)
+    """
+    from particlehub.models import StreamManager, Device
+    managed_devices = {device_id: Device(device_id, None, tags=dict(tags)) for device_id, tags in device_tags.items()}
+    replay_config = dict(url=stream_config["url"], handler_workers=0, dedup=stream_config.get("dedup", dict()))
+    return StreamManager(replay_config, [], log_dest, log_credentials, managed_devices=managed_devices)
+
+
+###################################################################################################
+# Command Line
+
+def _parse_time(value):
+    if value == "now":
+        return time.time_ns()
+    return parse_timestamp_ns(value)
+
+
+def _state_device_tags():
+    from particlehub.state import open_state_store
+    if "PHSTATE_FILE" not in os.environ:
+        return dict()
+    state_store = open_state_store(os.environ["PHSTATE_FILE"], os.environ.get("PHSTATE_BACKEND", "sqlite"))
+    state = state_store.load() or dict(managed_device_ids=list(), tags=dict())
+    state_store.close()
+    return {device_id: state["tags"].get(device_id, dict()) for device_id in state["managed_device_ids"]}
+
+
+def record(phconfig, directory, segment_bytes):
+    from particlehub.stream_supervisor import StreamSupervisor
+    recorder = EventRecorder(directory, segment_bytes=segment_bytes)
+    supervisor = StreamSupervisor(phconfig.stream_config["url"], recorder.record,
+                                  headers=phconfig.stream_config.get("headers"))
+    supervisor.start()
+    try:
+        while True:
+            time.sleep(10)
+            print("%(recorded_events)d events, %(segments)d segments" % recorder.stats(), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop(timeout=1)
+        recorder.close()
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="record the raw event stream to compressed NDJSON segments")
+    record_parser.add_argument("directory")
+    record_parser.add_argument("--segment-mb", type=float, default=64, help="uncompressed MB per segment")
+    replay_parser = commands.add_parser("replay", help="replay event files to the log database")
+    replay_parser.add_argument("paths", nargs="+", help="event files or directories")
+    replay_parser.add_argument("--dry-run", action="store_true", help="count the events without handling them")
+    replay_parser.add_argument("--shift", type=float, default=0, help="seconds added to every published_at")
+    replay_parser.add_argument("--rebase", type=_parse_time, help='move the first event to this time or "now"')
+    replay_parser.add_argument("--workers", type=int, default=4)
+    replay_parser.add_argument("--all-devices", action="store_true", help="also replay unmanaged devices")
+    args = arg_parser.parse_args(argv)
+
+    from particlehub.particlehub_app import load_config
+    phconfig = load_config()
+    if args.command == "record":
+        record(phconfig, args.directory, int(args.segment_mb * 2 ** 20))
+        return 0
+    log_dest = phconfig.default_log_source
+    stream_manager = replay_stream_manager(phconfig.stream_config, log_dest, phconfig.log_config[log_dest],
+                                           _state_device_tags())
+    replayer = EventReplayer(stream_manager, workers=args.workers,
+                             time_offset=int(args.shift * 1e9), rebase_to=args.rebase, dry_run=args.dry_run,
+                             add_devices=args.all_devices)
+    print(json.dumps(replayer.run(args.paths), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
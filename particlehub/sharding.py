@@ -0,0 +1,245 @@
+import os
+import zlib
+import bisect
+import logging
+import threading
+import collections
+import multiprocessing
+
+phlog = logging.getLogger("particle-hub.sharding")
+
+ShardFrame = collections.namedtuple("ShardFrame", ["event", "data"])  # The sseclient.Event fields handlers use
+
+
+###################################################################################################
+# Sharded Ingestion
+
+class HashRing:
+    """Consistent hash of device ids onto shard numbers, so resizing the pool moves few devices"""
+
+    def __init__(self, shards, replicas=64):
+        self.shards = shards
+        points = sorted((zlib.crc32(("%d-%d" % (shard, replica)).encode()), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._shards = [point[1] for point in points]
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._hashes, zlib.crc32(key.encode())) % len(self._hashes)
+        return self._shards[index]
+
+
+def extract_coreid(data):
+    """
+    Finds the coreid of a raw Particle event without decoding the whole JSON document
+
+    :param data: (str) event data
+    :return: (str) or None
+    """
+    return extract_field(data, "coreid")
+
+
+def extract_field(data, field):
+    """
+    Finds a top level string field of a raw Particle event without decoding the whole JSON document
+
+    :param data: (str) event data
+    :param field: (str) e.g. coreid or published_at
+    :return: (str) or None
+    """
+    key = data.find('"%s"' % field)
+    if key < 0:
+        return None
+    start = data.find('"', data.find(':', key + len(field) + 2) + 1)
+    end = data.find('"', start + 1)
+    if start < 0 or end < 0:
+        return None
+    return data[start + 1:end]
+
+
+class ShardedIngestion:
+    """
+    Spreads event handling over worker processes. Raw frames are routed by the consistent hash of their coreid
+    and sent to each shard in batches over a pipe. Every shard parses, handles and logs its events with its own
+    StreamManager and database writer, and sends the parsed samples back so the hub keeps its live state.
+    """
+
+    def __init__(self, workers, stream_config, log_dest, shard_log_credentials, on_samples, batch_size=500,
+                 flush_interval=0.05):
+        """
+            workers (int):                  number of shard processes
+            stream_config (dict):           passed to the StreamManager of each shard
+            log_dest (str):                 key of models.log_functions
+            shard_log_credentials (list):   log credentials of each shard
+            on_samples (func):              on_samples(samples) with a list of (device_id, values, timestamp_ns)
+            batch_size (int):               frames sent per pipe write
+            flush_interval (float):         max seconds a frame waits for its batch to fill
+        """
+        self.workers = workers
+        self.stream_config = stream_config
+        self.log_dest = log_dest
+        self.shard_log_credentials = shard_log_credentials
+        self.on_samples = on_samples
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ring = HashRing(workers)
+        self.assignments = [dict() for _ in range(workers)]  # device_id: tags of each shard
+        self.frames = [0] * workers
+        self.restarts = [0] * workers
+        self._context = multiprocessing.get_context("spawn")  # Forking a threaded process is unsafe
+        self._processes = [None] * workers
+        self._frame_connections = [None] * workers
+        self._batches = [list() for _ in range(workers)]
+        self._locks = [threading.Lock() for _ in range(workers)]
+        self._stop_event = threading.Event()
+        self._flush_thread = threading.Thread(target=self._run_flush, name="PHShardFlushThread", daemon=True)
+
+    def start(self):
+        for shard in range(self.workers):
+            self._start_shard(shard)
+        self._flush_thread.start()
+
+    def stop(self, timeout=5):
+        self._stop_event.set()
+        for shard in range(self.workers):
+            with self._locks[shard]:
+                self._flush(shard)
+                self._send(shard, ("stop", None), restart=False)
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()
+
+    def assign(self, devices):
+        """
+        Rebalances the managed devices over the shards, sending each shard whose devices or tags changed
+        its new assignment
+
+        :param devices: (dict) device_id: Device
+        """
+        assignments = [dict() for _ in range(self.workers)]
+        for device_id, device in devices.items():
+            assignments[self.ring.shard_for(device_id)][device_id] = dict(device.tags)
+        for shard, assignment in enumerate(assignments):
+            if assignment != self.assignments[shard]:
+                self.assignments[shard] = assignment
+                with self._locks[shard]:
+                    self._flush(shard)
+                    self._send(shard, ("devices", assignment))
+
+    def submit(self, coreid, event, data):
+        """Queues one raw frame on the shard owning coreid"""
+        shard = self.ring.shard_for(coreid)
+        with self._locks[shard]:
+            batch = self._batches[shard]
+            batch.append((event, data))
+            if len(batch) >= self.batch_size:
+                self._flush(shard)
+
+    def stats(self):
+        return dict(shards=self.workers, shard_frames=list(self.frames), shard_restarts=list(self.restarts),
+                    shard_devices=[len(assignment) for assignment in self.assignments])
+
+    def _run_flush(self):
+        while not self._stop_event.wait(self.flush_interval):
+            for shard in range(self.workers):
+                with self._locks[shard]:
+                    self._flush(shard)
+
+    def _flush(self, shard):
+        """Sends the pending batch of a shard, the caller holds its lock"""
+        batch = self._batches[shard]
+        if batch:
+            self._batches[shard] = list()
+            self.frames[shard] += len(batch)
+            self._send(shard, ("frames", batch))
+
+    def _send(self, shard, message, restart=True):
+        if self._frame_connections[shard] is None:  # Not started, the assignment is sent on start
+            return
+        try:
+            self._frame_connections[shard].send(message)
+        except (OSError, ValueError) as e:
+            if not restart:
+                return
+            phlog.error("Shard %d is gone, restarting it" % shard)
+            phlog.debug(e)
+            self.restarts[shard] += 1
+            self._start_shard(shard)
+
+    def _start_shard(self, shard):
+        frames_reader, frames_writer = self._context.Pipe(duplex=False)
+        samples_reader, samples_writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_shard_main, name="PHShard-%d" % shard, daemon=True,
+                                        args=(frames_reader, samples_writer, self.stream_config, self.log_dest,
+                                              self.shard_log_credentials[shard]))
+        process.start()
+        frames_reader.close()
+        samples_writer.close()
+        self._processes[shard] = process
+        self._frame_connections[shard] = frames_writer
+        frames_writer.send(("devices", self.assignments[shard]))
+        threading.Thread(target=self._receive_samples, args=(samples_reader,),
+                         name="PHShardSamplesThread-%d" % shard, daemon=True).start()
+
+    def _receive_samples(self, connection):
+        while True:
+            try:
+                samples = connection.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                self.on_samples(samples)
+            except Exception as e:
+                phlog.error("Applying shard samples failed")
+                phlog.debug(e)
+
+
+class _SampleCollector:
+    """Stands in for the TimeSeriesCache of a shard's StreamManager, gathering samples to return to the hub"""
+
+    def __init__(self):
+        self.samples = list()
+
+    def record(self, device_id, values, timestamp):
+        self.samples.append((device_id, {variable: value for variable, value in values.items()
+                                         if variable != 'timestamp'}, timestamp))
+
+    def drain(self):
+        samples, self.samples = self.samples, list()
+        return samples
+
+
+def _shard_main(frames, samples, stream_config, log_dest, log_credentials):
+    """Shard process loop: applies device assignments and handles batches of frames until told to stop"""
+    from particlehub.models import StreamManager, Device, close_influx_writers
+    collector = _SampleCollector()
+    stream_config = dict(stream_config, handler_workers=0, engine="thread", shards=0, record=None)
+    stream_manager = StreamManager(stream_config, [], log_dest, log_credentials, managed_devices=dict(),
+                                   timeseries=collector)
+    while True:
+        try:
+            kind, payload = frames.recv()
+        except (EOFError, OSError):
+            break
+        if kind == "frames":
+            for event, data in payload:
+                try:
+                    stream_manager._handle_msg(ShardFrame(event, data))
+                except Exception as e:
+                    phlog.error("Shard process %d failed to handle an event" % os.getpid())
+                    phlog.debug(e)
+            if collector.samples:
+                samples.send(collector.drain())
+        elif kind == "devices":
+            managed_devices = dict()
+            for device_id, tags in payload.items():
+                device = stream_manager.managed_devices.get(device_id) or Device(device_id, None)
+                device.tags = tags
+                managed_devices[device_id] = device
+            stream_manager.managed_devices = managed_devices
+        elif kind == "stop":
+            break
+    close_influx_writers()
+    samples.close()
@@ -0,0 +1,217 @@
+import os
+import mmap
+import zlib
+import fcntl
+import struct
+import logging
+import threading
+import simplejson as json
+
+phlog = logging.getLogger("particle-hub.spool")
+
+RECORD_HEADER = struct.Struct("<II")  # payload length, payload crc32
+SEGMENT_TEMPLATE = "segment-%012d.log"
+CHECKPOINT_FILE = "checkpoint"
+
+
+class PointSpool:
+    """
+    Append only, segment rotated write ahead log of database points that could not be written. Each record is
+    one JSON encoded batch framed by its length and crc32. Replay reads records through a memory map starting at
+    the last committed checkpoint, which is replaced atomically so a crash never loses or corrupts pending data.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 2 ** 20, max_bytes=512 * 2 ** 20):
+        """
+            directory (str):        spool location, created if missing
+            segment_bytes (int):    size at which a new segment file is started
+            max_bytes (int):        total spool size cap, the oldest segments are discarded beyond it
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            fcntl.flock(self._directory_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)  # One writer process per spool
+        except OSError:
+            os.close(self._directory_fd)
+            raise SpoolLockedError(directory)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.dropped_segments = 0
+        self.dropped_bytes = 0
+        self._lock = threading.Lock()
+        self.segments = sorted(int(name[8:20]) for name in os.listdir(directory)
+                               if name.startswith("segment-") and name.endswith(".log"))
+        self.read_segment, self.read_offset = self._load_checkpoint()
+        for sequence in [sequence for sequence in self.segments if sequence < self.read_segment]:
+            self._delete_segment(sequence)
+        if not self.segments:
+            self.segments.append(max(self.read_segment, 0))
+        if self.read_segment not in self.segments:
+            self.read_segment, self.read_offset = self.segments[0], 0
+        self._recover_tail()
+        self._writer = open(self._path(self.segments[-1]), "ab")
+
+    def append(self, points):
+        """
+        Durably appends one batch of points
+
+        :param points: (list) point dicts
+
+        :return: (None)
+        """
+        payload = json.dumps(points).encode()
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._writer.tell() > 0 and self._writer.tell() + len(record) > self.segment_bytes:
+                self._rotate()
+            self._writer.write(record)
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._enforce_cap()
+
+    def read_batch(self, max_points):
+        """
+        Reads whole records from the checkpoint onwards without consuming them.
+
+        :param max_points: (int) stop before a record that would exceed this many points
+
+        :return: (tuple) (list of points, position to pass to commit)
+        """
+        with self._lock:
+            sequence, offset = self.read_segment, self.read_offset
+            points = list()
+            while sequence in self.segments:
+                size = os.path.getsize(self._path(sequence))
+                if offset < size:
+                    offset, complete = self._read_records(sequence, offset, size, points, max_points)
+                    if not complete:
+                        break
+                if sequence == self.segments[-1]:
+                    break
+                sequence, offset = self.segments[self.segments.index(sequence) + 1], 0
+            return points, (sequence, offset)
+
+    def commit(self, position):
+        """
+        Marks everything before position as written and deletes fully consumed segments
+
+        :param position: (tuple) from read_batch
+
+        :return: (None)
+        """
+        with self._lock:
+            self.read_segment, self.read_offset = position
+            self._write_checkpoint()
+            for sequence in [sequence for sequence in self.segments if sequence < self.read_segment]:
+                self._delete_segment(sequence)
+
+    def has_pending(self):
+        with self._lock:
+            return (self.read_segment != self.segments[-1] or
+                    self.read_offset < os.path.getsize(self._path(self.segments[-1])))
+
+    @property
+    def pending_bytes(self):
+        with self._lock:
+            total = sum(os.path.getsize(self._path(sequence)) for sequence in self.segments)
+            return total - self.read_offset
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+            os.close(self._directory_fd)
+
+    def stats(self):
+        return dict(pending_bytes=self.pending_bytes, segments=len(self.segments),
+                    dropped_segments=self.dropped_segments, dropped_bytes=self.dropped_bytes)
+
+    def _read_records(self, sequence, offset, size, points, max_points):
+        """Returns the offset reached and whether the segment was read to its end"""
+        with open(self._path(sequence), "rb") as segment, \
+                mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            while offset + RECORD_HEADER.size <= size:
+                length, crc = RECORD_HEADER.unpack_from(view, offset)
+                start = offset + RECORD_HEADER.size
+                payload = view[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    phlog.error("Spool segment %d is corrupt at offset %d, skipping the rest" % (sequence, offset))
+                    return size, True
+                record = json.loads(payload)
+                if points and len(points) + len(record) > max_points:
+                    return offset, False
+                points.extend(record)
+                offset = start + length
+        return offset, True
+
+    def _recover_tail(self):
+        """Truncates a record left half written by a crash at the end of the newest segment"""
+        path = self._path(self.segments[-1])
+        if not os.path.exists(path):
+            open(path, "wb").close()
+            return
+        size = os.path.getsize(path)
+        offset = 0
+        if size:
+            with open(path, "rb") as segment, mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                while offset + RECORD_HEADER.size <= size:
+                    length, crc = RECORD_HEADER.unpack_from(view, offset)
+                    start = offset + RECORD_HEADER.size
+                    if start + length > size or zlib.crc32(view[start:start + length]) != crc:
+                        break
+                    offset = start + length
+        if offset < size:
+            phlog.warning("Truncating incomplete spool record in segment %d" % self.segments[-1])
+            with open(path, "r+b") as segment:
+                segment.truncate(offset)
+
+    def _rotate(self):
+        self._writer.close()
+        self.segments.append(self.segments[-1] + 1)
+        self._writer = open(self._path(self.segments[-1]), "ab")
+
+    def _enforce_cap(self):
+        total = sum(os.path.getsize(self._path(sequence)) for sequence in self.segments)
+        while total > self.max_bytes and len(self.segments) > 1:
+            oldest = self.segments[0]
+            size = os.path.getsize(self._path(oldest))
+            phlog.error("Spool size cap reached, discarding segment %d" % oldest)
+            self._delete_segment(oldest)
+            self.dropped_segments += 1
+            self.dropped_bytes += size
+            total -= size
+            if self.read_segment == oldest:
+                self.read_segment, self.read_offset = self.segments[0], 0
+                self._write_checkpoint()
+
+    def _delete_segment(self, sequence):
+        try:
+            os.remove(self._path(sequence))
+        except FileNotFoundError:
+            pass
+        if sequence in self.segments:
+            self.segments.remove(sequence)
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as checkpoint:
+                sequence, offset = json.load(checkpoint)
+                return sequence, offset
+        except (FileNotFoundError, ValueError):
+            return (self.segments[0] if self.segments else 0), 0
+
+    def _write_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as checkpoint:
+            json.dump([self.read_segment, self.read_offset], checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _path(self, sequence):
+        return os.path.join(self.directory, SEGMENT_TEMPLATE % sequence)
+
+
+class SpoolLockedError(Exception):
+    """The spool directory is owned by another process"""
+    pass
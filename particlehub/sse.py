@@ -0,0 +1,72 @@
+"""
+Server-sent event building blocks shared by the thread (StreamSupervisor) and asyncio (AsyncStreamEngine) stream
+engines: request headers, incremental frame parsing and reconnect backoff.
+"""
+
+import codecs
+import random
+import sseclient
+
+
+class StreamHTTPError(Exception):
+    pass
+
+
+def request_headers(headers=None, last_event_id=None):
+    """
+    :param headers: (dict) extra request headers
+    :param last_event_id: (str) resume point, None for a new stream
+
+    :return: (dict) headers of an event stream request
+    """
+    request = {"Accept": "text/event-stream", "Cache-Control": "no-cache"}
+    request.update(headers or dict())
+    if last_event_id:
+        request["Last-Event-ID"] = last_event_id
+    return request
+
+
+class SSEFrameParser:
+    """
+    Splits the body of an event stream into events. Chunks may end anywhere, inside a frame or a UTF-8 sequence,
+    the rest is kept for the next chunk. Comments and keepalives, frames without data, are not returned.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")  # SSE is always UTF-8
+
+    def feed(self, chunk):
+        """
+        :param chunk: (bytes)
+
+        :return: (list) sseclient.Event objects completed by chunk
+        """
+        self.buffer += self.decoder.decode(chunk)
+        events = list()
+        while True:
+            parts = sseclient.end_of_field.split(self.buffer, maxsplit=1)
+            if len(parts) == 1:
+                return events
+            event_string, self.buffer = parts
+            event = sseclient.Event.parse(event_string)
+            if event.data != "":
+                events.append(event)
+
+
+class Backoff:
+    """Jittered exponential reconnect delays: uniform between 0 and base * 2 ** failed attempts, up to maximum"""
+
+    def __init__(self, base=1.0, maximum=60.0):
+        self.base = base
+        self.maximum = maximum
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def next_delay(self):
+        """:return: (float) seconds to wait before the next attempt"""
+        delay = random.uniform(0, min(self.maximum, self.base * 2 ** self.attempt))
+        self.attempt += 1
+        return delay
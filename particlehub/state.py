@@ -0,0 +1,310 @@
+import os
+import pickle
+import sqlite3
+import logging
+import threading
+import contextlib
+import simplejson as json
+
+phlog = logging.getLogger("particle-hub.state")
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+###################################################################################################
+# State Stores
+
+class StateStore:
+    """
+    Persistence interface for hub state: which devices are managed and the tags of each device.
+    """
+
+    def load(self):
+        """
+        :return: (dict) managed_device_ids (list), tags (dict of device_id: tags), or None if empty
+        """
+        raise NotImplementedError
+
+    def save(self, data):
+        """Replaces the whole state with data in the format returned by load"""
+        raise NotImplementedError
+
+    def set_managed(self, device_ids, managed=True):
+        raise NotImplementedError
+
+    def set_tags(self, device_id, tags):
+        raise NotImplementedError
+
+    def version(self):
+        """
+        :return: value that changes when another process commits a change, or None if changes are not visible
+        """
+        return None
+
+    def load_device_snapshot(self):
+        """:return: (list) device dicts saved by save_device_snapshot, or None"""
+        return None
+
+    def save_device_snapshot(self, device_list):
+        """Keeps the last cloud device list so a restarted hub can serve it before the cloud answers"""
+        pass
+
+    def publish_updates(self, updates):
+        """
+        Appends a batch of live updates for the other processes, see particlehub.live.LiveUpdateRelay
+
+        :param updates: (dict) JSON friendly batch
+
+        :return: cursor of the batch, None if updates are not shared
+        """
+        return None
+
+    def load_updates(self, after=None):
+        """
+        :param after: cursor returned by a previous call or by publish_updates, None for every retained batch
+
+        :return: (tuple) (cursor, list of batches published after the given cursor)
+        """
+        return after, list()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Groups several updates into a single write"""
+        yield self
+
+    def close(self):
+        pass
+
+
+class SQLiteStateStore(StateStore):
+    """
+    One row per device in a SQLite database. Every update is an atomic transaction, and updates made inside
+    batch() are committed together. Live update batches are kept in a table trimmed to the newest
+    retained_updates rows. Device changes also bump a counter row read by version(), so the live update
+    commits do not make other processes reload the devices.
+    """
+
+    def __init__(self, path, legacy_pickle=None, retained_updates=30):
+        """
+            path (str):                 database file
+            legacy_pickle (str):        pickle state file imported once when the database is empty
+            retained_updates (int):     live update batches kept for processes that read them late
+        """
+        self.path = path
+        self.retained_updates = retained_updates
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS devices (device_id TEXT PRIMARY KEY, "
+                                "managed INTEGER NOT NULL DEFAULT 0, tags TEXT NOT NULL DEFAULT '{}')")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS device_snapshot (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                                "devices TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS live_updates (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                "updates TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state_version (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                                "version INTEGER NOT NULL)")
+        self.connection.execute("INSERT OR IGNORE INTO state_version (id, version) VALUES (0, 0)")
+        if legacy_pickle is not None and os.path.exists(legacy_pickle):
+            self._migrate_pickle(legacy_pickle)
+
+    def load(self):
+        with self._lock:
+            rows = self.connection.execute("SELECT device_id, managed, tags FROM devices").fetchall()
+        if not rows:
+            return None
+        return dict(managed_device_ids=[device_id for device_id, managed, _ in rows if managed],
+                    tags={device_id: json.loads(tags) for device_id, _, tags in rows})
+
+    def save(self, data):
+        with self.batch():
+            self.connection.execute("DELETE FROM devices")
+            managed = set(data['managed_device_ids'])
+            device_ids = set(data['tags']) | managed
+            self.connection.executemany(
+                "INSERT INTO devices (device_id, managed, tags) VALUES (?, ?, ?)",
+                [(device_id, device_id in managed, json.dumps(data['tags'].get(device_id, dict())))
+                 for device_id in device_ids])
+            self._bump_version()
+
+    def set_managed(self, device_ids, managed=True):
+        with self.batch():
+            self.connection.executemany(
+                "INSERT INTO devices (device_id, managed) VALUES (?, ?) "
+                "ON CONFLICT(device_id) DO UPDATE SET managed=excluded.managed",
+                [(device_id, int(managed)) for device_id in device_ids])
+            self._bump_version()
+
+    def set_tags(self, device_id, tags):
+        with self.batch():
+            self.connection.execute(
+                "INSERT INTO devices (device_id, tags) VALUES (?, ?) "
+                "ON CONFLICT(device_id) DO UPDATE SET tags=excluded.tags", (device_id, json.dumps(tags)))
+            self._bump_version()
+
+    def version(self):
+        with self._lock:
+            return self.connection.execute("SELECT version FROM state_version").fetchone()[0]
+
+    def _bump_version(self):
+        self.connection.execute("UPDATE state_version SET version = version + 1")
+
+    def load_device_snapshot(self):
+        with self._lock:
+            row = self.connection.execute("SELECT devices FROM device_snapshot").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save_device_snapshot(self, device_list):
+        with self.batch():
+            self.connection.execute("INSERT OR REPLACE INTO device_snapshot (id, devices) VALUES (0, ?)",
+                                    (json.dumps(device_list),))
+
+    def publish_updates(self, updates):
+        with self.batch():
+            seq = self.connection.execute("INSERT INTO live_updates (updates) VALUES (?)",
+                                          (json.dumps(updates),)).lastrowid
+            self.connection.execute("DELETE FROM live_updates WHERE seq <= ?", (seq - self.retained_updates,))
+        return seq
+
+    def load_updates(self, after=None):
+        with self._lock:
+            rows = self.connection.execute("SELECT seq, updates FROM live_updates WHERE seq > ? ORDER BY seq",
+                                           (after or 0,)).fetchall()
+        if not rows:
+            return after, list()
+        return rows[-1][0], [json.loads(updates) for _, updates in rows]
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self._lock:
+            if self._batch_depth == 0:
+                self.connection.execute("BEGIN IMMEDIATE")
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.connection.execute("ROLLBACK")
+                raise
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.connection.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def _migrate_pickle(self, legacy_pickle):
+        with self._lock:
+            if self.connection.execute("SELECT COUNT(*) FROM devices").fetchone()[0]:
+                return
+            with open(legacy_pickle, 'rb') as state_file:
+                data = pickle.load(state_file)
+            self.save(data)
+        os.replace(legacy_pickle, legacy_pickle + ".migrated")
+        phlog.info("Migrated state from %s" % legacy_pickle)
+
+
+class PickleStateStore(StateStore):
+    """The original single file pickle persistence, rewritten on every change."""
+
+    def __init__(self, path):
+        self.path = path
+        self._data = self.load() or dict(managed_device_ids=list(), tags=dict())
+        self._batch_depth = 0
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as state_file:
+                self._data = pickle.load(state_file)  # Picks up changes written by other processes
+                return self._data
+        return None
+
+    def save(self, data):
+        self._data = data
+        self._write()
+
+    def version(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load_device_snapshot(self):
+        try:
+            with open(self.path + ".devices", 'rb') as snapshot_file:
+                return pickle.load(snapshot_file)
+        except FileNotFoundError:
+            return None
+
+    def save_device_snapshot(self, device_list):
+        temp_filename = self.path + ".devices.tmp"
+        with open(temp_filename, 'wb') as snapshot_file:
+            pickle.dump(device_list, snapshot_file)
+        os.replace(temp_filename, self.path + ".devices")
+
+    def set_managed(self, device_ids, managed=True):
+        managed_ids = set(self._data['managed_device_ids'])
+        if managed:
+            managed_ids.update(device_ids)
+        else:
+            managed_ids.difference_update(device_ids)
+        self._data['managed_device_ids'] = list(managed_ids)
+        self._write()
+
+    def set_tags(self, device_id, tags):
+        self._data['tags'][device_id] = tags
+        self._write()
+
+    @contextlib.contextmanager
+    def batch(self):
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        self._write()
+
+    def _write(self):
+        if self._batch_depth:
+            return
+        temp_filename = self.path + ".tmp"
+        with open(temp_filename, 'wb') as state_file:
+            pickle.dump(self._data, state_file)
+        os.replace(temp_filename, self.path)
+
+
+state_backends = dict(sqlite=SQLiteStateStore, pickle=PickleStateStore)
+
+
+def open_state_store(path, backend="sqlite"):
+    """
+    Opens the state store for PHSTATE_FILE. With the sqlite backend a ".pkl" path is stored in the matching
+    ".db" file and any other path that holds a pickle in "<path>.db". An existing pickle file is migrated on
+    first use.
+
+    :param path: (str)
+    :param backend: (str) key of state_backends
+
+    :return: (StateStore)
+    """
+    if backend != "sqlite":
+        return state_backends[backend](path)
+    root, extension = os.path.splitext(path)
+    if extension == ".pkl":
+        return SQLiteStateStore(root + ".db", legacy_pickle=path)
+    if os.path.exists(path + ".db") or _is_legacy_pickle(path):  # The database of a migrated pickle
+        return SQLiteStateStore(path + ".db", legacy_pickle=path)
+    return SQLiteStateStore(path, legacy_pickle=root + ".pkl")
+
+
+def _is_legacy_pickle(path):
+    """:return: (bool) True when path is a non-empty file without the SQLite header"""
+    try:
+        with open(path, 'rb') as state_file:
+            header = state_file.read(len(SQLITE_HEADER))
+    except (FileNotFoundError, IsADirectoryError):
+        return False
+    return bool(header) and header != SQLITE_HEADER
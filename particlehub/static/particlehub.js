@@ -3,11 +3,50 @@ $(document).ready(function($){
             headers:
             { 'X-CSRF-TOKEN': $('meta[name="csrf-token"]').attr('content') }
         });
+    $("#device-page-prev").click(function(){
+        update_device_table(device_page - 1);
+    });
+    $("#device-page-next").click(function(){
+        update_device_table(device_page + 1);
+    });
     update_device_table();
+    start_live_updates();
 });
-function update_device_table() {
-  $.get("/get-devices", function(data, status){
+let device_page = 1;
+let live_state = {};
+function start_live_updates() {
+    if (!window.EventSource) {
+        return;
+    }
+    let source = new EventSource("/events");
+    source.addEventListener("devices", function(event){
+        JSON.parse(event.data).forEach(function(device){
+            live_state[device.id] = device;
+        });
+        update_live_values();
+    });
+}
+function update_live_values() {
+    let list = $("#live-values");
+    let device = live_state[list.attr('data-id')];
+    if (device === undefined) {
+        return;
+    }
+    list.empty();
+    $.each(device.variable_state, function(name, value){
+        let item = $('<li class="list-group-item d-flex justify-content-between align-items-center"></li>');
+        item.append($('<span class="font-weight-bold"></span>').text(name + " "));
+        item.append($('<span></span>').text(value));
+        list.append(item);
+    });
+}
+function update_device_table(page) {
+  if (page !== undefined) {
+    device_page = page;
+  }
+  $.get("/get-devices", {"page": device_page}, function(data, status, xhr){
     $('#device-list').html(data);
+    update_device_pager(xhr);
 
     // Attach detail info callbacks to the new rows.
     $(".device-row").click(function () {
@@ -15,6 +54,7 @@ function update_device_table() {
         $.get("/get-device-info", {"id": device_id}, function(_data, _status){
             $("#device-details").html(_data);
             attach_tagging_callbacks();
+            update_live_values();
         });
     });
     // Attach callbacks for add/remove
@@ -33,6 +73,19 @@ function update_device_table() {
     });
   });
 }
+function update_device_pager(xhr) {
+    let total = parseInt(xhr.getResponseHeader('X-Total-Count'));
+    let per_page = parseInt(xhr.getResponseHeader('X-Per-Page'));
+    if (isNaN(total) || isNaN(per_page)) {
+        $("#device-pager").hide();
+        return;
+    }
+    let pages = Math.max(Math.ceil(total / per_page), 1);
+    $("#device-page-label").text(device_page + " / " + pages);
+    $("#device-page-prev").prop("disabled", device_page <= 1);
+    $("#device-page-next").prop("disabled", device_page >= pages);
+    $("#device-pager").toggle(pages > 1);
+}
 function attach_tagging_callbacks(){
     // Attach tagging callbacks to the variable rows
     $(".tag-row").click(function (){
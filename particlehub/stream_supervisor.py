@@ -0,0 +1,156 @@
+import time
+import socket
+import logging
+import threading
+import urllib.parse
+import requests
+from particlehub import metrics
+from particlehub.sse import StreamHTTPError, SSEFrameParser, Backoff, request_headers
+
+phlog = logging.getLogger("particle-hub.stream_supervisor")
+
+
+class StreamSupervisor:
+    """
+    Keeps one SSE connection alive on a background thread. Dropped or idle connections are retried with
+    jittered exponential backoff and resumed from the last received event id, and every reconnect reports the
+    outage to on_gap so the missed data can be polled.
+    """
+
+    def __init__(self, url, on_event, on_gap=None, name=None, headers=None, last_event_id=None, idle_timeout=90.0,
+                 connect_timeout=10.0, backoff_base=1.0, backoff_max=60.0, min_gap=5.0):
+        """
+            url (str):                  SSE endpoint
+            on_event (func):            on_event(sseclient.Event), called on the stream thread
+            on_gap (func):              on_gap(started, ended) with the time.monotonic() of the last event before
+                                        an outage and of the reconnect, called on the stream thread
+            name (str):                 label used in logs and stats
+            headers (dict):             extra request headers
+            last_event_id (str):        resume point for the first connection
+            idle_timeout (float):       seconds without data, keepalives included, before reconnecting
+            connect_timeout (float):    seconds to establish a connection
+            backoff_base (float):       first reconnect delay bound in seconds, doubled per failed attempt
+            backoff_max (float):        upper bound on the reconnect delay
+            min_gap (float):            shorter outages are not reported to on_gap
+        """
+        self.url = url
+        self.on_event = on_event
+        self.on_gap = on_gap
+        self.name = name if name is not None else urllib.parse.urlsplit(url).path
+        self.headers = headers if headers is not None else dict()
+        self.last_event_id = last_event_id
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.min_gap = min_gap
+        self.connected = False
+        self.events = 0
+        self.reconnects = 0
+        self.gaps = 0
+        self.last_event_at = None
+        self._gap_started = None
+        self._response = None
+        self._response_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="PHStreamThread", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1):
+        """Stops reconnecting and interrupts the blocking read of the current connection"""
+        self._stop_event.set()
+        self._interrupt()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stats(self):
+        return dict(connected=self.connected, events=self.events, reconnects=self.reconnects, gaps=self.gaps,
+                    last_event_id=self.last_event_id)
+
+    def _run(self):
+        backoff = Backoff(self.backoff_base, self.backoff_max)
+        while not self._stop_event.is_set():
+            try:
+                for event in self._read_events():
+                    backoff.reset()
+                    self.events += 1
+                    self.last_event_at = time.monotonic()
+                    if event.id:
+                        self.last_event_id = event.id
+                    try:
+                        self.on_event(event)
+                    except Exception as e:
+                        phlog.error("Stream %s event handler raised %s" % (self.name, type(e).__name__))
+                        phlog.debug(e)
+            except (requests.RequestException, OSError, EOFError, StreamHTTPError) as e:
+                if not self._stop_event.is_set():
+                    phlog.warning("Stream %s disconnected: %s" % (self.name, type(e).__name__))
+                    phlog.debug(e)
+            self.connected = False
+            if self._stop_event.is_set():
+                break
+            if self._gap_started is None:
+                self._gap_started = self.last_event_at if self.last_event_at is not None else time.monotonic()
+            self.reconnects += 1
+            if metrics.enabled:
+                metrics.STREAM_RECONNECTS.inc(self.name)
+            self._stop_event.wait(backoff.next_delay())
+
+    def _read_events(self):
+        headers = dict(request_headers(self.headers, self.last_event_id), **{"Accept-Encoding": "identity"})
+        # The read timeout applies to every socket read, so it doubles as the idle watchdog
+        response = requests.get(self.url, headers=headers, stream=True,
+                                timeout=(self.connect_timeout, self.idle_timeout))
+        with self._response_lock:
+            self._response = response
+        if self._stop_event.is_set():  # stop() ran before the response could be interrupted
+            self._interrupt()
+        try:
+            if response.status_code != requests.codes.ok:
+                raise StreamHTTPError("HTTP %d" % response.status_code)
+            self.connected = True
+            if self._gap_started is not None:
+                self._report_gap(self._gap_started)
+                self._gap_started = None
+            parser = SSEFrameParser()
+            for chunk in response.iter_content(chunk_size=None):  # Event streams are chunked, reads return early
+                for event in parser.feed(chunk):
+                    yield event
+            raise EOFError("Stream closed by server")
+        finally:
+            with self._response_lock:
+                self._response = None
+            response.close()
+
+    def _interrupt(self):
+        """Unblocks a read in progress by shutting down the connection's socket"""
+        with self._response_lock:
+            response = self._response
+        if response is None:
+            return
+        sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _report_gap(self, started):
+        ended = time.monotonic()
+        if self.on_gap is None or ended - started < self.min_gap:
+            return
+        self.gaps += 1
+        phlog.warning("Stream %s recovered after %.1f seconds without events" % (self.name, ended - started))
+        try:
+            self.on_gap(started, ended)
+        except Exception as e:
+            phlog.error("Stream %s gap handler raised %s" % (self.name, type(e).__name__))
+            phlog.debug(e)
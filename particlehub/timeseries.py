@@ -0,0 +1,255 @@
+import time
+import array
+import calendar
+import functools
+import threading
+
+NS_PER_SECOND = 1000000000
+
+
+###################################################################################################
+# Recent Telemetry Cache
+
+@functools.lru_cache(maxsize=1024)
+def _seconds_since_epoch(prefix):
+    return calendar.timegm(time.strptime(prefix, "%Y-%m-%dT%H:%M:%S"))
+
+
+def parse_timestamp_ns(published_at):
+    """
+    Converts a Particle "published_at" timestamp, e.g. "2021-03-04T05:06:07.123Z", to epoch nanoseconds
+
+    :param published_at: (str)
+
+    :return: (int)
+    """
+    nanoseconds = _seconds_since_epoch(published_at[:19]) * NS_PER_SECOND
+    fraction = published_at[20:].rstrip("Z") if published_at[19:20] == "." else ""
+    if fraction:
+        nanoseconds += int(fraction[:9].ljust(9, "0"))
+    return nanoseconds
+
+
+def format_timestamp_ns(timestamp):
+    """
+    Converts epoch nanoseconds to a Particle "published_at" timestamp with millisecond precision
+
+    :param timestamp: (int)
+
+    :return: (str)
+    """
+    seconds, nanoseconds = divmod(timestamp, NS_PER_SECOND)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + ".%03dZ" % (nanoseconds // 1000000)
+
+
+class SeriesBuffer:
+    """
+    Ring buffer of up to capacity (timestamp, value) samples for one variable, stored in int64 and float64
+    arrays that start small and double as samples arrive, so rarely updated series stay small. Samples are kept
+    in time order; a sample older than the newest one is not cached.
+    """
+
+    initial_size = 16
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array("q")
+        self.values = array.array("d")
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp, value):
+        """:return: (bool) False if the sample was out of order and not stored"""
+        if self.size and timestamp < self.times[self._index(self.size - 1)]:
+            return False
+        if self.size < self.capacity:
+            if self.size == len(self.times):
+                self._grow()
+            index = self._index(self.size)
+            self.size += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.times[index] = timestamp
+        self.values[index] = value
+        return True
+
+    def trim(self, oldest):
+        """Discards samples with a timestamp before oldest"""
+        drop = self._bisect(oldest)
+        self.start = self._index(drop)
+        self.size -= drop
+
+    def oldest(self):
+        return self.times[self.start] if self.size else None
+
+    def last(self):
+        if not self.size:
+            return None
+        index = self._index(self.size - 1)
+        return self.times[index], self.values[index]
+
+    def range(self, start=None, end=None):
+        """:return: (list) [timestamp, value] pairs with start <= timestamp < end"""
+        first = 0 if start is None else self._bisect(start)
+        stop = self.size if end is None else self._bisect(end)
+        return [[self.times[self._index(i)], self.values[self._index(i)]] for i in range(first, stop)]
+
+    def downsample(self, bucket, start=None, end=None):
+        """
+        Aggregates samples into epoch aligned buckets
+
+        :param bucket: (int) bucket width in nanoseconds
+
+        :return: (list) dicts of time, min, max, mean, count
+        """
+        first = 0 if start is None else self._bisect(start)
+        stop = self.size if end is None else self._bisect(end)
+        buckets = list()
+        for i in range(first, stop):
+            index = self._index(i)
+            bucket_time = self.times[index] - self.times[index] % bucket
+            value = self.values[index]
+            if buckets and buckets[-1]["time"] == bucket_time:
+                current = buckets[-1]
+                current["min"] = min(current["min"], value)
+                current["max"] = max(current["max"], value)
+                current["sum"] += value
+                current["count"] += 1
+            else:
+                buckets.append(dict(time=bucket_time, min=value, max=value, sum=value, count=1))
+        for current in buckets:
+            current["mean"] = current.pop("sum") / current["count"]
+        return buckets
+
+    def _grow(self):
+        """Reallocates the full buffer with twice the room, oldest sample first"""
+        grow_by = min(self.capacity, max(self.initial_size, 2 * len(self.times))) - len(self.times)
+        self.times = self.times[self.start:] + self.times[:self.start]
+        self.values = self.values[self.start:] + self.values[:self.start]
+        self.times.frombytes(bytes(8 * grow_by))
+        self.values.frombytes(bytes(8 * grow_by))
+        self.start = 0
+
+    def _index(self, position):
+        return (self.start + position) % len(self.times)
+
+    def _bisect(self, timestamp):
+        """Position of the first sample at or after timestamp"""
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self._index(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class TimeSeriesCache:
+    """
+    Recent numeric samples of every device variable, bounded both by a time window and by a per series sample
+    count. Reads older than the cached data are completed from the log database through a fallback function.
+    """
+
+    def __init__(self, window=3600, max_samples=3600):
+        """
+            window (float):     seconds of history kept per series
+            max_samples (int):  ring buffer capacity per series, allocated as samples arrive
+        """
+        self.window = int(window * NS_PER_SECOND)
+        self.max_samples = max_samples
+        self.series = dict()  # (device_id, variable): SeriesBuffer
+        self.out_of_order = 0
+        self.on_record = None  # func(device_id, values, timestamp) after each record
+        self._lock = threading.Lock()
+
+    def record(self, device_id, values, timestamp):
+        """
+        Adds one sample per numeric value
+
+        :param device_id: (str)
+        :param values: (dict) variable name: value, non numeric values are ignored
+        :param timestamp: (int) epoch nanoseconds
+
+        :return: (None)
+        """
+        with self._lock:
+            for variable, value in values.items():
+                if isinstance(value, str) or not isinstance(value, (int, float)):
+                    continue
+                series = self.series.get((device_id, variable))
+                if series is None:
+                    series = self.series[(device_id, variable)] = SeriesBuffer(self.max_samples)
+                if not series.append(timestamp, value):
+                    self.out_of_order += 1
+                    continue
+                if timestamp - series.oldest() > self.window:
+                    series.trim(timestamp - self.window)
+        if self.on_record is not None:
+            self.on_record(device_id, values, timestamp)
+
+    def last(self, device_id, variable=None):
+        """:return: (dict) variable: [timestamp, value] for one or all cached variables of the device"""
+        with self._lock:
+            return {name: list(series.last()) for (series_device, name), series in self.series.items()
+                    if series_device == device_id and len(series) and variable in (None, name)}
+
+    def query(self, device_id, variable, start=None, end=None, bucket=None, fallback=None):
+        """
+        Reads samples with start <= timestamp < end, all in epoch nanoseconds
+
+        :param bucket: (int) downsampling bucket width in nanoseconds, None for raw samples
+        :param fallback: (func) fallback(variable, start, end, bucket) -> points in the same format, used for the
+                         part of the range before the oldest cached sample when start is given
+
+        :return: (tuple) (list of points, source) where source is "cache", "fallback" or "cache+fallback"
+        """
+        with self._lock:
+            series = self.series.get((device_id, variable))
+            oldest = series.oldest() if series is not None else None
+            if series is None or not len(series):
+                points = list()
+            elif bucket:
+                points = series.downsample(bucket, start, end)
+            else:
+                points = series.range(start, end)
+        if fallback is None or start is None or (oldest is not None and start >= oldest):
+            return points, "cache"
+        fallback_end = oldest if end is None or (oldest is not None and oldest < end) else end
+        older = fallback(variable, start, fallback_end, bucket)
+        if not points:
+            return older, "fallback"
+        if bucket:
+            return merge_buckets(older, points), "cache+fallback"
+        return older + points, "cache+fallback"
+
+    def clear(self, device_id=None):
+        with self._lock:
+            for key in [key for key in self.series if device_id in (None, key[0])]:
+                del self.series[key]
+
+    def retain(self, device_ids):
+        """Drops the series of every device not in device_ids, e.g. devices that are no longer managed"""
+        with self._lock:
+            for key in [key for key in self.series if key[0] not in device_ids]:
+                del self.series[key]
+
+    def stats(self):
+        with self._lock:
+            return dict(series=len(self.series), samples=sum(len(series) for series in self.series.values()),
+                        out_of_order=self.out_of_order)
+
+
+def merge_buckets(older, newer):
+    """Concatenates two downsampled results, combining a bucket split across both"""
+    if not older or not newer or older[-1]["time"] != newer[0]["time"]:
+        return older + newer
+    left, right = older[-1], newer[0]
+    count = left["count"] + right["count"]
+    merged = dict(time=left["time"], min=min(left["min"], right["min"]), max=max(left["max"], right["max"]),
+                  mean=(left["mean"] * left["count"] + right["mean"] * right["count"]) / count, count=count)
+    return older[:-1] + [merged] + newer[1:]
@@ -0,0 +1,236 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from particlehub.polling import TokenBucket, AccountLimiter, DEFAULT_RATE, DEFAULT_BURST
+
+phlog = logging.getLogger("particle-hub.vitals")
+
+# Numeric health metrics: name: path in the diagnostics payload of GET /v1/diagnostics/:id/last
+VITALS_METRICS = dict(
+    signal_strength=("device", "network", "signal", "strength"),  # %
+    signal_quality=("device", "network", "signal", "quality"),  # %
+    signal_dbm=("device", "network", "signal", "strengthv"),
+    battery_charge=("device", "power", "battery", "charge"),  # %
+    uptime=("device", "system", "uptime"),  # s
+    memory_used=("device", "system", "memory", "used"),  # bytes
+    cloud_disconnects=("device", "cloud", "connection", "disconnects"),
+    network_disconnects=("device", "network", "connection", "disconnects"),
+)
+SUMMARY_METRICS = ("signal_strength", "battery_charge")
+
+
+class DeviceVitals:
+    """The numeric health metrics of a device's last diagnostics report"""
+
+    def __init__(self, device_id, metrics=None, status=None, updated_at=None):
+        self.device_id = device_id
+        self.metrics = metrics if metrics is not None else dict()
+        self.status = status
+        self.updated_at = updated_at
+        self.fetched_at = time.monotonic()
+
+    @classmethod
+    def from_diagnostics(cls, device_id, diagnostics):
+        """
+        :param device_id: (str)
+        :param diagnostics: (dict) "diagnostics" object of the Particle response. Metrics the device could not
+                            measure are reported as {"err": code} and left out.
+
+        :return: (DeviceVitals)
+        """
+        payload = diagnostics.get("payload") or dict()
+        metrics = dict()
+        for name, path in VITALS_METRICS.items():
+            value = payload
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metrics[name] = value
+        status = ((payload.get("service") or dict()).get("device") or dict()).get("status")
+        return cls(device_id, metrics, status, diagnostics.get("updated_at"))
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        :param data: (dict) to_dict() output, age included
+
+        :return: (DeviceVitals) as old as the vitals it was made from
+        """
+        vitals = cls(data["device_id"], data.get("metrics"), data.get("status"), data.get("updated_at"))
+        vitals.fetched_at -= data.get("age", 0.0)
+        return vitals
+
+    @property
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+    def summary(self):
+        """:return: (dict) status, updated_at and the SUMMARY_METRICS that were reported"""
+        summary = dict(status=self.status, updated_at=self.updated_at)
+        summary.update({name: self.metrics[name] for name in SUMMARY_METRICS if name in self.metrics})
+        return summary
+
+    def to_dict(self):
+        return dict(device_id=self.device_id, status=self.status, updated_at=self.updated_at, metrics=self.metrics)
+
+
+class VitalsCollector:
+    """
+    Keeps the vitals of managed devices in a cache. While running, a background thread fetches the devices whose
+    entry is older than ttl in concurrent batches, limited per account and by a token bucket. Readers are served
+    from the cache: get() returns an entry up to max_stale seconds old and refreshes it in the background once
+    it is older than ttl (stale-while-revalidate), peek() never calls the cloud.
+    """
+
+    def __init__(self, ttl=600, max_stale=3600, interval=60, batch_size=50, max_workers=8, account_concurrency=4,
+                 rate=DEFAULT_RATE, burst=DEFAULT_BURST, timeout=10.0, rate_limiter=None, on_vitals=None):
+        """
+            ttl (float):                  seconds before an entry is refreshed
+            max_stale (float):            seconds after which an entry is no longer served
+            interval (float):             seconds between checks for due devices
+            batch_size (int):             devices fetched concurrently before the next batch starts
+            max_workers (int):            size of the request thread pool
+            account_concurrency (int):    max in-flight requests per cloud API token
+            rate (float), burst (int):    token bucket settings, ignored when rate_limiter is given
+            timeout (float):              seconds to wait for each request
+            rate_limiter (TokenBucket):   shared with other users of the same API budget, e.g. the poller
+            on_vitals (func):             on_vitals(device, vitals) after each successful fetch
+        """
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.interval = interval
+        self.batch_size = batch_size
+        self.account_limiter = AccountLimiter(account_concurrency)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket(rate, burst)
+        self.timeout = timeout
+        self.on_vitals = on_vitals
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="PHVitalsThread")
+        self.fetches = 0
+        self.errors = 0
+        self._cache = dict()  # device_id: DeviceVitals
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def peek(self, device_id):
+        """:return: (DeviceVitals) cached vitals at most max_stale seconds old, or None. Never calls the cloud."""
+        vitals = self._cache.get(device_id)
+        if vitals is None or vitals.age > self.max_stale:
+            return None
+        return vitals
+
+    def store(self, vitals):
+        """Caches vitals fetched by another process"""
+        self._cache[vitals.device_id] = vitals
+
+    def get(self, device):
+        """
+        Returns the cached vitals of a device, refreshing them in the background when older than ttl
+
+        :param device: (Device)
+
+        :return: (DeviceVitals) or None until the first fetch finished
+        """
+        vitals = self._cache.get(device.id)
+        if vitals is None or vitals.age > self.ttl:
+            self.refresh_async([device])
+        return self.peek(device.id)
+
+    def refresh_async(self, devices):
+        """Fetches the vitals of devices in the background, skipping devices already being fetched"""
+        for device in self._claim(devices):
+            future = self.executor.submit(self._fetch, device)
+            future.add_done_callback(lambda _, device_id=device.id: self._release(device_id))
+
+    def collect(self, devices):
+        """
+        Fetches the vitals of devices in concurrent batches of batch_size and waits for them
+
+        :param devices: (list) Device objects
+
+        :return: (dict) device_id: DeviceVitals, or the exception that failed the fetch
+        """
+        devices = self._claim(devices)
+        results = dict()
+        try:
+            for index in range(0, len(devices), self.batch_size):
+                batch = devices[index:index + self.batch_size]
+                futures = {device.id: self.executor.submit(self._fetch, device) for device in batch}
+                wait(futures.values())
+                for device_id, future in futures.items():
+                    results[device_id] = future.exception() or future.result()
+        finally:
+            for device in devices:
+                self._release(device.id)
+        return results
+
+    def due(self, devices):
+        """:return: (list) devices without vitals or with vitals older than ttl, offline ones after max_stale / 2"""
+        due = list()
+        for device in devices:
+            vitals = self._cache.get(device.id)
+            if vitals is None or vitals.age > (self.ttl if device.online is not False else self.max_stale / 2):
+                due.append(device)
+        return due
+
+    def start(self, get_devices):
+        """
+        Starts collecting the vitals of the devices returned by get_devices() every interval seconds
+
+        :param get_devices: (func) returns the list of devices to watch, normally the managed ones
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(get_devices,), name="PHVitalsCollectorThread",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, get_devices):
+        while not self._stop_event.is_set():
+            try:
+                self.collect(self.due(get_devices()))
+            except Exception as e:
+                phlog.error("Vitals collection failed")
+                phlog.debug(e)
+            self._stop_event.wait(self.interval)
+
+    def _fetch(self, device):
+        try:
+            with self.account_limiter.limit(device.cloud_api_token):
+                self.rate_limiter.acquire()
+                vitals = device.device_health(timeout=self.timeout)
+        except Exception as e:
+            self.errors += 1
+            phlog.debug("Vitals of %s: %s" % (device.id, e))
+            raise
+        self.fetches += 1
+        self._cache[device.id] = vitals
+        if self.on_vitals is not None:
+            self.on_vitals(device, vitals)
+        return vitals
+
+    def _claim(self, devices):
+        with self._lock:
+            claimed = [device for device in devices if device.id not in self._refreshing]
+            self._refreshing.update(device.id for device in claimed)
+        return claimed
+
+    def _release(self, device_id):
+        with self._lock:
+            self._refreshing.discard(device_id)
+
+    def stats(self):
+        return dict(vitals_entries=len(self._cache), vitals_fetches=self.fetches, vitals_errors=self.errors,
+                    vitals_refreshing=len(self._refreshing))
+
+    def close(self):
+        self.stop()
+        self.executor.shutdown(wait=True)
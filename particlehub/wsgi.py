@@ -1,3 +1,4 @@
 # Configure Particle Hub for production
-from particlehub.particlehub_app import app
+from particlehub.particlehub_app import create_app
+app = create_app()
 app.config['DEBUG'] = False
@@ -4,17 +4,65 @@ Default log database is InfluxDB
 """
 cloud_api_token = ""
 csrf_key = ""
+device_cache_ttl = 30  # seconds the /v1/devices list is reused between page loads
+cloud_timeout = 10  # seconds to wait for the /v1/devices list
 default_log_source = "influx"
 influx_db_name = ""
 influx_user = ""
 influx_password = ""
 influx_host = ""
 influx_port = 8086
+influx_batch_size = 5000
+influx_flush_interval = 1.0
+influx_max_queue_size = 100000
+influx_replay_rate = 5000  # points/s replayed from the spool after a database outage
+influx_spool_max_bytes = 512 * 2 ** 20
 syslog_host = ("", 5000)
 web_host = "0.0.0.0"
 log_config = {"influx": dict(host=influx_host,
                              port=influx_port,
                              username=influx_user,
                              password=influx_password,
-                             database=influx_db_name)}
-stream_config = {"url": "https://api.particle.io/v1/devices/events?access_token=%s" % cloud_api_token}
+                             database=influx_db_name,
+                             batch_size=influx_batch_size,
+                             flush_interval=influx_flush_interval,
+                             max_queue_size=influx_max_queue_size,
+                             replay_rate=influx_replay_rate,
+                             spool_max_bytes=influx_spool_max_bytes)}
+poll_config = dict(max_workers=16, account_concurrency=8, rate=30.0, burst=30, timeout=10)  # requests/s, seconds
+# Fleet function calls (/bulk/call-function), sharing poll_config's rate limit unless a rate is given here
+command_config = dict(max_workers=32, account_concurrency=8, timeout=10, retries=2)
+# Device vitals (Particle diagnostics) of managed devices, refreshed after ttl seconds while ingesting and shown in
+# the device list; the numeric metrics are logged as vitals_* measurements. Set to None to disable.
+vitals_config = dict(ttl=600, max_stale=3600, interval=60, batch_size=50)
+# Background polling of managed devices, set to None to disable
+schedule_config = dict(default_interval=300, device_intervals={}, variable_intervals={}, jitter=10, max_backoff=3600)
+# Stream ingestion runs in the one web worker holding this lock, set to None for a single worker without a lock.
+# The file backend coordinates workers on one host through a lock file next to PHSTATE_FILE. The other workers get
+# live device updates and recent samples (/events, /timeseries) from the leader through the sqlite state store.
+coordination_config = dict(backend="file")
+# Live device updates (/events): browsers streamed to per web worker, each holding one of the worker's threads
+# (see deploy/gunicorn_config.py), and devices with updates waiting before a slow browser is disconnected
+live_max_clients = 4
+live_max_pending = 1000
+# Hot path instrumentation served at /metrics in the Prometheus text format
+metrics_enabled = True
+# In memory recent samples per device variable: window in seconds, max_samples per variable (16 bytes each)
+timeseries_config = dict(window=3600, max_samples=3600)
+stream_config = {"url": "https://api.particle.io/v1/devices/events?access_token=%s" % cloud_api_token,
+                 "handler_workers": 4,  # 0 handles events on the stream thread, stalling it while handlers run
+                 "max_queue_size": 10000,
+                 "backpressure": "block",  # block, drop_oldest or spill
+                 "shards": 0,  # > 0 handles events in that many processes, devices are hashed by coreid
+                 "idle_timeout": 90,  # Reconnect after this many seconds without data or keepalives
+                 "backoff_max": 60,  # Upper bound on the reconnect delay in seconds
+                 "backfill_min_gap": 5,  # Outages at least this long poll the devices that missed events
+                 "dedup": dict(window=600, max_entries=100000),  # Drops redelivered events, None to disable
+                 "record": None,  # dict(directory=...) records the raw stream as NDJSON segments for replay
+                 "engine": "thread"}  # "asyncio" multiplexes stream_config["subscriptions"] on one event loop
+# Example asyncio subscriptions (see particlehub.async_stream.subscription_url):
+# stream_config["subscriptions"] = [dict(name="fleet-a", url=".../v1/products/1234/events?access_token=..."),
+#                                   dict(name="sensors", url=".../v1/devices/events/DATA?access_token=...")]
+# Recorded or exported event files below this directory can be replayed to the log database through /replay,
+# None disables the endpoint. The same files can be replayed offline with python -m particlehub.replay.
+replay_dir = None
@@ -1,9 +1,35 @@
+import tempfile
+from types import SimpleNamespace
 from unittest import TestCase
-from particlehub.particlehub_app import app
+from unittest.mock import MagicMock
+from particlehub.models import HubManager
+from particlehub.state import SQLiteStateStore
+from particlehub.particlehub_app import create_app
+
+
+def device_dict(device_id, online=True):
+    return dict(id=device_id, name=device_id, variables={"temp": "double"}, notes=None, connected=online,
+                online=online, status="normal")
 
 
 class BaseTest(TestCase):
 
     def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.cloud = MagicMock(cloud_api_token="token")
+        self.cloud.get_device_list.return_value = ([device_dict("a"), device_dict("b")], True)
+        leader_lock = MagicMock()
+        leader_lock.acquire.return_value = False  # Requests are served without stream ingestion
+        self.hub_manager = HubManager(self.cloud, dict(url="http://127.0.0.1:9/v1/devices/events"), [], None, None,
+                                      state_store=SQLiteStateStore(self.state_dir.name + "/phstate.db"),
+                                      leader_lock=leader_lock, lazy=True)
+        self.hub_manager.wait_until_ready(5)
+        config = SimpleNamespace(csrf_key="test", syslog_host=("localhost", 514))
+        app = create_app(config, hub_manager=self.hub_manager)
         app.testing = True
+        app.config['WTF_CSRF_ENABLED'] = False
         self.app = app.test_client
+
+    def tearDown(self):
+        self.hub_manager.leader_elector.stop()
+        self.state_dir.cleanup()
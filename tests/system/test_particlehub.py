@@ -1,3 +1,4 @@
+from unittest.mock import MagicMock
 from tests.system.base_test import BaseTest
 
 
@@ -11,3 +12,45 @@ class TestParticleHubApp(BaseTest):
     def test_add_device(self):
         # TODO: test CSRF !
         self.fail()
+
+    def test_get_devices_paginated(self):
+        with self.app() as client:
+            response = client.get('/get-devices?page=1&per_page=1')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['X-Total-Count'], "2")
+
+    def test_health(self):
+        with self.app() as client:
+            response = client.get('/health/ready')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()["devices"], "cloud")
+            self.assertEqual(response.get_json()["ingestion"], "standby")
+            self.assertEqual(client.get('/health/live').status_code, 200)
+
+    def test_device_rows_show_cached_vitals(self):
+        self.hub_manager.vitals_summary = lambda device_id: dict(status="ok", battery_charge=87.6) \
+            if device_id == "a" else None
+        with self.app() as client:
+            rows = client.get('/get-devices').get_data(as_text=True).splitlines()
+        self.assertIn("88%", "".join(rows))
+        self.cloud.get_device_list.assert_called_once()
+
+    def test_bulk_requires_selection(self):
+        with self.app() as client:
+            for route in ('/bulk/add-devices', '/bulk/remove-devices', '/bulk/add-tag', '/bulk/remove-tag'):
+                self.assertEqual(client.post(route, json=dict(tag="room")).status_code, 400, route)
+            self.hub_manager.call_function = MagicMock()
+            response = client.post('/bulk/call-function', json=dict(function="reset"))
+            self.assertEqual(response.status_code, 400)
+            response = client.post('/bulk/call-function', json=dict(ids=["a"]))
+            self.assertEqual(response.status_code, 400)
+            for route in ('/bulk/add-tag', '/bulk/remove-tag'):
+                self.assertEqual(client.post(route, json=dict(ids=["a"])).status_code, 400, route)
+            response = client.post('/bulk/add-devices', json=dict(ids="ab"))
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()["error"], "ids must be a list")
+            self.hub_manager.call_function.assert_not_called()
+            self.assertEqual(self.hub_manager.select_devices(managed=True), [])
+            response = client.post('/bulk/add-devices', json=dict(ids=["a"]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()["a"]["status"], "success")
@@ -0,0 +1,61 @@
+import asyncio
+from unittest import TestCase
+from particlehub.async_stream import AsyncStreamEngine, SSESubscription, subscription_url
+
+
+def chunk(text):
+    data = text.encode()
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+
+class TestAsyncStreamEngine(TestCase):
+
+    def test_subscription_url(self):
+        self.assertEqual(subscription_url("abc", product="fleet", event_prefix="DATA"),
+                         "https://api.particle.io/v1/products/fleet/events/DATA?access_token=abc")
+        self.assertEqual(subscription_url("abc"), "https://api.particle.io/v1/devices/events?access_token=abc")
+
+    def test_multiplex_and_resume(self):
+        requests_seen = list()
+        received = list()
+
+        async def serve(reader, writer):
+            request = await reader.readuntil(b"\r\n\r\n")
+            requests_seen.append(request.decode())
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+            if "Last-Event-ID" not in request.decode():
+                writer.write(chunk(":ok\n\nid: 1\nevent: DATA\ndata: {\"a\": 1}\n\n"))
+                writer.write(chunk("id: 2\nevent: DATA\ndata: {\"a\": 2}\n\n") + b"0\r\n\r\n")
+            else:
+                writer.write(chunk("id: 3\nevent: LOG\ndata: {\"a\": 3}\n\n"))
+            await writer.drain()
+            writer.close()
+
+        async def scenario():
+            server = await asyncio.start_server(serve, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            url = "http://127.0.0.1:%d/v1/devices/events" % port
+            subscriptions = [SSESubscription(url, lambda event, name=name: received.append((name, event.id)),
+                                             name=name) for name in ("first", "second")]
+            engine = AsyncStreamEngine(subscriptions, idle_timeout=2, backoff_base=0.01)
+            task = asyncio.ensure_future(engine.run())
+            while {name for name, event_id in received if event_id == "3"} != {"first", "second"}:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            server.close()
+            return engine
+
+        engine = asyncio.run(asyncio.wait_for(scenario(), 5))
+        for name in ("first", "second"):
+            self.assertEqual([event_id for sub, event_id in received if sub == name][:3], ["1", "2", "3"])
+        self.assertTrue(any("Last-Event-ID: 2" in request for request in requests_seen))
+        self.assertGreaterEqual(engine.stats()["first"]["reconnects"], 1)
+
+    def test_restart(self):
+        engine = AsyncStreamEngine([SSESubscription("http://127.0.0.1:9/v1/devices/events", lambda event: None)],
+                                   idle_timeout=1, backoff_base=0.01)
+        for _ in range(2):
+            engine.start()
+            engine.stop(timeout=2)
+            self.assertFalse(engine._thread.is_alive())
+        self.assertEqual(len(engine._tasks), 1)
@@ -0,0 +1,79 @@
+import time
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+import requests
+from particlehub.models import Device, CloudCommunicationError, TransientCloudError
+from particlehub.commands import FleetCommander
+
+
+class FakeDevice(Device):
+
+    def __init__(self, device_id, outcomes, delay=0.05):
+        super().__init__(device_id, "token")
+        self.outcomes = list(outcomes)
+        self.delay = delay
+        self.calls = list()
+
+    def call_function(self, func_name, arg="", timeout=None):
+        self.calls.append((func_name, arg, timeout))
+        time.sleep(self.delay)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class TestFleetCommander(TestCase):
+
+    def test_call_concurrently(self):
+        devices = [FakeDevice("dev%d" % i, [i]) for i in range(20)]
+        commander = FleetCommander(max_workers=20, account_concurrency=20, rate=1000, burst=1000, timeout=3)
+        start = time.monotonic()
+        results = commander.call(devices, "reset", "now")
+        self.assertLess(time.monotonic() - start, 0.05 * 20 / 2)
+        self.assertEqual([results[device.id].return_value for device in devices], list(range(20)))
+        self.assertTrue(all(result.ok and result.attempts == 1 for result in results.values()))
+        self.assertEqual(devices[0].calls, [("reset", "now", 3)])
+        commander.close()
+
+    def test_retries_transient_failures_only(self):
+        flaky = FakeDevice("flaky", [TransientCloudError("HTTP 503"), 1], delay=0)
+        offline = FakeDevice("offline", [CloudCommunicationError("HTTP 400"), 1], delay=0)
+        down = FakeDevice("down", [TransientCloudError("ReadTimeout")] * 3, delay=0)
+        commander = FleetCommander(retries=2, retry_backoff=0.01, rate=1000, burst=1000)
+        results = commander.call([flaky, offline, down], "reset")
+        self.assertEqual(results["flaky"].to_dict()["status"], "success")
+        self.assertEqual(results["flaky"].attempts, 2)
+        self.assertEqual(results["offline"].to_dict(), dict(status="fail", return_value=None, attempts=1,
+                                                            elapsed=results["offline"].elapsed, error="HTTP 400"))
+        self.assertEqual(results["down"].attempts, 3)
+        self.assertEqual(results["down"].error, "ReadTimeout")
+        commander.close()
+
+    @patch("particlehub.models.http_session")
+    def test_device_call_function(self, http_session):
+        device = Device("dev", "token")
+        http_session.post.return_value = MagicMock(status_code=200, json=lambda: dict(return_value=7))
+        self.assertEqual(device.call_function("reset", 1, timeout=2), 7)
+        self.assertEqual(http_session.post.call_args.kwargs["data"], dict(args="1", access_token="token"))
+        self.assertEqual(http_session.post.call_args.kwargs["timeout"], 2)
+
+        http_session.post.return_value = MagicMock(status_code=429)
+        self.assertRaises(TransientCloudError, device.call_function, "reset")
+        http_session.post.return_value = MagicMock(status_code=404)
+        with self.assertRaises(CloudCommunicationError) as context:
+            device.call_function("reset")
+        self.assertNotIsInstance(context.exception, TransientCloudError)
+        http_session.post.side_effect = requests.exceptions.ReadTimeout()
+        self.assertRaises(TransientCloudError, device.call_function, "reset")
+        http_session.post.side_effect = None
+        http_session.post.return_value = MagicMock(status_code=200, json=MagicMock(side_effect=ValueError))
+        self.assertRaises(CloudCommunicationError, device.call_function, "reset")
+
+    def test_unexpected_error_fails_one_device(self):
+        broken = FakeDevice("broken", [KeyError("return_value")], delay=0)
+        commander = FleetCommander(rate=1000, burst=1000)
+        results = commander.call([broken, FakeDevice("ok", [1], delay=0)], "reset")
+        self.assertEqual((results["broken"].error, results["broken"].attempts), ("KeyError", 1))
+        self.assertTrue(results["ok"].ok)
+        commander.close()
@@ -0,0 +1,44 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock
+from particlehub.coordination import FileLeaderLock, LeaderElector
+
+
+class TestFileLeaderLock(TestCase):
+
+    def test_single_holder(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "ingest.lock")
+            first, second = FileLeaderLock(path), FileLeaderLock(path)
+            self.assertTrue(first.acquire())
+            self.assertFalse(second.acquire())
+            first.release()
+            self.assertTrue(second.acquire())
+            second.release()
+
+
+class TestLeaderElector(TestCase):
+
+    def test_elected_once(self):
+        lock = MagicMock()
+        lock.acquire.side_effect = [False, True]
+        on_elected = MagicMock()
+        elector = LeaderElector(lock, on_elected)
+        elector._campaign()
+        on_elected.assert_not_called()
+        elector._campaign()
+        elector._campaign()
+        on_elected.assert_called_once_with()
+        self.assertTrue(elector.is_leader)
+
+    def test_demoted_when_renew_fails(self):
+        lock = MagicMock()
+        lock.acquire.return_value = True
+        lock.renew.return_value = False
+        on_demoted = MagicMock()
+        elector = LeaderElector(lock, MagicMock(), on_demoted)
+        self.assertTrue(elector._campaign())
+        self.assertFalse(elector._campaign())
+        on_demoted.assert_called_once_with()
+        self.assertFalse(elector.is_leader)
@@ -0,0 +1,40 @@
+from unittest import TestCase
+from unittest.mock import patch
+from particlehub.dedup import EventDeduplicator
+
+
+def event(data="temp=21.5", published_at="2021-01-01T00:00:00.000Z", coreid="device1"):
+    return dict(data=data, ttl=60, published_at=published_at, coreid=coreid)
+
+
+class TestEventDeduplicator(TestCase):
+
+    def test_redelivered_event_is_duplicate(self):
+        deduplicator = EventDeduplicator()
+        self.assertFalse(deduplicator.is_duplicate("DATA", event()))
+        self.assertTrue(deduplicator.is_duplicate("DATA", event()))
+        self.assertFalse(deduplicator.is_duplicate("LOG", event()))
+        self.assertFalse(deduplicator.is_duplicate("DATA", event(data="temp=21.6")))
+        self.assertFalse(deduplicator.is_duplicate("DATA", event(published_at="2021-01-01T00:00:01.000Z")))
+        self.assertFalse(deduplicator.is_duplicate("DATA", event(coreid="device2")))
+        self.assertEqual(deduplicator.stats(), dict(dedup_hits=1, dedup_misses=5, dedup_entries=5))
+
+    def test_bounded_entries(self):
+        deduplicator = EventDeduplicator(max_entries=3)
+        for second in range(5):
+            deduplicator.is_duplicate("DATA", event(published_at="2021-01-01T00:00:0%d.000Z" % second))
+        self.assertEqual(deduplicator.stats()["dedup_entries"], 3)
+        self.assertFalse(deduplicator.is_duplicate("DATA", event(published_at="2021-01-01T00:00:00.000Z")))
+        self.assertTrue(deduplicator.is_duplicate("DATA", event(published_at="2021-01-01T00:00:04.000Z")))
+
+    @patch("particlehub.dedup.time.monotonic")
+    def test_entries_expire_after_window(self, monotonic):
+        deduplicator = EventDeduplicator(window=10)
+        monotonic.return_value = 100.0
+        deduplicator.is_duplicate("DATA", event())
+        monotonic.return_value = 105.0
+        self.assertTrue(deduplicator.is_duplicate("DATA", event()))
+        monotonic.return_value = 111.0
+        self.assertFalse(deduplicator.is_duplicate("DATA", event()))
+        self.assertFalse(deduplicator.is_duplicate("DATA", event(data="hum=40")))
+        self.assertEqual(deduplicator.stats()["dedup_entries"], 2)
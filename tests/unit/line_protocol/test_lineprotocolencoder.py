@@ -0,0 +1,35 @@
+from unittest import TestCase
+from influxdb.line_protocol import make_line
+from particlehub.line_protocol import LineProtocolEncoder
+
+
+class TestLineProtocolEncoder(TestCase):
+
+    def test_matches_influxdb_client(self):
+        tags = {"site name": "lab,1", "room": "a=b", "empty": None, "z\\": 3.5}
+        data = dict(temp=21.5, ok=True, msg='say "hi"\n', big=1e21)
+        lines = LineProtocolEncoder().encode(data, tags, 1609459200250000000, "device1")
+        expected = [make_line(measurement, tags, {"value": value}, 1609459200250000000)
+                    for measurement, value in data.items()]
+        self.assertEqual(lines, expected)
+
+    def test_series_keys_cached_until_tags_change(self):
+        encoder = LineProtocolEncoder()
+        tags = dict(site="lab")
+        encoder.encode(dict(temp=1.0), tags, 1, "device1")
+        self.assertEqual(encoder.encode(dict(temp=2.0), tags, 2, "device1"), ["temp,site=lab value=2.0 2"])
+        self.assertEqual((encoder.hits, encoder.misses), (1, 1))
+
+        tags["site"] = "field"
+        self.assertEqual(encoder.encode(dict(temp=3.0), tags, 3, "device1"), ["temp,site=field value=3.0 3"])
+        tags.pop("site")
+        self.assertEqual(encoder.encode(dict(temp=4.0), tags, 4, "device1"), ["temp value=4.0 4"])
+        self.assertEqual(encoder.stats(), dict(series_key_hits=1, series_key_misses=3, series_keys=1))
+
+    def test_skips_tag_variables_and_none(self):
+        lines = LineProtocolEncoder().encode(dict(site="lab", temp=None, hum=40), dict(site="lab"), 7)
+        self.assertEqual(lines, ["hum,site=lab value=40.0 7"])
+
+    def test_ints_as_floats_and_non_finite_skipped(self):
+        data = dict(count=3, big=10 ** 400, nan=float("nan"), inf=float("-inf"), temp=21.5)
+        self.assertEqual(LineProtocolEncoder().encode(data, dict(), 7), ["count value=3.0 7", "temp value=21.5 7"])
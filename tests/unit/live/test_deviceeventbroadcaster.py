@@ -0,0 +1,58 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+from particlehub.live import DeviceEventBroadcaster
+
+
+def make_device(device_id, **variable_state):
+    return MagicMock(id=device_id, online=True, variable_state=variable_state)
+
+
+class TestDeviceEventBroadcaster(TestCase):
+
+    def setUp(self):
+        self.broadcaster = DeviceEventBroadcaster(max_pending=2)
+
+    def test_snapshot_on_subscribe(self):
+        client = self.broadcaster.subscribe([make_device("a", temp=1.0)])
+        batch = client.next_batch(timeout=0)
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(batch[0]["variable_state"], dict(temp=1.0))
+
+    def test_snapshot_not_limited_by_max_pending(self):
+        client = self.broadcaster.subscribe([make_device(device_id) for device_id in "abcde"])
+        self.broadcaster(make_device("f"))
+        self.assertEqual([d["id"] for d in client.next_batch(timeout=0)], list("abcdef"))
+        for device_id in ("a", "b", "c"):
+            self.broadcaster(make_device(device_id))
+        self.assertIsNone(client.next_batch(timeout=0))
+
+    def test_max_clients(self):
+        clients = [self.broadcaster.subscribe() for _ in range(5)]
+        self.assertIsNone(clients[-1])
+        self.assertEqual(self.broadcaster.stats()["rejected_clients"], 1)
+        self.broadcaster.unsubscribe(clients[0])
+        self.assertIsNotNone(self.broadcaster.subscribe())
+
+    def test_updates_coalesced_per_device(self):
+        client = self.broadcaster.subscribe()
+        device = make_device("a", temp=1.0)
+        self.broadcaster(device)
+        device.variable_state = dict(temp=2.0)
+        self.broadcaster(device)
+        self.broadcaster(make_device("b", temp=3.0))
+        batch = client.next_batch(timeout=0)
+        self.assertEqual([(d["id"], d["variable_state"]["temp"]) for d in batch], [("a", 2.0), ("b", 3.0)])
+        self.assertEqual(client.next_batch(timeout=0), [])
+
+    def test_slow_client_dropped(self):
+        client = self.broadcaster.subscribe()
+        for device_id in ("a", "b", "c"):
+            self.broadcaster(make_device(device_id))
+        self.assertIsNone(client.next_batch(timeout=0))
+        self.assertEqual(self.broadcaster.stats()["clients"], 0)
+        self.assertEqual(self.broadcaster.stats()["dropped_clients"], 1)
+
+    def test_unsubscribe_ends_client(self):
+        client = self.broadcaster.subscribe()
+        self.broadcaster.unsubscribe(client)
+        self.assertIsNone(client.next_batch(timeout=0))
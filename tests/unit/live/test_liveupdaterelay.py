@@ -0,0 +1,74 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock
+from particlehub.live import LiveUpdateRelay
+from particlehub.state import SQLiteStateStore
+from particlehub.timeseries import TimeSeriesCache
+from particlehub.vitals import DeviceVitals, VitalsCollector
+
+
+class TestLiveUpdateRelay(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "phstate.db")
+        self.leader_store, self.follower_store = SQLiteStateStore(path), SQLiteStateStore(path)
+        self.leader = LiveUpdateRelay(self.leader_store)
+        self.follower = LiveUpdateRelay(self.follower_store)
+        self.leader_timeseries = TimeSeriesCache()
+        self.leader_timeseries.on_record = self.leader.sample_recorded
+
+    def tearDown(self):
+        self.leader_store.close()
+        self.follower_store.close()
+        self.directory.cleanup()
+
+    def test_follower_applies_leader_updates(self):
+        leader_device = MagicMock(id="dev", variable_state=dict(temp=20.0))
+        self.leader.device_updated(leader_device)  # Not publishing yet
+        self.leader.publishing = True
+        self.leader_timeseries.record("dev", dict(temp=21.0, timestamp="2021-01-01T00:00:00.000Z"), 5)
+        self.leader_timeseries.record("other", dict(temp=1.0), 5)
+        leader_device.variable_state = dict(temp=21.0)
+        self.leader.device_updated(leader_device)
+        self.leader.flush()
+
+        follower_device = MagicMock(id="dev", variable_state=dict())
+        timeseries, notify = TimeSeriesCache(), MagicMock()
+        self.follower.apply(dict(dev=follower_device), timeseries, notify)
+        self.assertEqual(follower_device.variable_state, dict(temp=21.0))
+        self.assertEqual(timeseries.last("dev"), dict(temp=[5, 21.0]))
+        self.assertEqual(timeseries.stats()["series"], 1)
+        notify.assert_called_once_with(follower_device)
+
+        self.follower.apply(dict(dev=follower_device), timeseries, notify)  # Nothing new
+        notify.assert_called_once()
+        self.assertEqual(self.follower.applied, 1)
+
+    def test_follower_caches_leader_vitals(self):
+        device = MagicMock(id="dev")
+        self.leader.publishing = True
+        vitals = DeviceVitals("dev", dict(battery_charge=80.0), "ok", "2021-01-01T00:00:00.000Z")
+        vitals.fetched_at -= 30
+        self.leader.vitals_fetched(device, vitals)
+        self.leader.vitals_fetched(MagicMock(id="other"), DeviceVitals("other"))
+        self.leader.flush()
+
+        collector = VitalsCollector()
+        self.follower.apply(dict(dev=device), TimeSeriesCache(), MagicMock(), collector)
+        relayed = collector.peek("dev")
+        self.assertEqual(relayed.summary(), vitals.summary())
+        self.assertGreaterEqual(relayed.age, 30)
+        self.assertIsNone(collector.peek("other"))
+        collector.close()
+
+    def test_retained_batches(self):
+        self.leader_store.retained_updates = 2
+        self.leader.publishing = True
+        for second in range(5):
+            self.leader.sample_recorded("dev", dict(temp=float(second)), second)
+            self.leader.flush()
+        cursor, batches = self.follower_store.load_updates()
+        self.assertEqual([batch["samples"][0][2] for batch in batches], [3, 4])
+        self.assertEqual(self.follower_store.load_updates(cursor), (cursor, []))
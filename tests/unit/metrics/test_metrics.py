@@ -0,0 +1,48 @@
+from unittest import TestCase
+from unittest.mock import Mock
+from particlehub import metrics
+from particlehub.models import StreamManager, Device
+
+
+class TestMetrics(TestCase):
+
+    def test_counter_render(self):
+        counter = metrics.Counter("frames_total", "Frames", ("event",))
+        counter.inc("DATA")
+        counter.inc("DATA", amount=2)
+        counter.inc('say "hi"')
+        self.assertEqual(counter.render(), ['# HELP frames_total Frames', '# TYPE frames_total counter',
+                                            'frames_total{event="DATA"} 3',
+                                            'frames_total{event="say \\"hi\\""} 1'])
+
+    def test_histogram_cumulative_buckets(self):
+        histogram = metrics.Histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value)
+        lines = histogram.render()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_sum 6.05', lines)
+        self.assertIn('latency_seconds_count 4', lines)
+
+    def test_render_gauges(self):
+        text = metrics.render([("queue_depth", "Queue", {("a",): 2}, ("writer",)), ("up", "Up", 1, ())])
+        self.assertIn('queue_depth{writer="a"} 2\n', text)
+        self.assertIn('up 1\n', text)
+        self.assertIn('# TYPE particlehub_sse_frames_total counter', text)
+
+    def test_handle_data_logs_whether_or_not_enabled(self):
+        device = Device("device1", None)
+        stream_manager = StreamManager(dict(url="http://localhost", handler_workers=0), [], "influx", dict(),
+                                       managed_devices=dict(device1=device))
+        stream_manager.log_function = Mock()
+        event = dict(data="temp=21.5", coreid="device1", published_at="2021-01-01T00:00:00.000Z")
+        try:
+            stream_manager._handle_data(event, device)
+            metrics.enable()
+            stream_manager._handle_data(event, device)
+        finally:
+            metrics.disable()
+        self.assertEqual(stream_manager.log_function.call_count, 2)
+        self.assertEqual(metrics.EVENT_LAG_SECONDS.values[()][-1], 1)
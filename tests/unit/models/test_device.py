@@ -1,5 +1,6 @@
 from unittest import TestCase
-from particlehub.models import Device
+from unittest.mock import patch, MagicMock
+from particlehub.models import Device, TransientCloudError
 
 
 class TestDevice(TestCase):
@@ -10,11 +11,28 @@ class TestDevice(TestCase):
     def test_from_dict(self):
         self.fail()
 
-    def test_get_all_variable_data(self):
-        self.fail()
-
-    def test_device_health(self):
-        self.fail()
+    @patch("particlehub.models.http_session")
+    def test_get_all_variable_data(self, session):
+        session.get.return_value = MagicMock(status_code=200, json=MagicMock(return_value={"result": 7}))
+        device = Device("abc", "token", variables={"temp": "int32", "hum": "int32"}, tags={"temp": None})
+        result = device.get_all_variable_data()
+        self.assertTrue(result.ok)
+        self.assertEqual(device.variable_state, {"temp": 7, "hum": 7})
+        self.assertEqual(device.tags, {"temp": 7})
+        self.assertEqual(session.get.call_count, 2)
+
+    @patch("particlehub.models.http_session")
+    def test_device_health(self, session):
+        payload = dict(device=dict(power=dict(battery=dict(charge=87.5))), service=dict(device=dict(status="ok")))
+        session.get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=dict(
+            diagnostics=dict(updated_at="2021-01-01T00:00:00.000Z", payload=payload))))
+        vitals = Device("abc", "token").device_health(timeout=5)
+        self.assertEqual(vitals.metrics, dict(battery_charge=87.5))
+        self.assertEqual(vitals.status, "ok")
+        self.assertTrue(session.get.call_args.args[0].endswith("diagnostics/abc/last"))
+        self.assertEqual(session.get.call_args.kwargs["timeout"], 5)
+        session.get.return_value = MagicMock(status_code=503)
+        self.assertRaises(TransientCloudError, Device("abc", "token").device_health)
 
     def test__update_variable_names(self):
         self.fail()
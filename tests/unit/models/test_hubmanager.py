@@ -0,0 +1,231 @@
+import os
+import time
+import tempfile
+import threading
+import requests
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from particlehub.models import HubManager
+from particlehub.vitals import DeviceVitals
+
+
+def device_dict(device_id, name=None, online=True):
+    return dict(id=device_id, name=name or device_id, variables={"temp": "double"}, notes=None, connected=online,
+                online=online, status="normal")
+
+
+@patch("particlehub.models.StreamManager")
+class TestHubManager(TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.environ = patch.dict(os.environ, PHSTATE_FILE=os.path.join(self.state_dir.name, "phstate.pkl"))
+        self.environ.start()
+        self.cloud = MagicMock(cloud_api_token="token")
+        self.cloud.get_device_list.return_value = ([device_dict("a"), device_dict("b")], True)
+
+    def tearDown(self):
+        self.environ.stop()
+        self.state_dir.cleanup()
+
+    def test_update_device_list_in_place(self, stream_manager):
+        hub_manager = HubManager(self.cloud, dict(), [], None, None)
+        hub_manager.add_device("a")
+        device_a = hub_manager.devices["a"]
+        device_a.variable_state["temp"] = 21.0
+        managed = hub_manager.managed_devices
+
+        self.cloud.get_device_list.return_value = ([device_dict("a", name="renamed", online=False),
+                                                    device_dict("c")], True)
+        hub_manager.update_device_list()
+        self.assertIs(hub_manager.devices["a"], device_a)
+        self.assertEqual(device_a.name, "renamed")
+        self.assertEqual(device_a.variable_state, {"temp": 21.0})
+        self.assertIs(hub_manager.managed_devices, managed)
+        self.assertIn("c", hub_manager.devices)
+        self.assertNotIn("b", hub_manager.devices)
+
+        self.cloud.get_device_list.return_value = ([device_dict("c")], True)
+        hub_manager.update_device_list()
+        self.assertTrue(hub_manager.devices["a"].removed)
+
+    def test_unchanged_list_skips_reconcile(self, stream_manager):
+        hub_manager = HubManager(self.cloud, dict(), [], None, None)
+        devices = dict(hub_manager.devices)
+        self.cloud.get_device_list.return_value = ([], False)
+        hub_manager.update_device_list()
+        self.assertEqual(hub_manager.devices, devices)
+
+    def test_select_devices(self, stream_manager):
+        self.cloud.get_device_list.return_value = ([device_dict("a", name="Greenhouse-1"),
+                                                    device_dict("b", name="greenhouse-2"),
+                                                    device_dict("c", name="garage")], True)
+        hub_manager = HubManager(self.cloud, dict(), [], None, None)
+        hub_manager.devices["b"].tags["temp"] = 20.0
+        hub_manager.add_device("c")
+        self.assertEqual(hub_manager.select_devices(name="greenhouse-*"), ["a", "b"])
+        self.assertEqual(hub_manager.select_devices(tag="temp"), ["b"])
+        self.assertEqual(hub_manager.select_devices(managed=False), ["a", "b"])
+        self.assertEqual(hub_manager.select_devices(device_ids=["c", "x"]), ["c", "x"])
+
+    def test_bulk_add_remove_devices(self, stream_manager):
+        hub_manager = HubManager(self.cloud, dict(), [], None, None)
+        results = hub_manager.add_devices(["a", "b", "missing"])
+        self.assertEqual(results["missing"]["status"], "fail")
+        self.assertEqual(set(hub_manager.managed_devices), {"a", "b"})
+        stream_manager.return_value.set_managed_devices.assert_called_with(hub_manager.managed_devices)
+        self.assertEqual(set(hub_manager.state_store.load()["managed_device_ids"]), {"a", "b"})
+
+        hub_manager.remove_devices(["a"])
+        self.assertEqual(set(hub_manager.managed_devices), {"b"})
+        self.assertFalse(hub_manager.devices["a"].is_managed)
+        self.assertEqual(hub_manager.state_store.load()["managed_device_ids"], ["b"])
+
+    def test_bulk_tags(self, stream_manager):
+        hub_manager = HubManager(self.cloud, dict(), [], None, None)
+        hub_manager.devices["b"].online = False
+        hub_manager.poller = MagicMock()
+        poll_result = MagicMock(values={"temp": 21.0}, errors={})
+        hub_manager.poller.poll.return_value = {"a": poll_result}
+        results = hub_manager.add_tags(["a", "b"], "temp")
+        self.assertEqual(results["a"], dict(status="success", value=21.0))
+        self.assertEqual(results["b"]["error"], "offline")
+        self.assertEqual(hub_manager.state_store.load()["tags"]["a"], {"temp": 21.0})
+
+        results = hub_manager.remove_tags(["a", "b"], "temp")
+        self.assertEqual(results["a"]["status"], "success")
+        self.assertEqual(results["b"]["error"], "not tagged")
+        self.assertEqual(hub_manager.devices["a"].tags, {})
+
+    def test_device_listeners_notified(self, stream_manager):
+        listener = MagicMock()
+        hub_manager = HubManager(self.cloud, dict(), [], None, None, device_listeners=[listener])
+        hub_manager.publish_device_data(hub_manager.devices["a"], {"temp": 1.0})
+        listener.assert_called_once_with(hub_manager.devices["a"])
+        self.assertEqual(stream_manager.call_args.kwargs["device_listeners"], [listener])
+
+    @patch("particlehub.models.get_influx_writer")
+    def test_query_timeseries_falls_back_to_influx(self, get_influx_writer, stream_manager):
+        result = get_influx_writer.return_value.client.query.return_value
+        result.get_points.return_value = [dict(time=5, value=0.5)]
+        hub_manager = HubManager(self.cloud, dict(), [], "influx", dict(host="localhost"))
+        hub_manager.devices["a"].tags = dict(site="lab")
+        hub_manager.timeseries.record("a", dict(temp=1.0), 10)
+        points, source = hub_manager.query_timeseries("a", "temp", start=0)
+        self.assertEqual(points, [[5, 0.5], [10, 1.0]])
+        self.assertEqual(source, "cache+fallback")
+        query = get_influx_writer.return_value.client.query.call_args.args[0]
+        self.assertEqual(query, 'SELECT "value" FROM "temp" WHERE time >= 0 AND time < 10 AND "site" = \'lab\'')
+
+    def test_follower_waits_for_leadership_and_syncs_state(self, stream_manager):
+        leader = HubManager(self.cloud, dict(), [], None, None)
+        lock = MagicMock()
+        lock.acquire.return_value = False
+        follower = HubManager(self.cloud, dict(), [], None, None, leader_lock=lock, state_sync_interval=60)
+        self.assertFalse(follower.ingesting)
+        stream_manager.return_value.start_stream.assert_called_once_with()  # By the leader only
+
+        leader.add_device("a")
+        self.assertTrue(follower.sync_state())
+        self.assertEqual(list(follower.managed_devices), ["a"])
+        self.assertTrue(follower.devices["a"].is_managed)
+        self.assertFalse(follower.sync_state())
+        follower.leader_elector.stop()
+
+    def test_follower_serves_relayed_vitals_only(self, stream_manager):
+        lock = MagicMock()
+        lock.acquire.return_value = False
+        follower = HubManager(self.cloud, dict(), [], None, None, leader_lock=lock, state_sync_interval=60,
+                              vitals_config=dict(ttl=60))
+        follower.vitals.refresh_async = MagicMock()
+        self.assertIsNone(follower.device_vitals("a"))
+        follower.vitals.store(DeviceVitals("a", status="ok"))
+        self.assertEqual(follower.device_vitals("a").status, "ok")
+        follower.vitals.refresh_async.assert_not_called()
+        follower.leader_elector.stop()
+        follower.vitals.close()
+
+    def test_backfill_polls_devices_missing_updates(self, stream_manager):
+        hub_manager = HubManager(self.cloud, dict(), [], None, None)
+        hub_manager.add_devices(["a", "b"])
+        hub_manager.devices["a"].variable_updated["temp"] = 100.0  # Heard from after the outage began
+        hub_manager.devices["b"].variable_updated["temp"] = 10.0
+        hub_manager.poller = MagicMock()
+        hub_manager.poller.poll.return_value = dict(b=MagicMock(values={"temp": 2.0}))
+        hub_manager.publish_device_data = MagicMock()
+
+        hub_manager.backfill_stream_gap(50.0, 120.0).join(1)
+        hub_manager.poller.poll.assert_called_once_with([hub_manager.devices["b"]])
+        hub_manager.publish_device_data.assert_called_once_with(hub_manager.devices["b"], {"temp": 2.0})
+        self.assertIsNone(hub_manager.backfill_stream_gap(5.0, 120.0))
+        self.assertEqual(stream_manager.call_args.kwargs["on_stream_gap"], hub_manager.backfill_stream_gap)
+
+    def test_lazy_start_serves_snapshot_until_cloud_answers(self, stream_manager):
+        leader = HubManager(self.cloud, dict(), [], None, None)  # Saves the device list snapshot
+        leader.add_device("a")
+        fetched = threading.Event()
+        self.cloud.get_device_list.side_effect = lambda max_age=None: (
+            fetched.wait(5), ([device_dict("a"), device_dict("b"), device_dict("c")], True))[1]
+
+        hub_manager = HubManager(self.cloud, dict(), [], None, None, lazy=True)
+        self.assertEqual(hub_manager.device_source, "snapshot")
+        self.assertEqual(sorted(hub_manager.devices), ["a", "b"])
+        self.assertEqual(list(hub_manager.managed_devices), ["a"])
+        self.assertFalse(hub_manager.ready)
+        self.assertEqual(hub_manager.health()["ingestion"], "starting")
+
+        fetched.set()
+        self.assertTrue(hub_manager.wait_until_ready(5))
+        self.assertEqual(hub_manager.device_source, "cloud")
+        self.assertIn("c", hub_manager.devices)
+        self.assertTrue(hub_manager.devices["a"].is_managed)
+        self.assertTrue(hub_manager.ingesting)
+
+    def test_lazy_start_without_cloud_retries_device_list(self, stream_manager):
+        attempts = list()
+
+        def get_device_list(max_age=None):
+            attempts.append(max_age)
+            if len(attempts) == 1:
+                raise requests.ConnectionError()
+            return [device_dict("a")], True
+
+        self.cloud.get_device_list.side_effect = get_device_list
+        hub_manager = HubManager(self.cloud, dict(), [], None, None, lazy=True)
+        self.assertTrue(hub_manager.wait_until_ready(5))
+        self.assertTrue(hub_manager.ingesting)
+        deadline = time.monotonic() + 5
+        while hub_manager.device_source != "cloud" and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(hub_manager.device_source, "cloud")
+        self.assertEqual(list(hub_manager.devices), ["a"])
+
+    def test_call_function_aggregates_results(self, stream_manager):
+        hub_manager = HubManager(self.cloud, dict(), [], None, None)
+        self.assertIs(hub_manager.commander.rate_limiter, hub_manager.poller.rate_limiter)
+        result = MagicMock()
+        result.to_dict.return_value = dict(status="success", return_value=1, attempts=1, elapsed=0.1)
+        hub_manager.commander = MagicMock()
+        hub_manager.commander.call.return_value = dict(a=result)
+        summary = hub_manager.call_function(["a", "missing"], "reset", "now")
+        hub_manager.commander.call.assert_called_once_with([hub_manager.devices["a"]], "reset", "now")
+        self.assertEqual((summary["succeeded"], summary["failed"]), (1, 1))
+        self.assertEqual(summary["results"]["missing"], dict(status="fail", error="unknown device"))
+        self.assertEqual(summary["results"]["a"]["return_value"], 1)
+
+    def test_vitals_logged_and_summarized(self, stream_manager):
+        hub_manager = HubManager(self.cloud, dict(), [], "influx", dict(), vitals_config=dict(ttl=60))
+        self.assertIs(hub_manager.vitals.rate_limiter, hub_manager.poller.rate_limiter)
+        device = hub_manager.devices["a"]
+        device.tags = dict(site="lab")
+        vitals = DeviceVitals("a", dict(battery_charge=90.0), "ok", "2021-01-01T00:00:00.000Z")
+        hub_manager.vitals._cache["a"] = vitals
+        hub_manager._log_vitals(device, vitals)
+        log_function = hub_manager.stream_manager.log_function
+        log_function.assert_called_once_with({"vitals_battery_charge": 90.0},
+                                             hub_manager.stream_manager.log_credentials, dict(site="lab"),
+                                             timestamp=1609459200000000000, device_id="a")
+        self.assertEqual(hub_manager.vitals_summary("a"), dict(status="ok", updated_at="2021-01-01T00:00:00.000Z",
+                                                               battery_charge=90.0))
+        self.assertIsNone(hub_manager.vitals_summary("b"))
+        hub_manager.vitals.close()
@@ -0,0 +1,80 @@
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from influxdb.exceptions import InfluxDBServerError
+from particlehub.models import InfluxBatchWriter
+from particlehub.spool import PointSpool
+
+
+@patch("particlehub.models.InfluxDBClient")
+class TestInfluxBatchWriter(TestCase):
+
+    def test_flush_in_batches(self, client_cls):
+        writer = InfluxBatchWriter(dict(host="localhost"), batch_size=2, flush_interval=60)
+        writer.write([{"measurement": "m%d" % i, "fields": {"value": i}} for i in range(5)])
+        writer.close()
+        batch_sizes = [len(c.args[0]) for c in client_cls.return_value.write_points.call_args_list]
+        self.assertEqual(sum(batch_sizes), 5)
+        self.assertTrue(all(size <= 2 for size in batch_sizes))
+        self.assertEqual(writer.stats()["written_points"], 5)
+        self.assertEqual(writer.queue_depth, 0)
+
+    def test_close_flushes_pending(self, client_cls):
+        writer = InfluxBatchWriter(dict(host="localhost"), batch_size=100, flush_interval=60)
+        writer.write([{"measurement": "m", "fields": {"value": 1}}])
+        writer.close()
+        client_cls.return_value.write_points.assert_called_once()
+        client_cls.return_value.close.assert_called_once()
+
+    def test_queue_overflow_drops_oldest(self, client_cls):
+        writer = InfluxBatchWriter(dict(host="localhost"), batch_size=100, flush_interval=60, max_queue_size=3)
+        writer.write([{"measurement": "m", "fields": {"value": i}} for i in range(5)])
+        self.assertEqual(writer.dropped_points, 2)
+        writer.close()
+        written = client_cls.return_value.write_points.call_args.args[0]
+        self.assertEqual([p["fields"]["value"] for p in written], [2, 3, 4])
+
+    def test_queue_overflow_spooled(self, client_cls):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = PointSpool(directory)
+            writer = InfluxBatchWriter(dict(host="localhost"), batch_size=100, flush_interval=60, max_queue_size=3,
+                                       spool=spool)
+            writer.write(["m value=%d.0 %d" % (i, i) for i in range(5)])
+            self.assertEqual((writer.dropped_points, writer.spooled_points), (0, 2))
+            self.assertTrue(spool.has_pending())
+            writer.close()
+        self.assertEqual(client_cls.call_args.kwargs, dict(host="localhost", timeout=10))
+
+    def test_failed_write_counts_dropped(self, client_cls):
+        client_cls.return_value.write_points.side_effect = InfluxDBServerError("down")
+        writer = InfluxBatchWriter(dict(host="localhost"), batch_size=100, flush_interval=60)
+        writer.write([{"measurement": "m", "fields": {"value": 1}}])
+        writer.close()
+        self.assertEqual(writer.stats()["dropped_points"], 1)
+        self.assertEqual(writer.stats()["flush_count"], 1)
+
+    def test_outage_spooled_and_replayed(self, client_cls):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = PointSpool(directory)
+            client_cls.return_value.write_points.side_effect = InfluxDBServerError("down")
+            writer = InfluxBatchWriter(dict(host="localhost"), batch_size=100, flush_interval=60, spool=spool)
+            writer.write([{"measurement": "m", "fields": {"value": 1}}])
+            writer.flush()
+            self.assertEqual(writer.spooled_points, 1)
+            self.assertEqual(writer.dropped_points, 0)
+
+            client_cls.return_value.write_points.side_effect = None
+            self.assertEqual(writer.replay_spool(), 1)
+            replayed = client_cls.return_value.write_points.call_args.args[0]
+            self.assertIn("time", replayed[0])
+            self.assertFalse(spool.has_pending())
+            writer.close()
+
+    def test_lines_written_with_line_protocol(self, client_cls):
+        writer = InfluxBatchWriter(dict(host="localhost"), batch_size=100, flush_interval=60)
+        writer.write(["temp value=1.0 5", {"measurement": "m", "fields": {"value": 1}}])
+        writer.close()
+        calls = client_cls.return_value.write_points.call_args_list
+        self.assertEqual(calls[0].args[0], ["temp value=1.0 5"])
+        self.assertEqual(calls[0].kwargs, dict(protocol="line"))
+        self.assertEqual(calls[1].args[0], [{"measurement": "m", "fields": {"value": 1}}])
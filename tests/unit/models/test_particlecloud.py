@@ -1,5 +1,9 @@
+import requests
 from unittest import TestCase
-from particlehub.models import ParticleCloud
+from unittest.mock import patch, MagicMock
+from particlehub.models import ParticleCloud, CloudCommunicationError
+
+DEVICE = dict(id="abc", name="sensor", variables={}, notes=None, connected=True, online=True, status="normal")
 
 
 class TestParticleCloud(TestCase):
@@ -7,3 +11,35 @@ class TestParticleCloud(TestCase):
     def test_create_cloud(self):
         cloud = ParticleCloud(cloud_api_token="abc123")
         self.assertEqual(cloud.cloud_api_token, "abc123", "Cloud API token not equal to the constructor argument")
+
+    @patch("particlehub.models.http_session")
+    def test_device_list_cache(self, session):
+        session.get.return_value = MagicMock(status_code=200, headers={"ETag": "v1"},
+                                             json=MagicMock(return_value=[DEVICE]))
+        cloud = ParticleCloud(cloud_api_token="abc123", cache_ttl=60)
+        self.assertEqual(cloud.get_device_list(), ([DEVICE], True))
+        self.assertEqual(cloud.get_device_list(), ([DEVICE], False))
+        self.assertEqual(session.get.call_count, 1)
+
+        session.get.return_value = MagicMock(status_code=304)
+        self.assertEqual(cloud.get_device_list(max_age=0), ([DEVICE], False))
+        self.assertEqual(session.get.call_args.kwargs["headers"], {"If-None-Match": "v1"})
+
+    @patch("particlehub.models.http_session")
+    def test_get_devices(self, session):
+        session.get.return_value = MagicMock(status_code=200, headers={}, json=MagicMock(return_value=[DEVICE]))
+        devices = ParticleCloud(cloud_api_token="abc123").get_devices()
+        self.assertEqual(devices["abc"].name, "sensor")
+
+    @patch("particlehub.models.http_session")
+    def test_device_list_errors(self, session):
+        cloud = ParticleCloud(cloud_api_token="abc123", timeout=3)
+        for error in (requests.ConnectionError(), requests.Timeout()):
+            session.get.side_effect = error
+            with self.assertRaises(CloudCommunicationError):
+                cloud.get_device_list()
+        self.assertEqual(session.get.call_args.kwargs["timeout"], 3)
+        session.get.side_effect = None
+        session.get.return_value = MagicMock(status_code=200, json=MagicMock(side_effect=ValueError()))
+        with self.assertRaises(CloudCommunicationError):
+            cloud.get_device_list()
@@ -0,0 +1,52 @@
+from unittest import TestCase
+from unittest.mock import patch, Mock
+import simplejson as json
+from particlehub.models import StreamManager, Device, _log_to_influx
+from particlehub.sharding import ShardFrame
+
+
+def frame(data, published_at="2021-01-01T00:00:00.000Z"):
+    return ShardFrame("DATA", json.dumps(dict(data=data, ttl=60, published_at=published_at, coreid="device1")))
+
+
+class TestStreamManager(TestCase):
+
+    def setUp(self):
+        self.device = Device("device1", None)
+        self.stream_manager = StreamManager(dict(url="http://localhost", handler_workers=0), [], "influx", dict(),
+                                            managed_devices=dict(device1=self.device))
+        self.stream_manager.log_function = Mock()
+
+    def test_redelivered_event_handled_once(self):
+        self.stream_manager._handle_msg(frame("temp=21.5"))
+        self.stream_manager._handle_msg(frame("temp=21.5"))
+        self.stream_manager._handle_msg(frame("temp=21.5", published_at="2021-01-01T00:00:01.000Z"))
+        self.assertEqual(self.stream_manager.log_function.call_count, 2)
+        self.assertEqual(self.stream_manager.stats()["dedup_hits"], 1)
+
+    def test_dedup_disabled(self):
+        stream_manager = StreamManager(dict(url="http://localhost", handler_workers=0, dedup=None), [], "influx",
+                                       dict(), managed_devices=dict(device1=self.device))
+        stream_manager.log_function = Mock()
+        stream_manager._handle_msg(frame("temp=21.5"))
+        stream_manager._handle_msg(frame("temp=21.5"))
+        self.assertEqual(stream_manager.log_function.call_count, 2)
+
+    def test_points_timed_by_published_at(self):
+        self.stream_manager._handle_msg(frame("temp=21.5;temp=21.6", published_at="2021-01-01T00:00:00.250Z"))
+        timestamps = [c.kwargs["timestamp"] for c in self.stream_manager.log_function.call_args_list]
+        self.assertEqual(timestamps, [1609459200250000000, 1609459200250000001])
+
+    @patch("particlehub.models.get_influx_writer")
+    def test_log_to_influx_sets_point_time(self, get_influx_writer):
+        _log_to_influx({"temp": 21.5}, dict(), dict(site="lab"), timestamp=5)
+        _log_to_influx({"hum": 40}, dict(), dict())
+        lines = [c.args[0][0] for c in get_influx_writer.return_value.write.call_args_list]
+        self.assertEqual(lines[0], "temp,site=lab value=21.5 5")
+        self.assertRegex(lines[1], r"^hum value=40.0 \d{19}$")
+
+    @patch("particlehub.models.get_influx_writer")
+    def test_log_to_influx_skips_only_tag_variables(self, get_influx_writer):
+        _log_to_influx({"site": "lab", "temp": 21.5, "hum": 40}, dict(), dict(site="lab"), timestamp=5)
+        lines = get_influx_writer.return_value.write.call_args.args[0]
+        self.assertEqual(lines, ["temp,site=lab value=21.5 5", "hum,site=lab value=40.0 5"])
@@ -0,0 +1,47 @@
+from unittest import TestCase
+from particlehub.parser import DataParser
+
+
+class TestDataParser(TestCase):
+
+    def setUp(self):
+        self.parser = DataParser()
+
+    def test_typed_values(self):
+        self.assertEqual(self.parser.parse("temp=21.5,count=3,on=true,name=lab"),
+                         dict(temp=21.5, count=3, on=True, name="lab"))
+
+    def test_string_values_do_not_fix_the_type(self):
+        self.assertEqual(self.parser.parse("temp=,hum=40", "d"), dict(temp="", hum=40.0))
+        self.assertEqual(self.parser.parse("temp=21.5", "d"), dict(temp=21.5))
+        self.assertEqual(self.parser.parse("temp=nan", "d"), dict(temp="nan"))
+        self.assertEqual(self.parser.parse("temp=22", "d"), dict(temp=22.0))
+        self.assertEqual(self.parser.parse("temp=true", "d"), dict(temp=1.0))
+
+    def test_bool_keys_stay_bool(self):
+        self.assertIs(self.parser.parse("ok=true", "d")["ok"], True)
+        self.assertIs(self.parser.parse("ok=0", "d")["ok"], False)
+        self.assertEqual(self.parser.parse("ok=2.5", "d"), dict(ok=2.5))
+
+    def test_non_finite_and_python_literals_stay_strings(self):
+        self.assertEqual(self.parser.parse("a=nan,b=inf,c=-Infinity,d=1_000,e= 5,f=1e999,g=-.5e2"),
+                         dict(a="nan", b="inf", c="-Infinity", d="1_000", e=" 5", f="1e999", g=-50.0))
+
+    def test_separators_in_values(self):
+        self.assertEqual(self.parser.parse("expr=a=b,,empty=,=orphan,msg=x\\,y\\=z"),
+                         dict(expr="a=b", empty="", msg="x,y=z"))
+
+    def test_batched_samples(self):
+        self.assertEqual(self.parser.parse_samples("t=1,h=2;t=3,h=4;"), [dict(t=1, h=2), dict(t=3, h=4)])
+        self.assertEqual(self.parser.parse_samples("a=1\\;;b=2"), [dict(a="1;"), dict(b=2)])
+
+    def test_schema_cache(self):
+        self.parser.parse("temp=21.5", "dev")
+        self.assertEqual(self.parser.parse("temp=21", "dev"), dict(temp=21.0))
+        self.assertIsInstance(self.parser.parse("temp=21", "dev")["temp"], float)
+        count = self.parser.parse("count=1", "dev")["count"]  # An integral first value must not fix an int type
+        self.assertIsInstance(count, float)
+        self.assertIsInstance(self.parser.parse("count=1.5", "dev")["count"], float)
+        self.assertEqual(self.parser.parse("count=1.5", "dev"), dict(count=1.5))
+        self.parser.clear("dev")
+        self.assertEqual(self.parser.schema, dict())
@@ -0,0 +1,59 @@
+import threading
+from unittest import TestCase
+import sseclient
+import simplejson as json
+from particlehub.pipeline import EventPipeline
+
+
+def make_event(coreid, seq):
+    data = json.dumps(dict(coreid=coreid, data="seq=%d" % seq))
+    return sseclient.Event(data=data, event="DATA"), json.loads(data)
+
+
+class TestEventPipeline(TestCase):
+
+    def test_per_key_ordering(self):
+        handled = dict()
+        pipeline = EventPipeline(lambda event, data: handled.setdefault(data["coreid"], []).append(data["data"]),
+                                 workers=3)
+        pipeline.start()
+        for seq in range(50):
+            for coreid in ("a", "b", "c", "d"):
+                pipeline.submit(coreid, *make_event(coreid, seq))
+        pipeline.close()
+        for coreid in ("a", "b", "c", "d"):
+            self.assertEqual(handled[coreid], ["seq=%d" % seq for seq in range(50)])
+        self.assertEqual(pipeline.stats()["handle_time"]["count"], 200)
+
+    def test_drop_oldest(self):
+        release = threading.Event()
+        handled = list()
+
+        def handler(event, data):
+            release.wait()
+            handled.append(data["data"])
+
+        pipeline = EventPipeline(handler, workers=1, max_queue_size=2, backpressure="drop_oldest")
+        for seq in range(5):
+            pipeline.submit("a", *make_event("a", seq))
+        self.assertEqual(pipeline.dropped, 3)
+        release.set()
+        pipeline.start()
+        pipeline.close()
+        self.assertEqual(handled, ["seq=3", "seq=4"])
+
+    def test_spill_preserves_order(self):
+        handled = list()
+        pipeline = EventPipeline(lambda event, data: handled.append(data["data"]), workers=1, max_queue_size=2,
+                                 backpressure="spill")
+        for seq in range(6):
+            pipeline.submit("a", *make_event("a", seq))
+        self.assertEqual(pipeline.spilled, 4)
+        self.assertEqual(pipeline.queue_depth, 6)
+        pipeline.start()
+        pipeline.close()
+        self.assertEqual(handled, ["seq=%d" % seq for seq in range(6)])
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            EventPipeline(lambda event, data: None, backpressure="unknown")
@@ -0,0 +1,63 @@
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock
+from particlehub.models import Device
+from particlehub.polling import PollingService, PollResult
+
+
+class TestPollingService(TestCase):
+
+    def setUp(self):
+        self.device = Device("dev", "token", variables={"temp": "double", "hum": "double"}, online=True)
+        self.hub_manager = MagicMock(managed_devices={"dev": self.device})
+        result = PollResult("dev")
+        result.values = {"temp": 20.0}
+        self.hub_manager.poller.poll_device.return_value = result
+        self.service = PollingService(self.hub_manager, default_interval=60, variable_intervals={"hum": 600})
+
+    def test_sync_jobs(self):
+        self.service.sync()
+        self.assertEqual([job.id for job in self.service.scheduler.get_jobs()], ["dev"])
+        self.hub_manager.managed_devices = dict()
+        self.service.sync()
+        self.assertEqual(self.service.scheduler.get_jobs(), [])
+
+    def test_skips_fresh_stream_data(self):
+        self.device.variable_updated["hum"] = time.monotonic()
+        self.service.poll_device("dev")
+        self.hub_manager.poller.poll_device.assert_called_once_with(self.device, ["temp"])
+        self.hub_manager.publish_device_data.assert_called_once_with(self.device, {"temp": 20.0})
+
+        self.device.variable_updated["temp"] = time.monotonic()
+        self.assertIsNone(self.service.poll_device("dev"))
+        self.assertEqual(self.service.skipped, 1)
+
+    def test_offline_backoff(self):
+        self.device.online = False
+        self.service.poll_device("dev")
+        self.hub_manager.poller.poll_device.assert_not_called()
+        self.assertEqual(self.service.failures["dev"], 1)
+        self.device.online = True
+        self.service.poll_device("dev")  # Still inside the backoff window
+        self.hub_manager.poller.poll_device.assert_not_called()
+        self.service.next_allowed["dev"] = 0
+        self.service.poll_device("dev")
+        self.hub_manager.poller.poll_device.assert_called_once()
+        self.assertNotIn("dev", self.service.failures)
+
+    def test_offline_device_probed_after_backoff(self):
+        self.device.online = False
+        self.service.poll_device("dev")
+        self.service.next_allowed["dev"] = 0
+        self.service.poll_device("dev")
+        self.hub_manager.poller.poll_device.assert_called_once_with(self.device, ["temp"])
+        self.assertTrue(self.device.online)
+        self.assertNotIn("dev", self.service.failures)
+
+        self.device.online = False
+        self.hub_manager.poller.poll_device.return_value = PollResult("dev")
+        self.service.poll_device("dev")
+        self.service.next_allowed["dev"] = 0
+        self.service.poll_device("dev")
+        self.assertFalse(self.device.online)
+        self.assertEqual(self.service.failures["dev"], 2)
@@ -0,0 +1,89 @@
+import time
+import threading
+from unittest import TestCase
+from particlehub.models import Device, CloudCommunicationError
+from particlehub.polling import VariablePoller, TokenBucket, AccountLimiter
+
+
+class FakeDevice(Device):
+
+    def __init__(self, device_id, values, delay=0.05, **kwargs):
+        super().__init__(device_id, "token", variables={name: "int32" for name in values}, **kwargs)
+        self.values = values
+        self.delay = delay
+        self.timeouts = list()
+
+    def fetch_variable(self, var, timeout=None):
+        self.timeouts.append(timeout)
+        time.sleep(self.delay)
+        value = self.values[var]
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+class TestVariablePoller(TestCase):
+
+    def test_poll_concurrently(self):
+        devices = [FakeDevice("dev%d" % i, {"v%d" % j: j for j in range(5)}) for i in range(4)]
+        poller = VariablePoller(max_workers=20, account_concurrency=20, rate=1000, burst=1000)
+        start = time.monotonic()
+        results = poller.poll(devices)
+        self.assertLess(time.monotonic() - start, 0.05 * 20 / 2)
+        for device in devices:
+            self.assertTrue(results[device.id].ok)
+            self.assertEqual(device.variable_state, {"v%d" % j: j for j in range(5)})
+        poller.close()
+
+    def test_per_variable_errors_and_tags(self):
+        device = FakeDevice("dev", {"temp": 21.5, "hum": CloudCommunicationError("HTTP 408")}, delay=0,
+                            tags={"temp": None})
+        poller = VariablePoller(timeout=2.5)
+        result = poller.poll_device(device)
+        self.assertEqual(device.timeouts, [2.5, 2.5])
+        self.assertEqual(result.values, {"temp": 21.5})
+        self.assertEqual(result.errors, {"hum": "HTTP 408"})
+        self.assertEqual(device.tags, {"temp": 21.5})
+        self.assertNotIn("hum", device.variable_state)
+        poller.close()
+
+    def test_account_concurrency(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        class CountingDevice(FakeDevice):
+            def fetch_variable(self, var, timeout=None):
+                with lock:
+                    active.append(var)
+                    peak.append(len(active))
+                time.sleep(0.02)
+                with lock:
+                    active.remove(var)
+                return 1
+
+        device = CountingDevice("dev", {"v%d" % j: j for j in range(10)})
+        poller = VariablePoller(max_workers=10, account_concurrency=2, rate=1000, burst=1000)
+        poller.poll_device(device)
+        self.assertLessEqual(max(peak), 2)
+        poller.close()
+
+
+class TestAccountLimiter(TestCase):
+
+    def test_one_semaphore_per_token(self):
+        limiter = AccountLimiter(concurrency=1)
+        self.assertIs(limiter.limit("a"), limiter.limit("a"))
+        with limiter.limit("a"):
+            self.assertFalse(limiter.limit("a").acquire(blocking=False))
+            self.assertTrue(limiter.limit("b").acquire(blocking=False))
+
+
+class TestTokenBucket(TestCase):
+
+    def test_rate_limit(self):
+        bucket = TokenBucket(rate=100, burst=5)
+        start = time.monotonic()
+        for _ in range(15):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
@@ -0,0 +1,55 @@
+import os
+import tempfile
+from unittest import TestCase
+import simplejson as json
+from particlehub.recording import EventRecorder, EventFileReader
+from particlehub.sharding import ShardFrame
+
+
+def frame(data="temp=21.5", published_at="2021-01-01T00:00:00.000Z", coreid="device1"):
+    return ShardFrame("DATA", json.dumps(dict(data=data, ttl=60, published_at=published_at, coreid=coreid)))
+
+
+class TestEventRecorder(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_recorded_frames_read_back(self):
+        recorder = EventRecorder(self.directory.name, segment_bytes=300)
+        frames = [frame(published_at="2021-01-01T00:00:0%d.000Z" % i) for i in range(5)]
+        for recorded in frames:
+            recorder.record(recorded)
+        recorder.close()
+        segments = sorted(os.listdir(self.directory.name))
+        self.assertEqual(len(segments), recorder.stats()["segments"])
+        self.assertGreater(len(segments), 1)
+        self.assertTrue(all(name.endswith(".ndjson.gz") for name in segments))
+        self.assertEqual(list(EventFileReader([self.directory.name])), frames)
+
+    def test_exported_events_and_malformed_lines(self):
+        path = os.path.join(self.directory.name, "export.jsonl")
+        with open(path, "w") as export:
+            export.write(json.dumps(dict(name="DATA", data="temp=1", published_at="2021-01-01T00:00:00.000Z",
+                                         coreid="device1")) + "\n\nnot json\n")
+        reader = EventFileReader([path])
+        frames = list(reader)
+        self.assertEqual(frames[0].event, "DATA")
+        self.assertEqual(json.loads(frames[0].data), dict(data="temp=1", published_at="2021-01-01T00:00:00.000Z",
+                                                         coreid="device1"))
+        self.assertEqual((reader.events, reader.malformed), (1, 1))
+
+    def test_truncated_segment_keeps_complete_events(self):
+        recorder = EventRecorder(self.directory.name)
+        for _ in range(100):
+            recorder.record(frame())
+        recorder._file.flush()  # Simulates a crash: the ".part" segment is never finished
+        path = recorder._path + ".part"
+        with open(path, "rb") as segment:
+            data = segment.read()
+        with open(path, "wb") as segment:
+            segment.write(data[:len(data) - 4])
+        self.assertGreater(len(list(EventFileReader([self.directory.name]))), 0)
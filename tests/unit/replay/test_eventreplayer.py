@@ -0,0 +1,66 @@
+import os
+import gzip
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock
+import simplejson as json
+from particlehub.models import StreamManager, Device
+from particlehub.replay import EventReplayer
+from particlehub.timeseries import parse_timestamp_ns
+
+
+def record(event, data, published_at, coreid):
+    frame_data = json.dumps(dict(data=data, ttl=60, published_at=published_at, coreid=coreid))
+    return json.dumps(dict(event=event, data=frame_data)) + "\n"
+
+
+class TestEventReplayer(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "events.ndjson.gz")
+        with gzip.open(self.path, "wt") as events:
+            for second in range(50):
+                for device_id in ("device1", "device2", "unmanaged"):
+                    events.write(record("DATA", "seq=%d" % second, "2021-01-01T00:00:%02d.000Z" % second,
+                                        device_id))
+            events.write(record("OTHER", "x", "2021-01-01T00:01:00.000Z", "device1"))
+        self.stream_manager = StreamManager(dict(url="http://localhost", handler_workers=0), [], "influx", dict(),
+                                            managed_devices=dict(device1=Device("device1", None),
+                                                                 device2=Device("device2", None)))
+        self.stream_manager.log_function = Mock()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def logged(self):
+        points = dict()
+        for c in self.stream_manager.log_function.call_args_list:
+            points.setdefault(c.kwargs["device_id"], list()).append((c.args[0]["seq"], c.kwargs["timestamp"]))
+        return points
+
+    def test_replay_keeps_device_order_and_times(self):
+        stats = EventReplayer(self.stream_manager, workers=2).run([self.directory.name])
+        self.assertEqual((stats["events"], stats["replayed"], stats["skipped"], stats["devices"]), (151, 100, 51, 2))
+        self.assertEqual(stats["first_published_at"], "2021-01-01T00:00:00.000Z")
+        points = self.logged()
+        self.assertEqual(sorted(points), ["device1", "device2"])
+        self.assertEqual(points["device1"], [(second, parse_timestamp_ns("2021-01-01T00:00:%02d.000Z" % second))
+                                             for second in range(50)])
+        self.assertEqual(self.stream_manager.managed_devices["device1"].variable_state["seq"], 49)
+
+    def test_rebase_and_add_devices(self):
+        rebase_to = parse_timestamp_ns("2022-06-01T12:00:00.000Z")
+        stats = EventReplayer(self.stream_manager, rebase_to=rebase_to, add_devices=True).run([self.path])
+        self.assertEqual(stats["replayed"], 150)
+        self.assertEqual(stats["time_offset"], rebase_to - parse_timestamp_ns("2021-01-01T00:00:00.000Z"))
+        points = self.logged()
+        self.assertEqual(points["unmanaged"][0], (0, rebase_to))
+        self.assertEqual(points["device2"][-1], (49, rebase_to + 49 * 10 ** 9))
+
+    def test_dry_run_handles_nothing(self):
+        stats = EventReplayer(self.stream_manager, dry_run=True, add_devices=True).run([self.path])
+        self.assertEqual((stats["replayed"], stats["devices"]), (150, 3))
+        self.assertEqual(stats["last_published_at"], "2021-01-01T00:00:49.000Z")
+        self.stream_manager.log_function.assert_not_called()
+        self.assertNotIn("unmanaged", self.stream_manager.managed_devices)
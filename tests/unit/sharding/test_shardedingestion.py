@@ -0,0 +1,50 @@
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock
+from particlehub.sharding import HashRing, ShardedIngestion, extract_coreid
+
+
+class TestHashRing(TestCase):
+
+    def test_spread_and_stability(self):
+        device_ids = ["device-%d" % i for i in range(1000)]
+        ring = HashRing(4)
+        counts = [0] * 4
+        for device_id in device_ids:
+            counts[ring.shard_for(device_id)] += 1
+        self.assertTrue(all(count > 150 for count in counts))
+        grown = HashRing(5)
+        moved = sum(1 for device_id in device_ids if ring.shard_for(device_id) != grown.shard_for(device_id))
+        self.assertLess(moved, 400)
+
+    def test_extract_coreid(self):
+        self.assertEqual(extract_coreid('{"data":"a=1","coreid":"abc","published_at":"x"}'), "abc")
+        self.assertEqual(extract_coreid('{"coreid": "abc"}'), "abc")
+        self.assertIsNone(extract_coreid('{"data":"a=1"}'))
+
+
+class TestShardedIngestion(TestCase):
+
+    def test_frames_handled_in_shard_processes(self):
+        received = list()
+        sharded = ShardedIngestion(2, dict(url=None), None, [None, None], received.extend, flush_interval=0.01)
+        sharded.start()
+        try:
+            devices = {device_id: MagicMock(tags={}) for device_id in ("a", "b", "c")}
+            sharded.assign(devices)
+            for device_id in devices:
+                data = '{"data":"temp=1.5","coreid":"%s","published_at":"2021-01-01T00:00:00.000Z"}' % device_id
+                sharded.submit(device_id, "DATA", data)
+            deadline = time.monotonic() + 30
+            while len(received) < 3 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            sharded.stop()
+        self.assertEqual(sorted(sample[0] for sample in received), ["a", "b", "c"])
+        self.assertEqual(received[0][1], dict(temp=1.5))
+        self.assertEqual(sum(sharded.stats()["shard_devices"]), 3)
+
+    def test_assign_before_start(self):
+        sharded = ShardedIngestion(2, dict(url=None), None, [None, None], list)
+        sharded.assign(dict(a=MagicMock(tags={})))
+        self.assertEqual(sum(sharded.stats()["shard_devices"]), 1)
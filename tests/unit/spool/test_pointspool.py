@@ -0,0 +1,78 @@
+import os
+import tempfile
+from unittest import TestCase
+from particlehub.spool import PointSpool, SpoolLockedError
+
+
+def batch(start, count):
+    return [{"measurement": "m", "fields": {"value": i}} for i in range(start, start + count)]
+
+
+class TestPointSpool(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_append_read_commit(self):
+        spool = PointSpool(self.path)
+        spool.append(batch(0, 3))
+        spool.append(batch(3, 3))
+        points, position = spool.read_batch(4)
+        self.assertEqual([p["fields"]["value"] for p in points], [0, 1, 2])
+        spool.commit(position)
+        points, position = spool.read_batch(10)
+        self.assertEqual([p["fields"]["value"] for p in points], [3, 4, 5])
+        spool.commit(position)
+        self.assertFalse(spool.has_pending())
+        spool.close()
+
+    def test_checkpoint_survives_restart(self):
+        spool = PointSpool(self.path, segment_bytes=200)
+        for start in range(0, 12, 3):
+            spool.append(batch(start, 3))
+        self.assertGreater(len(spool.segments), 1)
+        points, position = spool.read_batch(6)
+        spool.commit(position)
+        spool.close()
+
+        spool = PointSpool(self.path, segment_bytes=200)
+        points, position = spool.read_batch(100)
+        self.assertEqual([p["fields"]["value"] for p in points], list(range(6, 12)))
+        spool.commit(position)
+        self.assertEqual(len(os.listdir(self.path)), 2)  # Active segment and checkpoint
+        spool.close()
+
+    def test_torn_tail_is_truncated(self):
+        spool = PointSpool(self.path)
+        spool.append(batch(0, 2))
+        spool.close()
+        segment = os.path.join(self.path, sorted(os.listdir(self.path))[0])
+        with open(segment, "ab") as f:
+            f.write(b"\x40\x00\x00\x00\x00\x00")
+        spool = PointSpool(self.path)
+        spool.append(batch(2, 1))
+        points, position = spool.read_batch(10)
+        self.assertEqual([p["fields"]["value"] for p in points], [0, 1, 2])
+        spool.close()
+
+    def test_size_cap_drops_oldest(self):
+        spool = PointSpool(self.path, segment_bytes=150, max_bytes=400)
+        for start in range(0, 30, 3):
+            spool.append(batch(start, 3))
+        self.assertGreater(spool.dropped_segments, 0)
+        self.assertLessEqual(spool.pending_bytes, 400)
+        points, position = spool.read_batch(100)
+        self.assertEqual(points[-1]["fields"]["value"], 29)
+        spool.close()
+
+    def test_single_owner(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spool = PointSpool(directory)
+            with self.assertRaises(SpoolLockedError):
+                PointSpool(directory)
+            spool.close()
+            PointSpool(directory).close()
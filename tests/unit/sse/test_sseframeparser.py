@@ -0,0 +1,25 @@
+from unittest import TestCase
+from particlehub.sse import SSEFrameParser, Backoff, request_headers
+
+
+class TestSSEFrameParser(TestCase):
+
+    def test_split_frames_and_utf8(self):
+        parser = SSEFrameParser()
+        data = ":ok\n\nid: 1\nevent: DATA\ndata: t=21\xb0C\n\nevent: DATA\ndata: x".encode()
+        self.assertEqual(parser.feed(data[:12]), [])
+        events = parser.feed(data[12:34]) + parser.feed(data[34:])  # The split falls inside the degree sign
+        self.assertEqual([(event.id, event.data) for event in events], [("1", "t=21\xb0C")])
+        self.assertEqual(parser.feed(b"=1\r\n\r\n")[0].data, "x=1")
+
+    def test_backoff(self):
+        backoff = Backoff(base=1.0, maximum=3.0)
+        delays = [backoff.next_delay() for _ in range(5)]
+        self.assertTrue(all(0 <= delay <= bound for delay, bound in zip(delays, [1, 2, 3, 3, 3])))
+        backoff.reset()
+        self.assertLessEqual(backoff.next_delay(), 1.0)
+
+    def test_request_headers(self):
+        self.assertEqual(request_headers(dict(Authorization="Bearer x"), "7"),
+                         {"Accept": "text/event-stream", "Cache-Control": "no-cache", "Authorization": "Bearer x",
+                          "Last-Event-ID": "7"})
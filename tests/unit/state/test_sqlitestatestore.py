@@ -0,0 +1,80 @@
+import os
+import pickle
+import tempfile
+from unittest import TestCase
+from particlehub.state import SQLiteStateStore, open_state_store
+
+
+class TestSQLiteStateStore(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "phstate.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_incremental_updates(self):
+        store = SQLiteStateStore(self.path)
+        self.assertIsNone(store.load())
+        store.set_managed(["a", "b"], True)
+        store.set_tags("a", {"room": "lab"})
+        store.set_managed(["b"], False)
+        store.close()
+
+        state = SQLiteStateStore(self.path).load()
+        self.assertEqual(state["managed_device_ids"], ["a"])
+        self.assertEqual(state["tags"], {"a": {"room": "lab"}, "b": {}})
+
+    def test_batch_is_atomic(self):
+        store = SQLiteStateStore(self.path)
+        with self.assertRaises(RuntimeError):
+            with store.batch():
+                store.set_managed(["a", "b"], True)
+                raise RuntimeError()
+        self.assertIsNone(store.load())
+        with store.batch():
+            store.set_managed(["a"], True)
+            store.set_tags("a", {"x": 1})
+        self.assertEqual(store.load()["managed_device_ids"], ["a"])
+
+    def test_version_tracks_device_changes_only(self):
+        store, other = SQLiteStateStore(self.path), SQLiteStateStore(self.path)
+        version = other.version()
+        store.set_managed(["a"], True)
+        self.assertNotEqual(other.version(), version)
+        version = other.version()
+        store.publish_updates(dict(devices=dict()))
+        store.save_device_snapshot([dict(id="a")])
+        self.assertEqual(other.version(), version)
+        store.set_tags("a", {"room": "lab"})
+        self.assertNotEqual(other.version(), version)
+        store.close()
+        other.close()
+
+    def test_pickle_migration(self):
+        legacy = os.path.join(self.directory.name, "phstate.pkl")
+        with open(legacy, "wb") as state_file:
+            pickle.dump(dict(managed_device_ids=["a"], tags={"a": {"t": 1}, "b": {}}), state_file)
+        store = open_state_store(legacy)
+        self.assertEqual(store.path, self.path)
+        self.assertEqual(store.load(), dict(managed_device_ids=["a"], tags={"a": {"t": 1}, "b": {}}))
+        self.assertFalse(os.path.exists(legacy))
+        self.assertTrue(os.path.exists(legacy + ".migrated"))
+
+    def test_pickle_migration_without_pkl_extension(self):
+        legacy = os.path.join(self.directory.name, "phstate")
+        with open(legacy, "wb") as state_file:
+            pickle.dump(dict(managed_device_ids=["a"], tags={"a": {}}), state_file)
+        store = open_state_store(legacy)
+        self.assertEqual(store.path, legacy + ".db")
+        self.assertEqual(store.load()["managed_device_ids"], ["a"])
+        store.set_tags("a", {"t": 1})
+        store.close()
+        self.assertTrue(os.path.exists(legacy + ".migrated"))
+
+        store = open_state_store(legacy)  # The pickle is gone, the migrated database is reopened
+        self.assertEqual(store.path, legacy + ".db")
+        self.assertEqual(store.load()["tags"], {"a": {"t": 1}})
+        store.close()
+        self.assertEqual(open_state_store(self.path).path, self.path)
@@ -0,0 +1,86 @@
+import time
+import threading
+from unittest import TestCase
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from particlehub.stream_supervisor import StreamSupervisor
+
+
+class _EventsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests_seen = None
+    hold = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests_seen.append(dict(self.headers))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if self.headers.get("Last-Event-ID") is None:
+            self._chunk(":ok\n\nid: 1\nevent: DATA\ndata: {\"a\": 1}\n\n")
+            self._chunk("id: 2\nevent: DATA\ndata: {\"a\": 2}\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        else:
+            self._chunk("id: 3\nevent: LOG\ndata: {\"a\": 3}\n\n")
+            self.hold.wait(5)  # Keeps the stream open and silent
+
+    def _chunk(self, text):
+        data = text.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class TestStreamSupervisor(TestCase):
+
+    def setUp(self):
+        self.requests_seen = list()
+        self.hold = threading.Event()
+        handler = type("Handler", (_EventsHandler,), dict(requests_seen=self.requests_seen, hold=self.hold))
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/v1/devices/events" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.hold.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_reconnect_resumes_and_reports_gap(self):
+        received = list()
+        gaps = list()
+        supervisor = StreamSupervisor(self.url, lambda event: received.append(event.id),
+                                      on_gap=lambda started, ended: gaps.append((started, ended)),
+                                      backoff_base=0.01, min_gap=0)
+        supervisor.start()
+        self._wait_for(lambda: received == ["1", "2", "3"])
+        self.assertEqual(self.requests_seen[1].get("Last-Event-ID"), "2")
+        self.assertEqual(len(gaps), 1)
+        self.assertLessEqual(gaps[0][0], gaps[0][1])
+        self.assertEqual(supervisor.stats()["reconnects"], 1)
+        self.assertTrue(supervisor.stats()["connected"])
+
+        start = time.monotonic()
+        supervisor.stop(timeout=2)  # Interrupts the read blocked on the silent stream
+        self.assertFalse(supervisor.running)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(len(self.requests_seen), 2)
+
+    def test_idle_stream_reconnects(self):
+        supervisor = StreamSupervisor(self.url, lambda event: None, idle_timeout=0.2, backoff_base=0.01)
+        supervisor.last_event_id = "9"  # Every connection resumes and then stays silent
+        supervisor.start()
+        self._wait_for(lambda: len(self.requests_seen) >= 3)
+        supervisor.stop(timeout=2)
+        self.assertFalse(supervisor.running)
+        self.assertGreaterEqual(supervisor.reconnects, 2)
@@ -0,0 +1,75 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+from particlehub.timeseries import TimeSeriesCache, SeriesBuffer, parse_timestamp_ns, NS_PER_SECOND
+
+
+class TestSeriesBuffer(TestCase):
+
+    def test_ring_wraps_in_order(self):
+        series = SeriesBuffer(3)
+        for t in range(5):
+            series.append(t, t * 1.5)
+        self.assertEqual(series.range(), [[2, 3.0], [3, 4.5], [4, 6.0]])
+        self.assertEqual(series.range(3, 4), [[3, 4.5]])
+        self.assertEqual(series.last(), (4, 6.0))
+        self.assertFalse(series.append(1, 0.0))
+
+    def test_grows_on_demand(self):
+        series = SeriesBuffer(40)
+        series.append(0, 0.0)
+        self.assertEqual(len(series.times), SeriesBuffer.initial_size)
+        for t in range(1, 16):
+            series.append(t, float(t))
+        series.trim(10)  # The next appends wrap around the start of the arrays before they grow
+        for t in range(16, 60):
+            series.append(t, float(t))
+        self.assertEqual(len(series.times), 40)
+        self.assertEqual(series.range(), [[t, float(t)] for t in range(20, 60)])
+
+    def test_downsample(self):
+        series = SeriesBuffer(10)
+        for t, value in [(0, 1.0), (5, 3.0), (10, 2.0), (19, 4.0), (20, 5.0)]:
+            series.append(t, value)
+        self.assertEqual(series.downsample(10), [dict(time=0, min=1.0, max=3.0, mean=2.0, count=2),
+                                                 dict(time=10, min=2.0, max=4.0, mean=3.0, count=2),
+                                                 dict(time=20, min=5.0, max=5.0, mean=5.0, count=1)])
+
+
+class TestTimeSeriesCache(TestCase):
+
+    def setUp(self):
+        self.cache = TimeSeriesCache(window=10, max_samples=100)
+
+    def test_window_and_numeric_only(self):
+        for second in range(30):
+            self.cache.record("dev", dict(temp=second, name="lab"), second * NS_PER_SECOND)
+        points, source = self.cache.query("dev", "temp")
+        self.assertEqual(source, "cache")
+        self.assertEqual(points[0], [19 * NS_PER_SECOND, 19.0])
+        self.assertEqual(self.cache.last("dev"), dict(temp=[29 * NS_PER_SECOND, 29.0]))
+        self.assertEqual(self.cache.stats()["series"], 1)
+
+    def test_retain(self):
+        self.cache.record("dev", dict(temp=1.0), 1)
+        self.cache.record("other", dict(temp=1.0), 1)
+        self.cache.retain({"dev"})
+        self.assertEqual(list(self.cache.series), [("dev", "temp")])
+
+    def test_fallback_for_older_range(self):
+        self.cache.record("dev", dict(temp=1.0), 100)
+        fallback = MagicMock(return_value=[[50, 0.5]])
+        points, source = self.cache.query("dev", "temp", start=0, end=200, fallback=fallback)
+        fallback.assert_called_once_with("temp", 0, 100, None)
+        self.assertEqual(points, [[50, 0.5], [100, 1.0]])
+        self.assertEqual(source, "cache+fallback")
+        self.assertEqual(self.cache.query("dev", "temp", start=100, fallback=fallback)[1], "cache")
+
+    def test_fallback_buckets_merged(self):
+        self.cache.record("dev", dict(temp=4.0), 15)
+        fallback = MagicMock(return_value=[dict(time=10, min=2.0, max=2.0, mean=2.0, count=1)])
+        points, _ = self.cache.query("dev", "temp", start=0, bucket=10, fallback=fallback)
+        self.assertEqual(points, [dict(time=10, min=2.0, max=4.0, mean=3.0, count=2)])
+
+    def test_parse_timestamp_ns(self):
+        self.assertEqual(parse_timestamp_ns("1970-01-01T00:00:01.5Z"), int(1.5 * NS_PER_SECOND))
+        self.assertEqual(parse_timestamp_ns("1970-01-01T00:00:02Z"), 2 * NS_PER_SECOND)
@@ -0,0 +1,75 @@
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from particlehub.models import Device, TransientCloudError
+from particlehub.vitals import VitalsCollector, DeviceVitals
+
+
+def diagnostics(strength=80.5, charge=92.0):
+    return dict(updated_at="2021-01-01T00:00:00.000Z", payload=dict(
+        device=dict(network=dict(signal=dict(strength=strength, quality=61.2, strengthv=-71)),
+                    power=dict(battery=dict(charge=charge)), system=dict(uptime=3600, memory=dict(used={"err": -210})),
+                    cloud=dict(connection=dict(disconnects=2))),
+        service=dict(device=dict(status="ok"))))
+
+
+class FakeDevice(Device):
+
+    def __init__(self, device_id, delay=0.05, online=True, failures=0):
+        super().__init__(device_id, "token", online=online)
+        self.delay = delay
+        self.failures = failures
+        self.fetches = 0
+
+    def device_health(self, timeout=None):
+        self.fetches += 1
+        time.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise TransientCloudError("HTTP 503")
+        return DeviceVitals.from_diagnostics(self.id, diagnostics())
+
+
+class TestVitalsCollector(TestCase):
+
+    def test_from_diagnostics_keeps_numeric_metrics(self):
+        vitals = DeviceVitals.from_diagnostics("dev", diagnostics())
+        self.assertEqual(vitals.metrics, dict(signal_strength=80.5, signal_quality=61.2, signal_dbm=-71,
+                                              battery_charge=92.0, uptime=3600, cloud_disconnects=2))
+        self.assertEqual(vitals.summary(), dict(status="ok", updated_at="2021-01-01T00:00:00.000Z",
+                                                signal_strength=80.5, battery_charge=92.0))
+        self.assertEqual(DeviceVitals.from_diagnostics("dev", dict()).metrics, dict())
+
+    def test_collect_in_concurrent_batches(self):
+        logged = list()
+        collector = VitalsCollector(max_workers=10, account_concurrency=10, batch_size=10, rate=1000, burst=1000,
+                                    on_vitals=lambda device, vitals: logged.append(device.id))
+        devices = [FakeDevice("dev%d" % i) for i in range(20)] + [FakeDevice("flaky", failures=1)]
+        start = time.monotonic()
+        results = collector.collect(devices)
+        self.assertLess(time.monotonic() - start, 0.05 * 21 / 3)
+        self.assertIsInstance(results["flaky"], TransientCloudError)
+        self.assertEqual(len(logged), 20)
+        self.assertEqual(collector.stats(), dict(vitals_entries=20, vitals_fetches=20, vitals_errors=1,
+                                                 vitals_refreshing=0))
+        self.assertEqual(collector.due(devices), [devices[-1]])
+        collector.close()
+
+    def test_stale_while_revalidate(self):
+        collector = VitalsCollector(ttl=10, max_stale=100, rate=1000, burst=1000)
+        device = FakeDevice("dev", delay=0)
+        self.assertIsNone(collector.get(device))  # First read starts the fetch
+        collector.executor.submit(lambda: None).result()
+        time.sleep(0.05)
+        vitals = collector.get(device)
+        self.assertEqual(vitals.metrics["battery_charge"], 92.0)
+        self.assertEqual(device.fetches, 1)
+
+        with patch("particlehub.vitals.time.monotonic", return_value=time.monotonic() + 50):
+            self.assertIs(collector.get(device), vitals)  # Stale entry served while it is refreshed
+            self.assertIs(collector.peek("dev"), vitals)
+        time.sleep(0.05)
+        self.assertEqual(device.fetches, 2)
+        with patch("particlehub.vitals.time.monotonic", return_value=time.monotonic() + 500):
+            self.assertIsNone(collector.peek("dev"))
+        collector.close()